@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Benchmarks validate.py on synthetic corpora of increasing size.
+
+For each requested size, a corpus is generated with generate_synthetic_umr.py
+(or reused from the work directory if it already exists), validated with
+--profile-json, and the wall time together with the time of each validation
+stage (level and individual check) is appended to a JSON history file. Each
+new result is compared with the most recent earlier result for the same
+corpus and validator options, and stages that became slower by more than the
+tolerance are reported as regressions.
+
+Usage:
+    python benchmark_validate.py --sizes 1000 10000 100000
+    python benchmark_validate.py --sizes 1000 --error-rate 0.1 --validate-args="--level 2"
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import generate_synthetic_umr
+
+
+current_script_dir = Path(__file__).parent
+validator = current_script_dir / 'validate.py'
+
+# Differences below this limit (in seconds) are never reported as regressions;
+# they are within the noise of process startup and the file system.
+noise_seconds = 0.05
+
+
+def corpus_parameters(args, size):
+    """
+    Returns the generator parameters as a dictionary. It identifies the corpus
+    both in the work directory and in the history.
+    """
+    return {'sentences': size, 'nodes': args.nodes, 'temporal_density': args.temporal_density,
+            'coref_rate': args.coref_rate, 'chain_length': args.chain_length,
+            'error_rate': args.error_rate, 'errors': sorted(args.errors), 'seed': args.seed}
+
+
+def get_corpus(args, size):
+    """
+    Generates the corpus of the given size, unless it is already in the work
+    directory. Returns its path.
+    """
+    params = corpus_parameters(args, size)
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    path = Path(args.workdir) / ('synthetic-%d-%s.umr' % (size, key))
+    if not path.exists():
+        gen_args = argparse.Namespace(**params)
+        gen_args.document_id = 'synthetic'
+        start = time.perf_counter()
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as out:
+            generate_synthetic_umr.generate(out, gen_args)
+        os.replace(tmp, path)
+        print('Generated %s in %.1f s' % (path, time.perf_counter() - start), file=sys.stderr)
+    return path
+
+
+def run_validator(corpus, validate_args):
+    """
+    Runs validate.py on the corpus once. Returns the wall time, the profile
+    summary and the error summary of the validator.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        profile_path = os.path.join(tmpdir, 'profile.json')
+        output_path = os.path.join(tmpdir, 'output.jsonl')
+        command = [sys.executable, str(validator), '--profile-json', profile_path,
+                   '--output-format', 'jsonl', '--output', output_path] + validate_args + [str(corpus)]
+        start = time.perf_counter()
+        process = subprocess.run(command, stdout=subprocess.DEVNULL)
+        wall = time.perf_counter() - start
+        summary = {}
+        if os.path.exists(output_path):
+            with open(output_path, encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if 'summary' in record:
+                        summary = record['summary']
+        profile = {}
+        if os.path.exists(profile_path):
+            with open(profile_path, encoding='utf-8') as f:
+                profile = json.load(f)
+    return wall, profile, summary, process.returncode
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree (with '+' if it has uncommitted
+    changes), or None if it cannot be determined.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=current_script_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=current_script_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+
+def benchmark(args, size, validate_args):
+    """
+    Validates the corpus of the given size args.repeat times and returns the
+    history entry with the fastest run.
+    """
+    corpus = get_corpus(args, size)
+    best = None
+    for i in range(args.repeat):
+        wall, profile, summary, returncode = run_validator(corpus, validate_args)
+        if best is None or wall < best[0]:
+            best = (wall, profile, summary, returncode)
+    wall, profile, summary, returncode = best
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'label': args.label,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': corpus_parameters(args, size),
+        'validate_args': validate_args,
+        'repeat': args.repeat,
+        'returncode': returncode,
+        'wall': wall,
+        'levels': {str(k): v for k, v in profile.get('levels', {}).items()},
+        'checks': {c['check']: c['seconds'] for c in profile.get('checks', [])},
+        'errors': summary.get('errors'),
+        'counts': summary.get('counts', {})
+    }
+
+
+def stage_times(entry):
+    """
+    Returns the measured stages of a history entry as a dictionary from the
+    stage name to seconds.
+    """
+    stages = {'wall': entry['wall']}
+    for level, seconds in entry['levels'].items():
+        stages['level %s' % level] = seconds
+    stages.update(entry['checks'])
+    return stages
+
+
+def find_previous(history, entry):
+    """
+    Returns the most recent entry in the history that was measured on the same
+    corpus with the same validator options, or None.
+    """
+    for old in reversed(history):
+        if old['corpus'] == entry['corpus'] and old['validate_args'] == entry['validate_args']:
+            return old
+    return None
+
+
+def compare(previous, entry, tolerance):
+    """
+    Compares the stages of two history entries. Returns the list of
+    regressions as tuples (stage, old seconds, new seconds).
+    """
+    regressions = []
+    old_stages = stage_times(previous)
+    for stage, seconds in stage_times(entry).items():
+        if stage in old_stages:
+            old = old_stages[stage]
+            if seconds > old * (1 + tolerance) and seconds - old > noise_seconds:
+                regressions.append((stage, old, seconds))
+    return regressions
+
+
+def print_entry(entry, previous):
+    """
+    Prints the stages of the entry, together with the change against the
+    previous entry if there is one.
+    """
+    old_stages = stage_times(previous) if previous else {}
+    print('%d sentences: %.3f s, %s errors' % (entry['corpus']['sentences'], entry['wall'], entry['errors']))
+    for stage, seconds in stage_times(entry).items():
+        if stage in old_stages and old_stages[stage] > 0:
+            change = '%+6.1f%%' % (100 * (seconds - old_stages[stage]) / old_stages[stage])
+        else:
+            change = ''
+        print('  %-32s %10.3f %s' % (stage, seconds, change))
+
+
+def load_history(path):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return []
+
+
+def save_history(path, history):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks validate.py on synthetic UMR corpora.")
+    generate_synthetic_umr.add_arguments(parser, sentences=False)
+    group = parser.add_argument_group('Benchmark')
+    group.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of sentences of the benchmarked corpora.')
+    group.add_argument('--repeat', type=int, default=1, help='Validate each corpus this many times and keep the fastest run.')
+    group.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'umr-benchmark'), help='Directory for the generated corpora. They are reused by later runs.')
+    group.add_argument('--history', default='benchmark_history.json', help='JSON file to which the results are appended.')
+    group.add_argument('--no-history', action='store_true', default=False, help='Do not record the results.')
+    group.add_argument('--label', default=None, help='Free text stored with the results (e.g. the name of the change being measured).')
+    group.add_argument('--validate-args', default='--lang en --wikidata-offline', help='Options passed to validate.py (default: %(default)s).')
+    group.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown of a stage that is reported as a regression (default: %(default)s).')
+    group.add_argument('--fail-on-regression', action='store_true', default=False, help='Exit with status 1 if a regression is found.')
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    validate_args = shlex.split(args.validate_args)
+    history = load_history(args.history)
+    regressions = []
+    for size in args.sizes:
+        entry = benchmark(args, size, validate_args)
+        previous = find_previous(history, entry)
+        print_entry(entry, previous)
+        if previous:
+            for stage, old, new in compare(previous, entry, args.tolerance):
+                print('  REGRESSION %s: %.3f s -> %.3f s (previous run %s, commit %s)' % (stage, old, new, previous['timestamp'], previous['commit']))
+                regressions.append((size, stage))
+        history.append(entry)
+        if not args.no_history:
+            save_history(args.history, history)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
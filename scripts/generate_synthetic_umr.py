@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic UMR files for benchmarking and testing the validator.
+
+The generated documents follow the release format (sentence metadata, Index
+and Words lines, sentence level graph, alignment and document level
+annotation). By default they are valid UMR. With --error-rate, a portion of
+the sentences is broken on purpose, using one of the mutations in
+error_kinds, so that the error paths of the validator are exercised, too.
+
+The scale of the corpus is controlled by the number of sentences, the number
+of nodes per sentence, the number of additional temporal relations between
+events (temporal density), and the probability and length of coreference
+chains.
+
+Usage:
+    python generate_synthetic_umr.py --sentences 1000 --output synthetic.umr
+    python generate_synthetic_umr.py --sentences 1000 --error-rate 0.1 > broken.umr
+"""
+import argparse
+import random
+import sys
+
+
+# Words and the concepts of the nodes that are aligned to them. The entity
+# concepts are identical to the words so that they pass the lemma check.
+events = [('see', 'see-01'), ('give', 'give-01'), ('eat', 'eat-01'), ('say', 'say-01'),
+          ('think', 'think-01'), ('run', 'run-02'), ('read', 'read-01'), ('build', 'build-01'),
+          ('want', 'want-01'), ('find', 'find-01')]
+entities = ['dog', 'book', 'house', 'river', 'tree', 'car', 'letter', 'garden', 'bridge', 'song']
+aspects = ['state', 'activity', 'performance', 'habitual', 'endeavor']
+# Named entities: (entity type, list of name strings, wikidata id).
+named_entities = [('person', ['Edmund', 'Pope'], 'Q1'), ('person', ['John'], 'Q2'),
+                  ('person', ['Mary', 'Smith'], 'Q3'), ('city', ['Paris'], 'Q90'),
+                  ('city', ['Prague'], 'Q1085'), ('country', ['Peru'], 'Q419')]
+
+# Kinds of deliberate errors. Each of them triggers a different test of the
+# validator.
+error_kinds = ['duplicate-node', 'extra-bracket', 'missing-alignment', 'unknown-relation',
+               'missing-aspect', 'undefined-reference', 'temporal-mismatch', 'wiki-mismatch',
+               'duplicate-sentence-id']
+
+delimiter = '#' * 80
+
+
+class Node:
+    """
+    A node of the sentence level graph.
+    """
+    def __init__(self, var, concept):
+        self.var = var
+        self.concept = concept
+        self.attributes = []  # list of (relation, value) where value is a string
+        self.children = []    # list of (relation, Node)
+
+
+class Sentence:
+    """
+    A synthetic sentence: its tokens, graph, alignment and document level
+    annotation.
+    """
+    def __init__(self, number):
+        self.number = number
+        self.sent_id = number
+        self.words = []
+        self.root = None
+        self.nodes = []
+        self.alignment = {}   # var -> string such as '3-4'
+        self.events = []
+        self.temporal = []    # list of (n0, relation, n1)
+        self.modal = [('root', ':modal', 'author')]
+        self.coref = []
+        self.extra_brackets = 0
+        self.error = None     # kind of the deliberate error, if any
+
+
+def new_node(sentence, concept):
+    var = 's%d%s%d' % (sentence.number, concept[0], len(sentence.nodes) + 1)
+    node = Node(var, concept)
+    sentence.nodes.append(node)
+    return node
+
+
+def align_word(sentence, node, words):
+    """
+    Appends the words to the sentence and aligns them to the node.
+    """
+    start = len(sentence.words) + 1
+    sentence.words.extend(words)
+    sentence.alignment[node.var] = '%d-%d' % (start, len(sentence.words))
+
+
+class Generator:
+    """
+    Holds the parameters and the state that spans sentences (events for the
+    temporal relations, open coreference chains).
+    """
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.previous_events = []
+        self.chains = []      # open coreference chains
+        self.used_sent_ids = []
+
+    def entity(self, sentence):
+        """
+        Creates an entity node, possibly as the next mention of an existing
+        coreference chain or the first mention of a new one.
+        """
+        rng = self.rng
+        chain = None
+        if self.chains and rng.random() < self.args.coref_rate:
+            chain = rng.choice(self.chains)
+        if chain is None:
+            if rng.random() < 0.4:
+                kind, name, wiki = rng.choice(named_entities)
+            else:
+                kind, name, wiki = rng.choice(entities), None, None
+            chain = {'kind': kind, 'name': name, 'wiki': wiki, 'last': None, 'mentions': 0}
+            if self.args.chain_length > 1:
+                self.chains.append(chain)
+        node = new_node(sentence, chain['kind'])
+        if chain['name']:
+            name = new_node(sentence, 'name')
+            for i, part in enumerate(chain['name']):
+                name.attributes.append((':op%d' % (i + 1), '"%s"' % part))
+            node.children.append((':name', name))
+            node.attributes.append((':wiki', '"%s"' % chain['wiki']))
+            sentence.alignment[node.var] = '0-0'
+            align_word(sentence, name, chain['name'])
+        else:
+            align_word(sentence, node, [chain['kind']])
+        if chain['last']:
+            sentence.coref.append((chain['last'], ':same-entity', node.var))
+        chain['last'] = node.var
+        chain['mentions'] += 1
+        if chain['mentions'] >= self.args.chain_length and chain in self.chains:
+            self.chains.remove(chain)
+        return node
+
+    def event(self, sentence, budget):
+        """
+        Creates an event node with its arguments. Returns the node and the
+        number of nodes created.
+        """
+        rng = self.rng
+        word, concept = rng.choice(events)
+        node = new_node(sentence, concept)
+        align_word(sentence, node, [word])
+        node.attributes.append((':aspect', rng.choice(aspects)))
+        node.attributes.append((':modal-strength', 'full-affirmative'))
+        sentence.events.append(node.var)
+        used = 1
+        for role in (':ARG0', ':ARG1'):
+            if used >= budget:
+                break
+            if role == ':ARG1' and budget - used > 2 and rng.random() < 0.5:
+                child, n = self.event(sentence, (budget - used) // 2)
+            else:
+                before = len(sentence.nodes)
+                child = self.entity(sentence)
+                n = len(sentence.nodes) - before
+            node.children.append((role, child))
+            used += n
+        return node, used
+
+    def sentence(self, number):
+        rng = self.rng
+        sentence = Sentence(number)
+        budget = max(1, self.args.nodes)
+        sentence.root, used = self.event(sentence, budget)
+        while used < budget:
+            child, n = self.event(sentence, budget - used)
+            sentence.root.children.append((':purpose', child))
+            used += n
+        sentence.words.append('.')
+        # The events are ordered by their position in the document. All
+        # temporal relations point from an earlier to a later event so that
+        # they cannot contradict each other.
+        for e in sentence.events:
+            sentence.temporal.append(('document-creation-time', ':before', e))
+            sentence.modal.append(('author', ':full-affirmative', e))
+            window = self.previous_events[-50:]
+            k = self.args.temporal_density
+            count = int(k) + (1 if rng.random() < k - int(k) else 0)
+            for p in rng.sample(window, min(count, len(window))):
+                sentence.temporal.append((p, ':before', e))
+        self.previous_events.extend(sentence.events)
+        if self.args.error_rate and rng.random() < self.args.error_rate:
+            kind = rng.choice(self.args.errors)
+            if self.break_sentence(sentence, kind):
+                sentence.error = kind
+        self.used_sent_ids.append(sentence.sent_id)
+        return sentence
+
+    def break_sentence(self, sentence, kind):
+        """
+        Introduces one deliberate error of the given kind to the sentence.
+        Returns False if the error cannot be introduced in this sentence.
+        """
+        rng = self.rng
+        if kind == 'duplicate-node':
+            if len(sentence.nodes) < 2:
+                return False
+            sentence.nodes[-1].var = sentence.nodes[0].var
+        elif kind == 'extra-bracket':
+            sentence.extra_brackets += 1
+        elif kind == 'missing-alignment':
+            del sentence.alignment[rng.choice(sentence.nodes).var]
+        elif kind == 'unknown-relation':
+            parents = [n for n in sentence.nodes if n.children]
+            if not parents:
+                return False
+            node = rng.choice(parents)
+            i = rng.randrange(len(node.children))
+            node.children[i] = (':bogus-relation', node.children[i][1])
+        elif kind == 'missing-aspect':
+            node = rng.choice([n for n in sentence.nodes if n.var in sentence.events])
+            node.attributes = [a for a in node.attributes if a[0] != ':aspect']
+        elif kind == 'undefined-reference':
+            sentence.coref.append(('s%dx999' % sentence.number, ':same-event', sentence.root.var))
+        elif kind == 'temporal-mismatch':
+            # The event is after the document creation time, although it has
+            # already been said that it is before.
+            sentence.temporal.append((sentence.events[0], ':before', 'document-creation-time'))
+        elif kind == 'wiki-mismatch':
+            # A later mention in a coreference chain points to another entity.
+            mentions = set(t[2] for t in sentence.coref)
+            for node in sentence.nodes:
+                if node.var in mentions:
+                    for i, (r, v) in enumerate(node.attributes):
+                        if r == ':wiki':
+                            node.attributes[i] = (r, '"Q%d"' % rng.randint(100000, 999999))
+                            return True
+            return False
+        elif kind == 'duplicate-sentence-id':
+            if not self.used_sent_ids:
+                return False
+            sentence.sent_id = self.used_sent_ids[-1]
+        return True
+
+
+def render_node(node, indent):
+    lines = ['(%s / %s' % (node.var, node.concept)]
+    for relation, child in node.children:
+        sub = render_node(child, indent + 4)
+        sub[0] = ' ' * (indent + 4) + relation + ' ' + sub[0]
+        lines.extend(sub)
+    for relation, value in node.attributes:
+        lines.append(' ' * (indent + 4) + relation + ' ' + value)
+    lines[-1] += ')'
+    return lines
+
+
+def render_group(name, triples):
+    items = ['(%s %s %s)' % t for t in triples]
+    return '    %s (%s)' % (name, '\n            '.join(items))
+
+
+def render_sentence(sentence, document_id):
+    lines = [delimiter]
+    lines.append('# meta-info :: sent_id = %s.%d' % (document_id, sentence.number))
+    lines.append('# :: snt%d' % sentence.sent_id)
+    lines.append('Index: ' + '\t'.join(str(i + 1) for i in range(len(sentence.words))))
+    lines.append('Words: ' + '\t'.join(sentence.words))
+    lines.append('')
+    lines.append('# sentence level graph:')
+    graph = render_node(sentence.root, 0)
+    graph[-1] += ')' * sentence.extra_brackets
+    lines.extend(graph)
+    lines.append('')
+    lines.append('# alignment:')
+    for node in sentence.nodes:
+        if node.var in sentence.alignment:
+            lines.append('%s: %s' % (node.var, sentence.alignment[node.var]))
+    lines.append('')
+    lines.append('# document level annotation:')
+    lines.append('(s%ds0 / sentence' % sentence.number)
+    groups = [(':temporal', sentence.temporal), (':modal', sentence.modal), (':coref', sentence.coref)]
+    for name, triples in groups:
+        if triples:
+            lines.append(render_group(name, triples))
+    lines[-1] += ')'
+    lines.append('')
+    lines.append('')
+    return lines
+
+
+def generate(out, args):
+    """
+    Writes a synthetic document to the stream out. Returns the number of
+    sentences that were broken on purpose.
+    """
+    generator = Generator(args)
+    broken = 0
+    for i in range(1, args.sentences + 1):
+        sentence = generator.sentence(i)
+        if sentence.error:
+            broken += 1
+        out.write('\n'.join(render_sentence(sentence, args.document_id)) + '\n')
+    return broken
+
+
+def add_arguments(parser, sentences=True):
+    """
+    Adds the options of the generator to an argument parser, so that other
+    scripts (e.g. benchmark_validate.py) can offer the same options. Such a
+    script may set the number of sentences by other means.
+    """
+    group = parser.add_argument_group('Synthetic corpus', 'Size and shape of the generated documents.')
+    if sentences:
+        group.add_argument('--sentences', type=int, default=1000, help='Number of sentences.')
+    group.add_argument('--nodes', type=int, default=8, help='Approximate number of nodes per sentence.')
+    group.add_argument('--temporal-density', type=float, default=1.0,
+                       help='Average number of temporal relations of each event to the preceding events (besides the relation to the document creation time).')
+    group.add_argument('--coref-rate', type=float, default=0.3,
+                       help='Probability that an entity is the next mention in an existing coreference chain.')
+    group.add_argument('--chain-length', type=int, default=5, help='Maximum number of mentions in a coreference chain.')
+    group.add_argument('--error-rate', type=float, default=0.0, help='Probability that a sentence contains a deliberate error.')
+    group.add_argument('--errors', nargs='+', choices=error_kinds, default=error_kinds,
+                       help='Kinds of deliberate errors to choose from.')
+    group.add_argument('--seed', type=int, default=1, help='Seed of the random number generator.')
+    group.add_argument('--document-id', default='synthetic', help='Prefix of the sentence ids in the metadata.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic UMR documents.")
+    add_arguments(parser)
+    parser.add_argument('--output', default=None, help='Output file (default: standard output).')
+    args = parser.parse_args()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as out:
+            generate(out, args)
+    else:
+        generate(sys.stdout, args)
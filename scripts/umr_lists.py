@@ -1,50 +1,187 @@
+#!/usr/bin/env python3
+"""
+Reads the label inventories of the UMR tool from umr_tool_list/*.csv: roles
+with their inverses, attributes with their values, named entity types,
+abstract concepts and abstract rolesets (each with its group).
+
+The CSV files are spreadsheets exported for the annotators, so reading them
+is not free. load_tables() therefore compiles them once into a table of sets
+and dictionaries, which is pickled to umr_lists.pickle next to this script
+together with the version of the table format and the modification time,
+size and SHA-256 hash of each CSV file. The pickle is compiled again only if
+the format version changes or a CSV file changes its contents.
+
+Run as a script, it prints the differences between the CSV inventories and
+the tables hard-coded in validate.py.
+
+Usage:
+    python umr_lists.py
+"""
 import csv
-from validate import known_relations
-# import pandas as pd
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+
+current_script_dir = Path(__file__).parent
+tool_list_dir = current_script_dir.parent / 'umr_tool_list'
+table_path = current_script_dir / 'umr_lists.pickle'
+
+# Increase when the contents of the compiled table change, so that pickles of
+# the previous format are compiled again.
+table_version = 1
+
+csv_files = ['roles.csv', 'attributes.csv', 'ne_types.csv', 'abstract_concepts.csv', 'abstract_rolesets.csv']
+
+
+def read_csv(name):
+    with open(tool_list_dir / name, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+
 def from_roles():
-    roles = []
-
-    # Adjust the filename as needed.
-    # Assumes the CSV has headers and that column B is the primary role, C is the inverse role.
-    with open('../umr_tool_list/roles.csv', 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        header = next(reader)  # If there's a header row; if not, remove this line.
-
-        for row in reader:
-            # Assuming column B is at index 1 and column C is at index 2
-            role_col_b = row[1].strip() if len(row) > 1 else ""
-            # role_col_c = row[2].strip() if len(row) > 2 else "" # I don't want the inverse roles anymore
-
-            # Check if they start with ':'
-            if role_col_b.startswith(':'):
-                roles.append(role_col_b)
-            # if role_col_c.startswith(':'):
-            #     roles.append(role_col_c)
-
-    # print("Extracted Participant Roles:")
-    # for r in roles:
-    #     print(r)
+    """
+    Returns the roles (column B of roles.csv) as a dictionary from the role to
+    its inverse (column C), or None if the role has no inverse.
+    """
+    roles = {}
+    for row in read_csv('roles.csv')[1:]:
+        role = row[1].strip() if len(row) > 1 else ''
+        inverse = row[2].strip() if len(row) > 2 else ''
+        if role.startswith(':'):
+            roles[role] = inverse if inverse.startswith(':') else None
     return roles
 
-# def from_ne_types():
-#     # Load the CSV file
-#     file_path = '../umr_tool_list/ne_types.csv'
-#
-#     # Read the CSV file into a DataFrame
-#     df = pd.read_csv(file_path, header=None)
-#
-#     # Extract all the named entity types starting from row 4 (index 3 in pandas)
-#     named_entity_types = set()
-#     for row in df.iloc[3:].values:  # Start from row 4
-#         for cell in row:
-#             if pd.notnull(cell):  # Exclude NaN cells
-#                 named_entity_types.add(cell.strip())
-#     return named_entity_types
 
-if __name__ == '__main__':
-    umr_tool_roles = set(from_roles())
-    validate_roles = set(known_relations.keys())
+def from_attributes():
+    """
+    Returns the attributes (column B of attributes.csv) as a dictionary from
+    the attribute to the list of its values (column C of its row and of the
+    following rows with empty column B).
+    """
+    attributes = {}
+    attribute = None
+    for row in read_csv('attributes.csv'):
+        if len(row) > 1 and row[1].strip().startswith(':'):
+            attribute = row[1].strip()
+            attributes[attribute] = []
+        value = row[2].strip() if len(row) > 2 else ''
+        if attribute and value:
+            attributes[attribute].append(value)
+    return attributes
+
+
+def from_ne_types():
+    """
+    Returns the set of named entity types: all cells of ne_types.csv from the
+    fourth row on (the first rows are the title and the color legend).
+    """
+    return frozenset(cell.strip() for row in read_csv('ne_types.csv')[3:] for cell in row if cell.strip())
+
 
-    # print(umr_tool_roles - validate_roles)
-    print(validate_roles - umr_tool_roles)
+def from_grouped(name):
+    """
+    Returns the labels in column B of abstract_concepts.csv or
+    abstract_rolesets.csv as a dictionary from the label to its group (column
+    A of the nearest row above that has it). The header row is skipped.
+    """
+    labels = {}
+    group = None
+    for row in read_csv(name)[1:]:
+        if row and row[0].strip():
+            group = row[0].strip().rstrip(':').strip()
+        label = row[1].strip() if len(row) > 1 else ''
+        if label:
+            labels[label] = group
+    return labels
 
+
+def compile_tables(sources):
+    """
+    Reads all CSV files and returns the table that is pickled by load_tables().
+    """
+    return {
+        'version': table_version,
+        'sources': sources,
+        'roles': from_roles(),
+        'attributes': from_attributes(),
+        'ne_types': from_ne_types(),
+        'abstract_concepts': from_grouped('abstract_concepts.csv'),
+        'abstract_rolesets': from_grouped('abstract_rolesets.csv')
+    }
+
+
+def source_stat(name):
+    st = os.stat(tool_list_dir / name)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def source_hash(name):
+    with open(tool_list_dir / name, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_tables():
+    """
+    Returns the compiled table of the CSV inventories. The pickle is used if
+    its version is current and each CSV file has the same modification time
+    and size as when it was compiled; if only the modification times differ,
+    the hashes decide. Otherwise the table is compiled again and the pickle is
+    replaced (if the directory is not writable, the table is just returned).
+    """
+    stats = {name: source_stat(name) for name in csv_files}
+    table = None
+    try:
+        with open(table_path, 'rb') as f:
+            table = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    if table is not None and table.get('version') == table_version and set(table['sources']) == set(csv_files):
+        changed = [name for name in csv_files if tuple(table['sources'][name]['stat']) != stats[name]]
+        if not changed:
+            return table
+        if all(table['sources'][name]['sha256'] == source_hash(name) for name in changed):
+            # Touched but not modified: remember the new times so that the files are not hashed again.
+            for name in changed:
+                table['sources'][name]['stat'] = stats[name]
+            save_tables(table)
+            return table
+    sources = {name: {'stat': stats[name], 'sha256': source_hash(name)} for name in csv_files}
+    table = compile_tables(sources)
+    save_tables(table)
+    return table
+
+
+def save_tables(table):
+    tmp = '%s.%d.tmp' % (table_path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, table_path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def print_difference(title, csv_labels, validate_labels):
+    """
+    Prints the labels that are only in the CSV inventory and those that are
+    only in the table of validate.py, if there are any.
+    """
+    for where, labels in (('umr_tool_list', set(csv_labels) - set(validate_labels)), ('validate.py', set(validate_labels) - set(csv_labels))):
+        if labels:
+            print('%s only in %s: %s' % (title, where, ' '.join(sorted(labels))))
+
+
+if __name__ == '__main__':
+    import validate
+    tables = load_tables()
+    print_difference('Roles and attributes', list(tables['roles']) + list(tables['attributes']), validate.known_relations)
+    for attribute, values in sorted(tables['attributes'].items()):
+        if attribute in validate.known_relations:
+            print_difference('Values of %s' % attribute, values, validate.known_relations[attribute].get('values', validate.known_relations[attribute].get('value', [])))
+    print_difference('Abstract concepts', tables['abstract_concepts'], list(validate.abstract_concepts) + validate.discourse_concepts)
+    print_difference('Abstract rolesets', tables['abstract_rolesets'], validate.non_event_rolesets + validate.discourse_concepts)
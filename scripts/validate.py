@@ -5,13 +5,30 @@ import io
 import os.path
 import argparse
 import traceback
+import multiprocessing
+import gc
+import pickle
+import threading
+import socketserver
+import signal
+from contextlib import redirect_stdout, redirect_stderr
+import json
+import sqlite3
+import time
+import hashlib
+import importlib.metadata
+import mmap
+import stat
+import codecs
 # According to https://stackoverflow.com/questions/1832893/python-regex-matching-unicode-properties,
 # the regex module has the same API as re but it can check Unicode character properties using \p{}
 # as in Perl.
 #import re
 import regex as re
 import unicodedata
-from functools import cmp_to_key # for custom partial sorting
+from functools import lru_cache # for memoization
+from collections import deque
+import heapq
 # Optionally we can access Wikidata API through the requests library.
 # Install the library with pip3 install requests (or python3 -m pip install requests).
 # If the library is not installed, this script should still work, just skipping any dereferences of Wikidata codes.
@@ -31,47 +48,200 @@ sentence_line = 0 # The line in the input file on which the current sentence sta
 sentence_id = None # The most recently read sentence id
 error_counter = {} # key: error type value: error count
 warn_on_missing_files = set() # langspec files which you should warn about in case they are missing (can be deprel, edeprel, feat_val, tokens_w_space)
+sink = None # Where warn() sends the error messages; see open_sink()
+recorder = None # With --cache-dir, warn() collects the messages of the current file here instead of reporting them; see validate_cached_file()
 
-import spacy #for lemmatizer
-nlp = spacy.load("en_core_web_sm")
-
-def warn(msg, testclass, testlevel, testid, lineno=0, explanation=None):
+def warn(msg, testclass, testlevel, testid, lineno=0, explanation=None, node=None):
     """
-    Print the error/warning message.
-    If lineno is 0, print the number of the current line (most recently read from input).
-    If lineno is < 0, print the number of the first line of the current sentence.
-    If lineno is > 0, print lineno (probably pointing somewhere in the current sentence).
+    Report the error/warning message.
+    If lineno is 0, report the number of the current line (most recently read from input).
+    If lineno is < 0, report the number of the first line of the current sentence.
+    If lineno is > 0, report lineno (probably pointing somewhere in the current sentence).
     If explanation contains a string and this is the first time we are reporting
     an error of this type, the string will be appended to the main message. It
     can be used as an extended explanation of the situation.
+    If node is given, it is the variable of the node the message is about.
+    The message is not printed directly but passed as a record to report().
+    """
+    global curr_fname, curr_line, sentence_line, sentence_id
+    if lineno < 0:
+        lineno = sentence_line
+    elif lineno == 0:
+        lineno = curr_line
+    # Global variable (last read sentence id): sentence_id
+    record = {'file': curr_fname, 'line': lineno, 'sentence': sentence_id or None, 'level': testlevel, 'class': testclass, 'testid': testid, 'node': node, 'message': msg}
+    emit(record, explanation)
+
+def emit(record, explanation=None):
+    """
+    Passes a message record to the recorder if one is active, otherwise to
+    report(). Messages found elsewhere (e.g. in a worker process) are passed
+    here when their turn comes.
+    """
+    if recorder is not None:
+        recorder.append((record, explanation))
+    else:
+        report(record, explanation)
+
+def report(record, explanation=None):
+    """
+    Counts the error/warning and passes it to the diagnostics sink, which writes
+    it in the format selected by --output-format, unless --quiet is in effect or
+    --max-err errors of the same class have been reported already.
     """
-    global curr_fname, curr_line, sentence_line, sentence_id, error_counter, args
+    global error_counter, args
+    testclass = record['class']
     error_counter[testclass] = error_counter.get(testclass, 0)+1
     if args.max_err > 0 and error_counter[testclass] > args.max_err:
         if error_counter[testclass] == args.max_err + 1:
-            print(('...suppressing further errors regarding ' + testclass), file=sys.stderr)
+            sink.note('...suppressing further errors regarding ' + testclass)
         pass # supressed
     elif not args.quiet:
         if explanation and error_counter[testclass] == 1:
-            msg += ' ' + explanation
+            record['message'] += ' ' + explanation
+        sink.write(record)
+
+class TextSink:
+    """
+    Diagnostics sink that writes the records as lines of plain text, the
+    format that the validator has always printed. Free-form notes (such as the
+    traceback of an internal error) are written as they are.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, record):
         if len(args.input) > 1: # several files, should report which one
-            if curr_fname=='-':
+            if record['file'] == '-':
                 fn = '(in STDIN) '
             else:
-                fn = '(in '+os.path.basename(curr_fname)+') '
+                fn = '(in '+os.path.basename(record['file'])+') '
         else:
             fn = ''
         sent = ''
-        node = ''
-        # Global variable (last read sentence id): sentence_id
-        if sentence_id:
-            sent = ' Sent ' + sentence_id
-        if lineno > 0:
-            print("[%sLine %d%s%s]: [L%d %s %s] %s" % (fn, lineno, sent, node, testlevel, testclass, testid, msg), file=sys.stderr)
-        elif lineno < 0:
-            print("[%sLine %d%s%s]: [L%d %s %s] %s" % (fn, sentence_line, sent, node, testlevel, testclass, testid, msg), file=sys.stderr)
+        if record['sentence']:
+            sent = ' Sent ' + record['sentence']
+        self.stream.write("[%sLine %d%s]: [L%d %s %s] %s\n" % (fn, record['line'], sent, record['level'], record['class'], record['testid'], record['message']))
+
+    def note(self, text):
+        if not text.endswith('\n'):
+            text += '\n'
+        self.stream.write(text)
+
+    def summarize(self, summary):
+        """
+        Prints the number of errors of each class and the final verdict.
+        """
+        if not args.quiet:
+            for k, v in sorted(summary['counts'].items()):
+                if k == 'Warning':
+                    self.stream.write('Warnings: %d\n' % v)
+                else:
+                    self.stream.write('%s errors: %d\n' % (k, v))
+            if summary['passed']:
+                self.stream.write('*** PASSED ***\n')
+            else:
+                self.stream.write('*** FAILED *** with %d errors\n' % summary['errors'])
+
+    def close(self):
+        self.stream.flush()
+
+class JsonLinesSink(TextSink):
+    """
+    Diagnostics sink that writes every record as one JSON object per line.
+    Notes are written as objects with the single key 'note', and the summary
+    as a final object with the key 'summary'.
+    """
+    def write(self, record):
+        self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def note(self, text):
+        self.stream.write(json.dumps({'note': text.rstrip('\n')}, ensure_ascii=False) + '\n')
+
+    def summarize(self, summary):
+        self.stream.write(json.dumps({'summary': summary}, ensure_ascii=False) + '\n')
+
+class SarifSink(TextSink):
+    """
+    Diagnostics sink that writes a SARIF 2.1.0 log, which is understood by code
+    scanning services and editors. The log is one JSON document, hence the
+    records are kept in memory and written when the sink is closed. Every test
+    id is a rule; the results of the class 'Warning' have the level 'warning',
+    all other results are errors.
+    """
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.rules = {}
+        self.results = []
+        self.notes = []
+        self.summary = {}
+
+    def write(self, record):
+        if not record['testid'] in self.rules:
+            self.rules[record['testid']] = {'id': record['testid'], 'properties': {'class': record['class'], 'level': record['level']}}
+        result = {'ruleId': record['testid'], 'level': 'warning' if record['class'] == 'Warning' else 'error', 'message': {'text': record['message']}}
+        if record['file'] and record['file'] != '-':
+            location = {'artifactLocation': {'uri': record['file'].replace(os.sep, '/')}}
+            # SARIF lines are 1-based; line 0 means that there is no line to point to.
+            if record['line'] > 0:
+                location['region'] = {'startLine': record['line']}
+            result['locations'] = [{'physicalLocation': location}]
+        result['properties'] = {'class': record['class'], 'level': record['level'], 'sentence': record['sentence'], 'node': record['node']}
+        self.results.append(result)
+
+    def note(self, text):
+        self.notes.append({'level': 'note', 'message': {'text': text.rstrip('\n')}})
+
+    def summarize(self, summary):
+        self.summary = summary
+
+    def close(self):
+        invocation = {'executionSuccessful': not 'Internal' in self.summary['counts'], 'toolExecutionNotifications': self.notes, 'properties': self.summary}
+        run = {'tool': {'driver': {'name': 'validate.py', 'rules': list(self.rules.values())}}, 'invocations': [invocation], 'results': self.results}
+        json.dump({'version': '2.1.0', '$schema': 'https://json.schemastore.org/sarif-2.1.0.json', 'runs': [run]}, self.stream, ensure_ascii=False, indent=2)
+        self.stream.write('\n')
+        self.stream.flush()
+
+class CaptureSink:
+    """
+    Diagnostics sink of a --jobs worker process. It only collects the records
+    and notes so that they can be sent to the parent process, which passes them
+    to its own sink in input order (see validate_files_parallel()).
+    """
+    def __init__(self):
+        self.items = []
+
+    def write(self, record):
+        self.items.append(('record', record))
+
+    def note(self, text):
+        self.items.append(('note', text))
+
+def replay(items, target):
+    """
+    Passes records and notes collected by a CaptureSink to another sink.
+    """
+    for kind, item in items:
+        if kind == 'record':
+            target.write(item)
         else:
-            print("[%sLine %d%s%s]: [L%d %s %s] %s" % (fn, curr_line, sent, node, testlevel, testclass, testid, msg), file=sys.stderr)
+            target.note(item)
+
+sink_classes = {'text': TextSink, 'jsonl': JsonLinesSink, 'sarif': SarifSink}
+
+def open_sink(args):
+    """
+    Creates the diagnostics sink selected by --output-format. It writes to the
+    file given by --output, or to the standard error output. In both cases the
+    stream is block-buffered, so that long reports are not written with one
+    system call per message (the standard error output of Python is otherwise
+    flushed after every line).
+    """
+    if args.output:
+        stream = io.open(args.output, 'w', encoding='utf-8', buffering=65536)
+    else:
+        stream = io.open(sys.stderr.fileno(), 'w', encoding=sys.stderr.encoding, errors=sys.stderr.errors, buffering=65536, closefd=False)
+    return sink_classes[args.output_format](stream)
 
 def debugnode(nid, node_dict):
     """
@@ -82,10 +252,11 @@ def debugnode(nid, node_dict):
     if nid in node_dict:
         concept = 'UNKNOWN CONCEPT'
         alignment = 'UNALIGNED'
-        if 'concept' in node_dict[nid]:
-            concept = node_dict[nid]['concept']
-        if 'alignment' in node_dict[nid] and node_dict[nid]['alignment']['tokstr'] != '':
-            alignment = node_dict[nid]['alignment']['tokstr']
+        node = node_dict[nid]
+        if node.concept is not None:
+            concept = node.concept
+        if node.alignment is not None and node.alignment.tokstr != '':
+            alignment = node.alignment.tokstr
         result = "%s (%s '%s')" % (nid, concept, alignment)
     return result
 
@@ -132,41 +303,174 @@ align_re = re.compile(r"^s[0-9]+[a-z0-9]+:")
 def is_alignment(line):
     return align_re.match(line)
 
+# The characters matched by \s in the regular expressions above. Python's own
+# str.isspace() and str.strip() also treat \x1c-\x1f as whitespace, so they
+# must be given this set explicitly to work the same way as the expressions.
+whitespace_chars = '\t\n\x0b\x0c\r \x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000'
+
 def shorten(string):
     return string if len(string) < 25 else string[:20]+'[...]'
 
-wikidata_cache = {}
+#------------------------------------------------------------------------------
+# Wikidata labels of the :wiki values, shown in some messages and reports.
+# The labels are looked up in memory, then in the disk cache (--wikidata-cache)
+# and in a local dump (--wikidata-dump), and only then through the Wikidata
+# API, with up to 50 ids per wbgetentities request. Callers that need several
+# labels should pass all of them to prefetch_wikidata_labels() first. If the
+# API cannot be reached (or with --wikidata-offline), the labels are empty.
+#------------------------------------------------------------------------------
 
-def get_wikidata_label(id):
-    if requests_installed:
-        if id in wikidata_cache:
-            return wikidata_cache[id]
+wikidata_cache = {} # key: Q-id; value: label ('' if the id has no English label)
+wikidata_batch_size = 50 # the maximum number of ids in one wbgetentities request
+wikidata_session = None
+wikidata_unreachable = False # set after a failed request, so that the API is not tried again in this run
+wikidata_failed = set() # ids whose labels could not be fetched in this run (they are empty but not stored on disk)
+wikidata_failed_lookups = 0 # how many times get_wikidata_label() returned the empty label of such an id
+wikidata_dump = None # key: Q-id; value: label; loaded from --wikidata-dump
+wikidata_cache_db = None
+wikidata_cache_pid = None # the process that opened wikidata_cache_db; worker processes must open their own connection
+wikidata_id_re = re.compile(r"^Q[1-9][0-9]*$")
+
+def get_wikidata_cache_db():
+    """
+    Returns the connection to the disk cache of Wikidata labels (or None if the
+    cache is not used). Like the lemma cache, it is an SQLite database.
+    """
+    global wikidata_cache_db, wikidata_cache_pid
+    if not args.wikidata_cache:
+        return None
+    if wikidata_cache_db is None or wikidata_cache_pid != os.getpid():
+        wikidata_cache_db = sqlite3.connect(args.wikidata_cache, timeout=60)
+        wikidata_cache_db.execute('CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, label TEXT, fetched REAL)')
+        wikidata_cache_pid = os.getpid()
+    return wikidata_cache_db
+
+def get_wikidata_dump():
+    """
+    Returns the labels from --wikidata-dump, loading them on first use. The
+    dump is either a JSON file (an object mapping ids to labels, or a saved
+    wbgetentities response), or an SQLite database with the table
+    labels (id, label), e.g. a copy of --wikidata-cache.
+    """
+    global wikidata_dump
+    if wikidata_dump is None:
+        wikidata_dump = {}
+        if args.wikidata_dump:
+            if args.wikidata_dump.endswith('.json'):
+                with io.open(args.wikidata_dump, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if 'entities' in data:
+                    data = {id: entity.get('labels', {}).get('en', {}).get('value', '') for id, entity in data['entities'].items()}
+                wikidata_dump = {id: str(label) for id, label in data.items()}
+            else:
+                db = sqlite3.connect(args.wikidata_dump)
+                wikidata_dump = dict(db.execute('SELECT id, label FROM labels'))
+                db.close()
+    return wikidata_dump
+
+def get_wikidata_session():
+    """
+    Returns the HTTP session for the Wikidata API, which keeps the connection
+    open between requests.
+    """
+    global wikidata_session
+    if wikidata_session is None:
+        wikidata_session = requests.Session()
+        wikidata_session.headers['User-Agent'] = 'UMR-validate.py ' + requests.utils.default_user_agent()
+    return wikidata_session
+
+def prefetch_wikidata_labels(ids):
+    """
+    Makes sure that the labels of the given ids are in the in-memory cache.
+    Ids that are not in the disk cache (or are older than --wikidata-cache-ttl
+    days there) nor in the dump are requested from the API in batches.
+    Values that are not Q-ids get an empty label without asking the API,
+    which would reject the whole batch because of them.
+    """
+    global wikidata_unreachable
+    ids = [id for id in dict.fromkeys(ids) if not id in wikidata_cache]
+    for id in ids:
+        if not wikidata_id_re.match(id):
+            wikidata_cache[id] = ''
+    ids = [id for id in ids if not id in wikidata_cache]
+    if not ids:
+        return
+    db = get_wikidata_cache_db()
+    if db:
+        oldest = time.time() - args.wikidata_cache_ttl * 86400
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            query = 'SELECT id, label FROM labels WHERE fetched >= ? AND id IN (%s)' % ','.join('?' * len(chunk))
+            for id, label in db.execute(query, [oldest] + chunk):
+                wikidata_cache[id] = label
+        ids = [id for id in ids if not id in wikidata_cache]
+    dump = get_wikidata_dump()
+    for id in ids:
+        if id in dump:
+            wikidata_cache[id] = dump[id]
+    ids = [id for id in ids if not id in wikidata_cache]
+    fetched = {}
+    for i in range(0, len(ids), wikidata_batch_size):
+        if args.wikidata_offline or not requests_installed or wikidata_unreachable:
+            break
+        batch = ids[i:i+wikidata_batch_size]
         # Create parameters.
         params = {
             'action': 'wbgetentities',
-            'ids': id,
+            'ids': '|'.join(batch),
+            'props': 'labels',
             'format': 'json',
             'languages': 'en'
         }
         # Fetch the API.
         data = fetch_wikidata(params)
-        if data:
-            # Extract the label.
-            data = data.json()
-            label = str(data['entities'][id]['labels']['en']['value'])
-            wikidata_cache[id] = label
-            return label
-        else:
-            return ''
-    else:
-        return ''
+        if data is None:
+            wikidata_unreachable = True
+            break
+        # Extract the labels. Ids that do not exist are reported as missing.
+        entities = data['entities']
+        for id in batch:
+            fetched[id] = str(entities.get(id, {}).get('labels', {}).get('en', {}).get('value', ''))
+    wikidata_cache.update(fetched)
+    # The ids that could not be fetched have no label in this run but they are
+    # not stored on disk, so that they are tried again next time.
+    for id in ids:
+        if not id in wikidata_cache:
+            wikidata_cache[id] = ''
+            if not args.wikidata_offline and requests_installed:
+                wikidata_failed.add(id)
+    if db and fetched:
+        now = time.time()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO labels (id, label, fetched) VALUES (?, ?, ?)', [(id, label, now) for id, label in fetched.items()])
+
+def get_wikidata_label(id):
+    """
+    Returns the English label of a Wikidata id, or '' if it is not known.
+    """
+    global wikidata_failed_lookups
+    if not id in wikidata_cache:
+        prefetch_wikidata_labels([id])
+    if id in wikidata_failed:
+        wikidata_failed_lookups += 1
+    return wikidata_cache[id]
 
 def fetch_wikidata(params):
-    url = 'https://www.wikidata.org/w/api.php'
+    """
+    Sends one request to the Wikidata API (--wikidata-url). Returns the decoded
+    JSON response, or None if the request failed. The API reports some errors
+    (e.g. maxlag, rate limits or invalid ids) with HTTP status 200 and an
+    'error' object instead of 'entities'; these are failures, too.
+    """
     try:
-        return requests.get(url, params=params)
-    except:
-        return '' # error
+        response = get_wikidata_session().get(args.wikidata_url, params=params, timeout=args.wikidata_timeout)
+        response.raise_for_status()
+        data = response.json()
+    except Exception:
+        return None # error
+    if not isinstance(data, dict) or 'error' in data or not 'entities' in data:
+        return None
+    return data
 
 
 
@@ -177,6 +481,64 @@ def fetch_wikidata(params):
 sentid_re = re.compile(r"^#\s*::\s*(snt[0-9]+)(?:\s|$)")
 sentid_tokens_re = re.compile(r"^#\s*::\s*(snt[0-9]+)\s+(.+)$")
 
+def mapped_file(inp):
+    """
+    If inp is a non-empty UTF-8 text file opened on a regular file and nothing
+    has been read from it yet, memory-maps the file and returns the map.
+    Otherwise (standard input from a pipe, other encodings, empty files)
+    returns None and the caller reads inp line by line. None is also returned
+    if the file contains carriage returns, which the text mode would translate.
+    """
+    try:
+        if codecs.lookup(inp.encoding).name != 'utf-8' or inp.errors != 'strict' or inp.tell() != 0:
+            return None
+        fd = inp.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, ValueError, LookupError, TypeError):
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return None
+    mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if mm.find(b'\r') >= 0:
+        mm.close()
+        return None
+    return mm
+
+def mapped_lines(mm, inp):
+    """
+    Yields the lines of a memory-mapped file (see mapped_file()) without the
+    newline characters, each with a flag telling whether its Unicode
+    normalization must be checked. The file is decoded one annotation block
+    (up to the next empty line) at a time, so only the current block is held
+    in memory, and the normalization is checked for the whole block first;
+    individual lines are checked only if the block is not normalized. If a
+    block is not valid UTF-8, the rest of the file is read line by line from
+    inp, starting at that block, which reports the faulty line.
+    """
+    with mm:
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            end = mm.find(b'\n\n', pos)
+            end = size if end < 0 else end + 2
+            try:
+                block = str(mm[pos:end], 'utf-8')
+            except UnicodeDecodeError:
+                break
+            check_normalization = not unicodedata.is_normalized('NFC', block)
+            lines = block.split('\n')
+            # Every block but the last ends with a newline, so the last item
+            # is not a line.
+            if lines[-1] == '':
+                lines.pop()
+            for line in lines:
+                yield line, check_normalization
+            pos = end
+    if pos < size:
+        inp.seek(pos)
+        for line in inp:
+            yield line.rstrip('\n'), True
+
 def sentences(inp, args):
     """
     `inp` a file-like object yielding lines as unicode
@@ -234,7 +596,15 @@ def sentences(inp, args):
     corrupt = False # In case of spurious line check the remaining lines of the sentence but do not yield the sentence for further processing.
     testlevel = 1
     testclass = 'Format'
-    for line_counter, line in enumerate(inp):
+    # If the input is a regular file, we take it block by block from a memory
+    # map and split the blocks to lines, which is much faster than reading it
+    # line by line.
+    mm = mapped_file(inp)
+    if mm is None:
+        lines_in = ((line, True) for line in inp)
+    else:
+        lines_in = mapped_lines(mm, inp)
+    for line_counter, (line, check_normalization) in enumerate(lines_in):
         curr_line = line_counter + 1
         if not sentence_line:
             sentence_line = curr_line
@@ -243,15 +613,16 @@ def sentences(inp, args):
         line = line.rstrip("\n")
         if args.inline_comments:
             line = remove_inline_comment(line)
-        if has_trailing_whitespace(line):
+        if line and line[-1] in whitespace_chars:
             if args.check_trailing_whitespace:
                 testid = 'trailing-whitespace'
                 testmessage = 'Trailing whitespace should be removed.'
                 warn(testmessage, testclass, testlevel, testid)
-            line = remove_trailing_whitespace(line)
-        validate_unicode_normalization(line)
+            line = line.rstrip(whitespace_chars)
+        if check_normalization:
+            validate_unicode_normalization(line)
         # Unlike trailing whitespace, leading whitespace is legitimate (indentation) but we ignore it anyway.
-        line = remove_leading_whitespace(line)
+        line = line.lstrip(whitespace_chars)
         if not line: # empty line means end of block (and possibly end of sentence)
             if comments or lines: # end of an annotation block
                 blocks.append({'line0': bline0, 'comments': comments, 'lines': lines})
@@ -299,9 +670,17 @@ def sentences(inp, args):
                 testmessage = 'Spurious comment line. Comments are only allowed before a sentence.'
                 warn(testmessage, testclass, testlevel, testid)
                 corrupt = True
-        elif is_root(line) or is_attribute(line) or is_alignment(line):
+        # The type of the line follows from its first character: '(' starts
+        # a graph, ':' a relation of the graph, 's' a node variable in the
+        # alignment block; interlinear glossing lines start with a header
+        # such as 'Words' and none of the headers starts with 's'.
+        elif line[0] == '(':
+            lines.append(line)
+        elif line[0] == ':' and is_attribute(line):
             lines.append(line)
-        elif is_ilg(line):
+        elif line[0] == 's' and is_alignment(line):
+            lines.append(line)
+        elif line[0] != ':' and line[0] != 's' and is_ilg(line):
             lines.append(line)
         else: # A line which is neither a comment nor a token/word, nor empty. That's bad!
             testid = 'invalid-line'
@@ -331,6 +710,8 @@ def validate_unicode_normalization(text):
     letter plus combining diacritics) conform to NFC normalization (canonical
     decomposition followed by canonical composition).
     """
+    if unicodedata.is_normalized('NFC', text):
+        return
     normalized_text = unicodedata.normalize('NFC', text)
     if text != normalized_text:
         # Find the first unmatched character and include it in the report.
@@ -381,10 +762,168 @@ tokrng_re = re.compile(r"^0-0|([1-9][0-9]*)-([1-9][0-9]*)$")
 tokrngs_re = re.compile(r"^(?:0-0|([1-9][0-9]*)-([1-9][0-9]*)(,\s*[1-9][0-9]*-[1-9][0-9]*)*)$")
 tokrng_neg_re = re.compile(r"^-1--1|0-0|([1-9][0-9]*)-([1-9][0-9]*)$")
 tokrngs_neg_re = re.compile(r"^(?:-1--1|0-0|([1-9][0-9]*)-([1-9][0-9]*)(,\s*[1-9][0-9]*-[1-9][0-9]*)*)$")
+punctuation_tokens = frozenset('-.,;:?!()') # tokens that need not be aligned
 
 svariable_re = re.compile(r"^s[0-9]+s0")
 dvariable_re = re.compile(r"^([a-z]+(?:-[a-z]+)*|s[0-9]+[a-z]+[0-9]*)(\s|\)|$)") # constant or concept node id; we need to recognize following closing bracket but we must not consume it
 
+class GraphLexer:
+    """
+    Walks one line of a sentence level or document level graph with a position
+    cursor. The parser asks for the kinds of tokens it expects at the cursor
+    (the same string can be e.g. a concept or an atom depending on the context)
+    and gets a token with its kind, text and offsets. Unlike repeatedly cutting
+    the matched prefix off the line, this does not copy the rest of the line
+    after every token, so long one-line graphs are processed in linear time.
+    """
+    # For each kind of token: a regular expression (matched at the cursor, so
+    # it must not be anchored with '^'), the group that is the text of the
+    # token, and the group whose end is the end of the token. Numbers, atoms
+    # and document level node ids must be followed by whitespace or a closing
+    # bracket, but the bracket is not part of the token.
+    kinds = {
+        'lparen':    (re.compile(r"\("), 0, 0),
+        'rparen':    (re.compile(r"\)"), 0, 0),
+        'slash':     (re.compile(r"/"), 0, 0),
+        'sentence':  (re.compile(r"/ sentence"), 0, 0),
+        'variable':  (re.compile(variable_re.pattern[1:]), 0, 0),
+        'concept':   (re.compile(concept_re.pattern[1:]), 0, 0),
+        'relation':  (re.compile(relation_re.pattern[1:]), 0, 0),
+        'string':    (re.compile(string_re.pattern[1:]), 1, 0),
+        'number':    (re.compile(number_re.pattern[1:]), 1, 1),
+        'atom':      (re.compile(atom_re.pattern[1:]), 1, 1),
+        'svariable': (re.compile(svariable_re.pattern[1:]), 0, 0),
+        'dvariable': (re.compile(dvariable_re.pattern[1:]), 1, 1)
+    }
+    whitespace_re = re.compile(r"\s+")
+
+    def __init__(self, line):
+        self.line = line
+        self.pos = 0
+
+    def at_end(self):
+        return self.pos >= len(self.line)
+
+    def rest(self):
+        """
+        Returns the unprocessed part of the line (for error messages).
+        """
+        return self.line[self.pos:]
+
+    def skip_whitespace(self):
+        match = self.whitespace_re.match(self.line, self.pos)
+        if match:
+            self.pos = match.end()
+
+    def peek(self, *kinds):
+        """
+        Returns the first token of the given kinds found at the cursor as a
+        tuple (kind, text, start, end), or None. Does not move the cursor.
+        """
+        for kind in kinds:
+            regex, text_group, end_group = self.kinds[kind]
+            match = regex.match(self.line, self.pos)
+            if match:
+                return (kind, match.group(text_group), self.pos, match.end(end_group))
+        return None
+
+    def advance(self, token):
+        """
+        Moves the cursor after a token obtained from peek() and the whitespace
+        that follows it.
+        """
+        self.pos = token[3]
+        self.skip_whitespace()
+
+    def accept(self, *kinds):
+        """
+        Like peek() but if a token is found, the cursor moves after it.
+        """
+        token = self.peek(*kinds)
+        if token:
+            self.advance(token)
+        return token
+
+# A document may have tens of thousands of nodes and every relation is stored
+# twice (at the parent as outgoing and at the child as incoming), so nodes,
+# relations and alignments are small objects with fixed slots rather than
+# dictionaries, and their labels are interned.
+
+class Node:
+    """
+    A node of the sentence level graph. The sentence nodes of the document
+    level graphs (e.g. 's5s0') and unknown nodes referenced from document level
+    relations are stored as Nodes, too. Attributes that are not known (yet)
+    are None: e.g., the event_reason is set only if detect_events() finds out
+    that the node is an event.
+    """
+    __slots__ = ('variable', 'line0', 'concept', 'relations', 'alignment', 'event_reason', 'entity_reason', 'cluster', 'cluster_relations', 'cluster_line0')
+
+    def __init__(self, variable, line0, concept=None, relations=None, alignment=None):
+        self.variable = sys.intern(variable) if variable is not None else None
+        self.line0 = line0
+        self.concept = concept
+        self.relations = relations
+        self.alignment = alignment
+        self.event_reason = None
+        self.entity_reason = None
+        self.cluster = None
+        self.cluster_relations = None
+        self.cluster_line0 = None
+
+    # Nodes are sent between processes when the sentences of one file are
+    # validated in parallel (see --sentence-jobs). Pickling the constructor arguments
+    # is much faster than the default pickling of objects with __slots__.
+    def __reduce__(self):
+        return (Node, (self.variable, self.line0, self.concept, self.relations, self.alignment),
+                (self.event_reason, self.entity_reason, self.cluster, self.cluster_relations, self.cluster_line0))
+
+    def __setstate__(self, state):
+        self.event_reason, self.entity_reason, self.cluster, self.cluster_relations, self.cluster_line0 = state
+
+class Relation:
+    """
+    A relation of a node in the sentence level graph. Direction (dir) is 'out'
+    at the parent node and 'in' at the child node. Type is 'node' if the value
+    is the variable of the child node, otherwise it is 'string' or 'atom'.
+    """
+    __slots__ = ('relation', 'dir', 'type', 'value', 'line0')
+
+    def __init__(self, relation, dir, line0, type=None, value=''):
+        self.relation = sys.intern(relation)
+        self.dir = dir
+        self.line0 = line0
+        self.type = type
+        self.value = sys.intern(value)
+
+    def set_value(self, type, value):
+        self.type = type
+        self.value = sys.intern(value)
+
+    def __reduce__(self):
+        return (Relation, (self.relation, self.dir, self.line0, self.type, self.value))
+
+class Alignment:
+    """
+    The tokens to which a node is aligned: the segments as pairs of 1-based
+    token ids (first, last) ([(0, 0)] if the node is unaligned), the tokens as
+    a string, and the line of the alignment block (None if the alignment was
+    not given). The ids of the individual tokens are in tokids.
+    """
+    __slots__ = ('spans', 'tokstr', 'line0')
+
+    def __init__(self, spans, tokstr, line0=None):
+        self.spans = spans
+        self.tokstr = tokstr
+        self.line0 = line0
+
+    @property
+    def tokids(self):
+        return [tokid for t0, t1 in self.spans for tokid in range(t0, t1+1)]
+
+    def __reduce__(self):
+        return (Alignment, (self.spans, self.tokstr, self.line0))
+
 def validate_sentence_metadata(sentence, known_ids, args):
     """
     Verifies the first annotation block of a sentence. There must be a comment
@@ -591,147 +1130,125 @@ def validate_sentence_graph(sentence, node_dict, args):
     iline = sentence[1]['line0'] + len(sentence[1]['comments']) - 1
     for l in sentence[1]['lines']:
         iline += 1
-        pline = l # processed line: we will remove stuff from pline but not from l
-        while pline:
-            # Remove leading whitespace.
-            pline = remove_leading_whitespace(pline)
-            if pline.startswith('('):
+        lexer = GraphLexer(l)
+        while not lexer.at_end():
+            # Skip leading whitespace.
+            lexer.skip_whitespace()
+            token = lexer.peek('lparen', 'relation', 'rparen')
+            if token and token[0] == 'lparen':
                 if not expecting_node_definition:
                     testid = 'extra-opening-bracket'
-                    testmessage = "Not expecting full node definition (opening bracket), found '%s'." % pline
+                    testmessage = "Not expecting full node definition (opening bracket), found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = remove_leading_whitespace(pline[1:])
+                lexer.advance(token)
                 # Now expecting variable identifier, e.g., 's15p'.
-                if variable_re.match(pline):
-                    match = variable_re.match(pline)
-                    variable = match.group(0)
+                token = lexer.accept('variable')
+                if token:
+                    variable = sys.intern(token[1])
                     # If this is not the root node (i.e., there is something on
                     # the stack), store this node as the child of the most recently
                     # added relation of the parent node. (There must be at least
                     # one relation and its type must be 'node'. Should we verify
                     # it?)
                     if stack:
-                        node_dict[stack[-1]]['relations'][-1]['value'] = variable
-                    pline = remove_leading_whitespace(variable_re.sub('', pline, 1))
+                        node_dict[stack[-1]].relations[-1].value = variable
                     # The variable serves as node id. It must be unique.
                     if variable in node_dict:
                         testid = 'non-unique-node-id'
-                        testmessage = "The node id (variable) '%s' is not unique. It was previously used on line %d." % (variable, node_dict[variable]['line0'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                        testmessage = "The node id (variable) '%s' is not unique. It was previously used on line %d." % (variable, node_dict[variable].line0)
+                        warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                     else:
                         # We have read the beginning of a node, including its
                         # variable. Now store it both globally and locally.
-                        node_dict[variable] = {'variable': variable, 'line0': iline}
+                        node_dict[variable] = Node(variable, iline, relations=[])
                         sentence[1]['nodes'].add(variable)
                         stack.append(variable)
                     # Now expecting the slash ('/').
-                    if pline.startswith('/'):
-                        pline = remove_leading_whitespace(pline[1:])
+                    if lexer.accept('slash'):
                         # Now expecting the concept string, e.g., 'have-quant-91'.
-                        if concept_re.match(pline):
-                            match = concept_re.match(pline)
-                            concept = match.group(0)
-                            node_dict[variable]['concept'] = concept
-                            pline = remove_leading_whitespace(concept_re.sub('', pline, 1))
+                        token = lexer.accept('concept')
+                        if token:
+                            node_dict[variable].concept = sys.intern(token[1])
                         else:
                             testid = 'missing-concept-string'
-                            testmessage = "Expected concept string, found '%s'." % pline
-                            warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                            testmessage = "Expected concept string, found '%s'." % lexer.rest()
+                            warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                     else:
                         testid = 'missing-slash'
-                        testmessage = "Expected slash and concept string, found '%s'." % pline
-                        warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                        testmessage = "Expected slash and concept string, found '%s'." % lexer.rest()
+                        warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                 else:
                     testid = 'missing-variable'
-                    testmessage = "Expected node variable id, found '%s'." % pline
+                    testmessage = "Expected node variable id, found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
                 expecting_node_definition = False
-            elif relation_re.match(pline):
+            elif token and token[0] == 'relation':
                 if expecting_node_definition:
                     testid = 'missing-node-definition'
-                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % pline
+                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                match = relation_re.match(pline)
-                relation = match.group(0)
+                relation = token[1]
                 # Save the outgoing relation at the parent node.
                 # The topmost node on the stack is the parent node for this relation.
                 # But beware that the stack may be empty if the relation occurred unexpectedly!
-                parent = {'relations': []}
+                parent = Node(None, iline, relations=[])
                 if stack:
                     parent_id = stack[-1]
                     parent = node_dict[parent_id]
-                    if not 'relations' in parent:
-                        parent['relations'] = []
                 # Some relations, like ':ARG0', should occur at most once per parent node,
                 # but others, like ':mod', can occur multiple times, so we assume that
                 # multiple same relations are allowed in general and we will rule out
                 # specific cases at level 3.
-                parent['relations'].append({'relation': relation, 'dir': 'out', 'line0': iline})
-                pline = remove_leading_whitespace(relation_re.sub('', pline, 1))
+                parent.relations.append(Relation(relation, 'out', iline))
+                lexer.advance(token)
                 # Besides a child node, there may be a numeric or string value.
+                # Integer numbers would be consumed as atoms. Numbers are here
+                # because of decimal numbers.
                 expecting_node_definition = False
-                if string_re.match(pline):
-                    match = string_re.match(pline)
-                    string = match.group(1) # without the quotation marks
-                    parent['relations'][-1]['type'] = 'string'
-                    parent['relations'][-1]['value'] = string
-                    pline = remove_leading_whitespace(string_re.sub('', pline, 1))
-                elif variable_re.match(pline):
-                    match = variable_re.match(pline)
-                    variable = match.group(0)
+                token = lexer.accept('string', 'variable', 'atom', 'number')
+                if not token:
+                    parent.relations[-1].type = 'node'
+                    expecting_node_definition = True
+                elif token[0] == 'variable':
+                    variable = sys.intern(token[1])
                     node_references.append({'variable': variable, 'line0': iline})
                     if args.check_forward_references and not variable in sentence[1]['nodes']:
                         if variable in node_dict:
                             testid = 'cross-sentence-reference'
-                            testmessage = "Sentence level graph cannot contain nodes from other sentences: '%s' was defined on line %d." % (variable, node_dict[variable]['line0'])
-                            warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                            testmessage = "Sentence level graph cannot contain nodes from other sentences: '%s' was defined on line %d." % (variable, node_dict[variable].line0)
+                            warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                         else:
                             testid = 'unknown-node-id'
                             testmessage = "The node id (variable) '%s' is unknown. No such node has been defined so far." % variable
-                            warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                    parent['relations'][-1]['type'] = 'node'
-                    parent['relations'][-1]['value'] = variable
-                    pline = remove_leading_whitespace(variable_re.sub('', pline, 1))
-                elif atom_re.match(pline):
-                    match = atom_re.match(pline)
-                    atom = match.group(1)
-                    parent['relations'][-1]['type'] = 'atom'
-                    parent['relations'][-1]['value'] = atom
-                    pline = remove_leading_whitespace(match.group(2)+atom_re.sub('', pline, 1))
-                # Integer numbers would be consumed as atoms. This is here because of decimal numbers.
-                elif number_re.match(pline):
-                    match = number_re.match(pline)
-                    number = match.group(1)
-                    parent['relations'][-1]['type'] = 'atom'
-                    parent['relations'][-1]['value'] = number
-                    pline = remove_leading_whitespace(match.group(2)+number_re.sub('', pline, 1))
+                            warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
+                    parent.relations[-1].set_value('node', variable)
                 else:
-                    parent['relations'][-1]['type'] = 'node'
-                    expecting_node_definition = True
-            elif pline.startswith(')'):
+                    # The string is without the quotation marks.
+                    parent.relations[-1].set_value('string' if token[0] == 'string' else 'atom', token[1])
+            elif token and token[0] == 'rparen':
                 if expecting_node_definition:
                     testid = 'missing-node-definition'
-                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % pline
+                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
                 # Check for the matching opening bracket and remove it from the stack.
                 if not stack:
                     testid = 'extra-closing-bracket'
-                    testmessage = "Found closing bracket but there was no matching opening bracket: '%s'." % pline
+                    testmessage = "Found closing bracket but there was no matching opening bracket: '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
                 else:
                     stack.pop()
-                pline = remove_leading_whitespace(pline[1:])
+                lexer.advance(token)
                 expecting_node_definition = False
             else:
                 if expecting_node_definition:
                     testid = 'missing-node-definition'
-                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % pline
+                    testmessage = "Expecting full node definition (opening bracket), found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
                 else:
                     testid = 'invalid-sentence-level'
-                    testmessage = "Expecting colon or closing bracket, found '%s'." % pline
+                    testmessage = "Expecting colon or closing bracket, found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = ''
+                break
     # If checking forward references is on, we know that all node references
     # either lead to defined nodes or have been reported as errors. But if it is
     # off, we must check for undefined nodes now.
@@ -741,31 +1258,25 @@ def validate_sentence_graph(sentence, node_dict, args):
             if not r['variable'] in sentence[1]['nodes']:
                 if r['variable'] in node_dict:
                     testid = 'cross-sentence-reference'
-                    testmessage = "Sentence level graph cannot contain nodes from other sentences: '%s' was defined on line %d." % (r['variable'], node_dict[r['variable']]['line0'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                    testmessage = "Sentence level graph cannot contain nodes from other sentences: '%s' was defined on line %d." % (r['variable'], node_dict[r['variable']].line0)
+                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=r['variable'])
                 else:
                     testid = 'unknown-node-id'
                     testmessage = "The node id (variable) '%s' is unknown. No such node is defined in this sentence." % r['variable']
-                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-    # Make sure that every node has the relation list, even if empty.
+                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=r['variable'])
+    # Make sure that every node has a concept, even if empty.
     for nid in sentence[1]['nodes']:
         node = node_dict[nid]
-        if not 'concept' in node:
-            node['concept'] = ''
-        if not 'relations' in node:
-            node['relations'] = []
-        # Make sure that every relation has the information we expect, even if empty.
-        for r in node['relations']:
-            if not 'value' in r:
-                r['value'] = ''
+        if node.concept is None:
+            node.concept = ''
     # So far we know for each node its outgoing relations.
     # Store also the incoming relations at each node.
-    for nid in sentence[1]['nodes']:
+    for nid in sorted(sentence[1]['nodes']):
         node = node_dict[nid]
-        outrel = [r for r in node['relations'] if r['dir'] == 'out' and r['type'] == 'node']
+        outrel = [r for r in node.relations if r.dir == 'out' and r.type == 'node']
         for r in outrel:
-            if r['value'] in node_dict:
-                node_dict[r['value']]['relations'].append({'dir': 'in', 'type': 'node', 'value': nid, 'relation': r['relation'], 'line0': r['line0']})
+            if r.value in node_dict:
+                node_dict[r.value].relations.append(Relation(r.relation, 'in', r.line0, 'node', nid))
 
 def validate_alignment(sentence, node_dict, args):
     """
@@ -775,11 +1286,10 @@ def validate_alignment(sentence, node_dict, args):
     """
     testlevel = 2
     testclass = 'Alignment'
-    global tokrng_re
-    global tokrngs_re
-    if not args.check_nonnegative_alignment:
-        tokrng_re = tokrng_neg_re
-        tokrngs_re = tokrngs_neg_re
+    if args.check_nonnegative_alignment:
+        range_re, ranges_re = tokrng_re, tokrngs_re
+    else:
+        range_re, ranges_re = tokrng_neg_re, tokrngs_neg_re
     # Does the comment confirm that we are processing the concept-token alignment?
     if args.check_block_headers:
         heading_found = False
@@ -793,6 +1303,9 @@ def validate_alignment(sentence, node_dict, args):
             testmessage = "Missing heading comment '# alignment:'."
             warn(testmessage, testclass, testlevel, testid, lineno=sentence[2]['line0'])
     iline = sentence[2]['line0'] + len(sentence[2]['comments']) - 1
+    tokens = sentence[0]['tokens']
+    # The alignments found in this block. Their tokstr is filled once all their segments are known.
+    new_alignments = []
     for l in sentence[2]['lines']:
         iline += 1
         pline = l # processed line: we will remove stuff from pline but not from l
@@ -802,12 +1315,12 @@ def validate_alignment(sentence, node_dict, args):
             if not variable in sentence[1]['nodes']:
                 testid = 'unknown-node-id'
                 testmessage = "The node id (variable) '%s' is unknown. No such node is defined in this sentence." % variable
-                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
             pline = remove_leading_whitespace(variable_re.sub('', pline, 1))
             if pline.startswith(':'):
                 pline = remove_leading_whitespace(pline[1:])
-                if tokrngs_re.match(pline):
-                    match = tokrngs_re.match(pline)
+                if ranges_re.match(pline):
+                    match = ranges_re.match(pline)
                     if match.group(3):
                         # The span is discontiguous and group(3) contains the tail.
                         spans = re.split(r",\s*", pline)
@@ -815,10 +1328,10 @@ def validate_alignment(sentence, node_dict, args):
                         spans = [pline]
                     t1 = -1
                     for s in spans:
-                        # If we previously matched tokrngs_re, we must now match tokrng_re.
-                        match = tokrng_re.match(s)
+                        # If we previously matched ranges_re, we must now match range_re.
+                        match = range_re.match(s)
                         if match.group(0) == '0-0' or match.group(0) == '-1--1':
-                            # The regular expression tokrngs_re excludes '0-0' combined with anything else,
+                            # The regular expression ranges_re excludes '0-0' combined with anything else,
                             # so we do not have to check it here.
                             t0 = 0
                             t1 = 0
@@ -829,85 +1342,107 @@ def validate_alignment(sentence, node_dict, args):
                             if t0 <= old_t1 + 1:
                                 testid = 'invalid-token-range'
                                 testmessage = "Index of the first token of segment '%s' must be at least %d because the previous segment ended at %d." % (s, old_t1+2, old_t1)
-                                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                             if t1 < t0:
                                 testid = 'invalid-token-range'
                                 testmessage = "Index of the first token '%d' is greater than the index of the second token '%d'." % (t0, t1)
-                                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                             tmax = len(sentence[0]['tokens'])
                             if t0 > tmax:
                                 testid = 'invalid-token-index'
                                 testmessage = "Index of the first token '%d' is out of range: there are %d tokens." % (t0, tmax)
-                                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                             if t1 > tmax:
                                 testid = 'invalid-token-index'
                                 testmessage = "Index of the second token '%d' is out of range: there are %d tokens." % (t1, tmax)
-                                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                         # The variable should be in node_dict. If it is not there,
                         # it has been already reported as error; but we must survive it here.
                         if variable in node_dict and t1 > t0:
                             # There must not be multiple lines aligning the same node.
                             # However, there may be multiple alignment segments on one alignment line of the node.
-                            if 'alignment' in node_dict[variable]:
-                                if node_dict[variable]['alignment']['line0'] != iline:
+                            alignment = node_dict[variable].alignment
+                            if alignment is not None:
+                                if alignment.line0 != iline:
                                     testid = 'duplicate-alignment'
-                                    testmessage = "Repeated alignment of node '%s'. It was already specified as %s on line %d." % (variable, str(node_dict[variable]['alignment']['tokids']), node_dict[variable]['alignment']['line0'])
-                                    warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                                    testmessage = "Repeated alignment of node '%s'. It was already specified as %s on line %d." % (variable, str(alignment.tokids), alignment.line0)
+                                    warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                                 else:
-                                    tokids = node_dict[variable]['alignment']['tokids']
-                                    tokids.extend(range(t0, t1+1))
-                                    tokens = [sentence[0]['tokens'][tokid-1] for tokid in tokids] if len(tokids) > 1 or tokids[0] != 0 else []
-                                    node_dict[variable]['alignment']['tokids'] = tokids
-                                    node_dict[variable]['alignment']['tokstr'] = ' '.join(tokens)
+                                    alignment.spans.append((t0, t1))
                             else:
-                                tokids = []
-                                tokids.extend(range(t0, t1+1))
-                                tokens = [sentence[0]['tokens'][tokid-1] for tokid in tokids] if len(tokids) > 1 or tokids[0] != 0 else []
-                                node_dict[variable]['alignment'] = {'tokids': tokids, 'tokstr': ' '.join(tokens), 'line0': iline}
+                                node_dict[variable].alignment = Alignment([(t0, t1)], '', iline)
+                                new_alignments.append(node_dict[variable].alignment)
                 else:
                     testid = 'invalid-token-range'
                     testmessage = "Expecting 1-based token index range, or multiple comma-separated ranges, or '0-0', found '%s'." % pline
-                    warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                    warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
             else:
                 testid = 'invalid-alignment'
                 testmessage = "Expecting colon, found '%s'." % pline
-                warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
         else:
             testid = 'missing-variable'
             testmessage = "Expected node variable id, found '%s'." % pline
             warn(testmessage, testclass, testlevel, testid, lineno=iline)
+    for alignment in new_alignments:
+        # Segments beyond the last token have been reported above.
+        alignment.tokstr = ' '.join([token for t0, t1 in alignment.spans if t0 > 0 for token in tokens[t0-1:t1]])
     # Check that all nodes in this sentence have an alignment.
     # Even unaligned nodes should have alignment 0-0.
-    tokal = [False for x in sentence[0]['tokens']]
+    # The coverage has one byte per token, set to 1 if a node is aligned to it,
+    # so that whole segments can be checked and marked at once.
+    coverage = bytearray(len(tokens))
+    noverlapping = 0
+    nunaligned_nodes = 0
+    nmissing = 0
     for n in sorted(sentence[1]['nodes']):
-        if not 'alignment' in node_dict[n]:
+        if node_dict[n].alignment is None:
             if args.check_complete_alignment:
                 testid = 'missing-alignment'
                 testmessage = "Missing alignment of node '%s'. Even unaligned nodes should be explicitly marked with '0-0'." % n
-                warn(testmessage, testclass, testlevel, testid, lineno=iline+1) # iline is now at the end of the alignment block
+                warn(testmessage, testclass, testlevel, testid, lineno=iline+1, node=n) # iline is now at the end of the alignment block
             # We will later want to access the alignment, so set the default, i.e., unaligned.
-            node_dict[n]['alignment'] = {'tokids': [0], 'tokstr': ''}
-        elif node_dict[n]['alignment']['tokids'] != [0]:
+            node_dict[n].alignment = Alignment([(0, 0)], '')
+            nmissing += 1
+        elif node_dict[n].alignment.spans == [(0, 0)]:
+            nunaligned_nodes += 1
+        else:
             # Check that two nodes are not aligned to the same surface token.
             # It is not clear that this should be required but it seems to be
             # typically the case, so we are tentatively going to report any
             # deviations.
-            for tokid in node_dict[n]['alignment']['tokids']:
-                if tokal[tokid-1]:
-                    if args.check_overlapping_alignment:
-                        testid = 'overlapping-alignment'
-                        testmessage = "Multiple nodes aligned to token '%s'." % tokid
-                        warn(testmessage, 'Warning', testlevel, testid, lineno=iline+1) # iline is now at the end of the alignment block
+            for t0, t1 in node_dict[n].alignment.spans:
+                t1 = min(t1, len(tokens))
+                if coverage.find(1, t0-1, t1) < 0:
+                    # None of the tokens is covered yet (the usual case).
+                    coverage[t0-1:t1] = b'\x01' * (t1-t0+1)
                 else:
-                    tokal[tokid-1] = True
+                    for tokid in range(t0, t1+1):
+                        if coverage[tokid-1]:
+                            noverlapping += 1
+                            if args.check_overlapping_alignment:
+                                testid = 'overlapping-alignment'
+                                testmessage = "Multiple nodes aligned to token '%s'." % tokid
+                                warn(testmessage, 'Warning', testlevel, testid, lineno=iline+1) # iline is now at the end of the alignment block
+                        else:
+                            coverage[tokid-1] = 1
     # Check that every non-punctuation token is aligned to a node. This is
     # not required but let's tentatively report it to see the deviations.
-    if args.check_unaligned_token:
-        for i in range(len(sentence[0]['tokens'])):
-            if not tokal[i] and not re.match(r"^[-.,;:\?\!\(\)]$", sentence[0]['tokens'][i]):
+    nunaligned = 0
+    i = coverage.find(0)
+    while i >= 0:
+        if not tokens[i] in punctuation_tokens:
+            nunaligned += 1
+            if args.check_unaligned_token:
                 testid = 'unaligned-token'
-                testmessage = "Non-punctuation token %d ('%s') is not aligned to any node in the sentence level graph." % (i+1, sentence[0]['tokens'][i])
+                testmessage = "Non-punctuation token %d ('%s') is not aligned to any node in the sentence level graph." % (i+1, tokens[i])
                 warn(testmessage, 'Warning', testlevel, testid, lineno=iline+1) # iline is now at the end of the alignment block
+        i = coverage.find(0, i+1)
+    if args.alignment_stats:
+        add_alignment_stats({'sentences': 1, 'tokens': len(tokens), 'aligned': len(tokens) - coverage.count(0),
+                             'punctuation': sum(1 for token in tokens if token in punctuation_tokens),
+                             'unaligned': nunaligned, 'overlapping': noverlapping, 'nodes': len(sentence[1]['nodes']),
+                             'unaligned_nodes': nunaligned_nodes, 'missing': nmissing})
 
 def validate_document_level(sentence, node_dict, args):
     """
@@ -915,7 +1450,9 @@ def validate_document_level(sentence, node_dict, args):
     Saves the document-level relations in the list sentence[3]['relations']. It
     means that if we later want to see all document-level relations in the
     document, we will have to collect them from the sentences; such collection
-    is not created now.
+    is not created now. The same relations are indexed by node and relation
+    group in sentence[3]['node_relations'] ({node: {group: [relations]}}), so
+    that the tests can look up the relations of a node without scanning them.
     """
     testlevel = 2
     testclass = 'Document'
@@ -938,13 +1475,15 @@ def validate_document_level(sentence, node_dict, args):
     current_first_node = ''
     current_line0 = iline
     sentence[3]['relations'] = []
+    sentence[3]['node_relations'] = {}
     for l in sentence[3]['lines']:
         iline += 1
-        pline = l # processed line: we will remove stuff from pline but not from l
-        while pline:
-            # Remove leading whitespace.
-            pline = remove_leading_whitespace(pline)
-            if pline.startswith('('):
+        lexer = GraphLexer(l)
+        while not lexer.at_end():
+            # Skip leading whitespace.
+            lexer.skip_whitespace()
+            token = lexer.peek('lparen', 'svariable', 'dvariable', 'relation', 'rparen')
+            if token and token[0] == 'lparen':
                 if expecting == 'initial opening bracket':
                     expecting = 'sentence variable id'
                 elif expecting == 'group opening bracket':
@@ -953,54 +1492,50 @@ def validate_document_level(sentence, node_dict, args):
                     expecting = 'the first node of a relation'
                 else:
                     testid = 'invalid-document-level'
-                    testmessage = "Expecting %s, found '%s'." % (expecting, pline)
+                    testmessage = "Expecting %s, found '%s'." % (expecting, lexer.rest())
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = remove_leading_whitespace(pline[1:])
-            elif svariable_re.match(pline):
-                match = svariable_re.match(pline)
-                variable = match.group(0)
+                lexer.advance(token)
+            elif token and token[0] == 'svariable':
+                variable = sys.intern(token[1])
                 if expecting != 'sentence variable id':
                     testid = 'invalid-document-level'
-                    testmessage = "Expecting %s, found '%s'." % (expecting, pline)
+                    testmessage = "Expecting %s, found '%s'." % (expecting, lexer.rest())
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                    pline = ''
                     break
-                pline = remove_leading_whitespace(svariable_re.sub('', pline, 1))
+                lexer.advance(token)
                 # The variable serves as node id. It must be unique.
                 if variable in node_dict:
                     testid = 'non-unique-node-id'
-                    testmessage = "The node id (variable) '%s' is not unique. It was previously used on line %d." % (variable, node_dict[variable]['line0'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=iline)
+                    testmessage = "The node id (variable) '%s' is not unique. It was previously used on line %d." % (variable, node_dict[variable].line0)
+                    warn(testmessage, testclass, testlevel, testid, lineno=iline, node=variable)
                 else:
-                    node_dict[variable] = {'line0': iline}
+                    node_dict[variable] = Node(variable, iline)
                 # Now expecting the slash ('/') and the concept 'sentence'.
-                if pline.startswith('/ sentence'):
-                    pline = remove_leading_whitespace(pline[10:])
-                else:
+                if not lexer.accept('sentence'):
                     testid = 'missing-sentence-concept'
-                    testmessage = "Expected '/ sentence', found '%s'." % pline
+                    testmessage = "Expected '/ sentence', found '%s'." % lexer.rest()
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
                 expecting = 'relation group or final closing bracket'
-            elif dvariable_re.match(pline):
-                match = dvariable_re.match(pline)
-                variable = match.group(1)
+            elif token and token[0] == 'dvariable':
+                variable = sys.intern(token[1])
                 if expecting == 'the first node of a relation':
                     current_first_node = variable
                     current_line0 = iline
                     expecting = 'relation'
                 elif expecting == 'the second node of the relation':
-                    sentence[3]['relations'].append({'group': current_relation_group, 'relation': current_relation, 'node0': current_first_node, 'node1': variable, 'line0': current_line0})
+                    relation = {'group': current_relation_group, 'relation': current_relation, 'node0': current_first_node, 'node1': variable, 'line0': current_line0}
+                    sentence[3]['relations'].append(relation)
+                    for n in set([current_first_node, variable]):
+                        sentence[3]['node_relations'].setdefault(n, {}).setdefault(current_relation_group, []).append(relation)
                     expecting = 'relation closing bracket'
                 else:
                     testid = 'invalid-document-level'
-                    testmessage = "Expecting %s, found '%s'." % (expecting, pline)
+                    testmessage = "Expecting %s, found '%s'." % (expecting, lexer.rest())
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                    pline = ''
                     break
-                pline = remove_leading_whitespace(match.group(2) + dvariable_re.sub('', pline, 1))
-            elif relation_re.match(pline):
-                match = relation_re.match(pline)
-                relation = match.group(0)
+                lexer.advance(token)
+            elif token and token[0] == 'relation':
+                relation = sys.intern(token[1])
                 if expecting == 'relation group' or expecting == 'relation group or final closing bracket':
                     current_relation_group = relation
                     expecting = 'group opening bracket'
@@ -1009,10 +1544,10 @@ def validate_document_level(sentence, node_dict, args):
                     expecting = 'the second node of the relation'
                 else:
                     testid = 'invalid-document-level'
-                    testmessage = "Expecting %s, found '%s'." % (expecting, pline)
+                    testmessage = "Expecting %s, found '%s'." % (expecting, lexer.rest())
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = remove_leading_whitespace(relation_re.sub('', pline, 1))
-            elif pline.startswith(')'):
+                lexer.advance(token)
+            elif token and token[0] == 'rparen':
                 if expecting == 'relation closing bracket':
                     expecting = 'relation opening bracket or group closing bracket'
                 elif expecting == 'relation opening bracket or group closing bracket':
@@ -1021,14 +1556,14 @@ def validate_document_level(sentence, node_dict, args):
                     expecting = 'end of document level annotation'
                 else:
                     testid = 'invalid-document-level'
-                    testmessage = "Expecting %s, found '%s'." % (expecting, pline)
+                    testmessage = "Expecting %s, found '%s'." % (expecting, lexer.rest())
                     warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = remove_leading_whitespace(pline[1:])
+                lexer.advance(token)
             else:
                 testid = 'invalid-document-level'
-                testmessage = "Not expecting this: '%s'." % pline
+                testmessage = "Not expecting this: '%s'." % lexer.rest()
                 warn(testmessage, testclass, testlevel, testid, lineno=iline)
-                pline = ''
+                break
 
 
 
@@ -1169,7 +1704,6 @@ discourse_concepts = [
     # These are reifications, thus rolesets, and have :ARGN children:
     'have-apprehensive-91', 'have-condition-91', 'have-pure-addition-91', 'have-substitution-91', 'have-concession-91', 'have-concessive-condition-91', 'have-subtraction-91'
 ]
-discourse_concept_re = re.compile(r"^(" + '|'.join(discourse_concepts) + r")$")
 
 # minus discourse_concepts
 abstract_concepts = {
@@ -1260,215 +1794,22 @@ abstract_concepts = {
                          'sub-roles': []}
 }
 
-ne_types = ['academic-organization',
- 'aircraft',
- 'aircraft-type',
- 'airport',
- 'amino-acid',
- 'animal',
- 'animal-nest',
- 'armed-organization',
- 'assembly',
- 'association',
- 'automobile',
- 'automobile-type',
- 'autonomous-region / nation?',
- 'avalanche',
- 'bay',
- 'behavior',
- 'biomedical-entity',
- 'body-of-literature',
- 'book',
- 'breed',
- 'bridge',
- 'broadcast-network',
- 'broadcast-program',
- 'building',
- 'business',
- 'canal',
- 'canyon',
- 'category',
- 'celestial-entity',
- 'cell',
- 'cell-line',
- 'ceremony',
- 'chemical-compound',
- 'chemical-element',
- 'city-square',
- 'clan',
- 'coastland',
- 'color',
- 'company',
- 'computer-program',
- 'conceptualization',
- 'constellation',
- 'continent',
- 'country',
- 'country-partition',
- 'country-region',
- 'court-decision',
- 'criminal-organization',
- 'cultural-activity',
- 'cultural-artifact',
- 'cultural-facility',
- 'culturally-protected-area',
- 'currency-system',
- 'cyber-entity',
- 'cyberattack',
- 'cyclone',
- 'dam',
- 'dance',
- 'degree',
- 'desert',
- 'diet',
- 'disease',
- 'dna-sequence',
- 'duststorm',
- 'earthquake',
- 'ecosystem',
- 'enzyme',
- 'ethnic-group',
- 'event',
- 'facility',
- 'family',
- 'festival',
- 'financial-entity',
- 'fire',
- 'flood',
- 'food-dish',
- 'forest',
- 'galaxy',
- 'game',
- 'gene',
- 'geo-political-entity',
- 'geographical-entity',
- 'glaciological-entity',
- 'government-organization',
- 'government-output',
- 'grassland',
- 'gulf',
- 'historical-period',
- 'honor',
- 'hotel',
- 'human-settlement',
- 'identification-number',
- 'incident',
- 'international-organization',
- 'island',
- 'journal',
- 'lake',
- 'land-entity',
- 'landslide',
- 'language',
- 'legislation',
- 'local-region',
- 'macro-molecular-complex',
- 'magazine',
- 'market',
- 'market-sector',
- 'measurement-system',
- 'medical-condition',
- 'medicinal-substance',
- 'mission',
- 'molecular-physical-entity',
- 'moon',
- 'mountain',
- 'mountain-range',
- 'movement',
- 'museum',
- 'music',
- 'music-key',
- 'musical-note',
- 'name',
- 'nationality',
- 'natural-disaster',
- 'natural-object',
- 'natural-reserve',
- 'news-media',
- 'notational-system',
- 'nucleic-acid',
- 'ocean',
- 'organization',
- 'palace',
- 'park',
- 'pass',
- 'pathogen',
- 'pathway',
- 'peninsula',
- 'performance',
- 'performing-group',
- 'person',
- 'place',
- 'planet',
- 'plant',
- 'policy',
- 'political-ideology',
- 'political-organization',
- 'port',
- 'principle',
- 'product',
- 'protected-area',
- 'protein',
- 'protein-family',
- 'protein-segment',
- 'publication',
- 'qualification',
- 'railway-line',
- 'region',
- 'regional-group',
- 'religion',
- 'religious-group',
- 'religious-organization',
- 'river',
- 'road',
- 'rock',
- 'room',
- 'sea',
- 'ship',
- 'ship-type',
- 'small-celestial-body',
- 'small-molecule',
- 'social-group',
- 'social-media',
- 'social-program',
- 'solar-system',
- 'spacecraft',
- 'spacecraft-type',
- 'spaceport',
- 'species',
- 'sports-facility',
- 'sports-organization',
- 'star',
- 'station',
- 'strait',
- 'system',
- 'tax',
- 'taxon',
- 'test',
- 'theater',
- 'therapy',
- 'thing',
- 'thoroughfare',
- 'treaty',
- 'tunnel',
- 'unit',
- 'utility-structure',
- 'valley',
- 'variable',
- 'vehicle',
- 'vehicle-type',
- 'volcanic-disaster',
- 'volcano',
- 'war',
- 'water-entity',
- 'weapon',
- 'weapon-type',
- 'website',
- 'wetland',
- 'work-of-art',
- 'world-region',
- 'worship-place',
- 'writing-script']
+# The named entity types are read from umr_tool_list/ne_types.csv, which is
+# compiled (together with the other inventories of the UMR tool) into a pickled
+# table by umr_lists.py. The table is loaded when it is needed for the first
+# time, so that the lower levels of validation do not read it at all.
+label_tables = None
+
+def get_label_tables():
+    """
+    Returns the compiled inventories of the UMR tool (see umr_lists.load_tables()),
+    loading them on first use.
+    """
+    global label_tables
+    if label_tables is None:
+        import umr_lists
+        label_tables = umr_lists.load_tables()
+    return label_tables
 
 # These reification rolesets (minus discourse_concepts) have :ARGN children
 # Abstract concepts for things that are neither events nor discourse connectives
@@ -1499,7 +1840,207 @@ non_event_rolesets = [
     'emit-sound-91', 'proverb-91', 'say-91'
 ] # todo: don't validating those
 
-non_event_roleset_re = re.compile(r"^(" + '|'.join(non_event_rolesets) + r")$")
+# Concepts that are not events even if they look like ones (see is_non_event_concept()).
+non_event_concepts = frozenset(discourse_concepts + non_event_rolesets)
+
+#------------------------------------------------------------------------------
+# Lemmatization of the tokens of a sentence. The lemmas are needed when checking
+# abstract concepts and named entities. Running spaCy is by far the most
+# expensive part of the level 3 tests, so the lemmas are cached in memory and
+# optionally on disk (--lemma-cache), and they are computed in batches.
+# The lemmatizer itself is not loaded until it is needed for the first time,
+# so that lower levels of validation, and scripts that only import the label
+# lists from this module, do not pay for loading spaCy.
+#------------------------------------------------------------------------------
+
+nlp = None # The lemmatizer selected by --lemmatizer; see get_nlp().
+
+def get_nlp():
+    """
+    Returns the lemmatizer, loading it on first use. The 'spacy' backend is the
+    full en_core_web_sm pipeline. The 'lookup' backend is a blank English
+    pipeline with spaCy's lookup-table lemmatizer, which loads much faster but
+    does not consider the context (it needs the spacy-lookups-data package).
+    """
+    global nlp
+    if nlp is None:
+        import spacy
+        if args.lemmatizer == 'lookup':
+            nlp = spacy.blank('en')
+            nlp.add_pipe('lemmatizer', config={'mode': 'lookup'})
+            nlp.initialize()
+        else:
+            nlp = spacy.load('en_core_web_sm')
+    return nlp
+
+lemma_cache = {} # key: tuple of tokens; value: list of lemmas
+lemma_cache_touched = set() # keys that should be written to the disk cache (new or used in this run)
+lemma_cache_db = None
+lemma_cache_pid = None # the process that opened lemma_cache_db; worker processes must open their own connection
+
+def lemma_model_id():
+    """
+    Identifies the lemmatizer, so that lemmas from different models are not
+    mixed in the disk cache. The id is built from the versions of the installed
+    packages, so that sentences found in the disk cache do not need spaCy to
+    be loaded at all.
+    """
+    packages = ['spacy', 'spacy-lookups-data' if args.lemmatizer == 'lookup' else 'en_core_web_sm']
+    versions = []
+    for package in packages:
+        try:
+            versions.append('%s-%s' % (package, importlib.metadata.version(package)))
+        except importlib.metadata.PackageNotFoundError:
+            versions.append(package)
+    return '%s:%s' % (args.lemmatizer, ':'.join(versions))
+
+def get_lemma_cache_db():
+    """
+    Returns the connection to the disk cache of lemmas (or None if the cache
+    is not used). The cache is an SQLite database, which can be shared by
+    multiple processes.
+    """
+    global lemma_cache_db, lemma_cache_pid
+    if not args.lemma_cache:
+        return None
+    if lemma_cache_db is None or lemma_cache_pid != os.getpid():
+        lemma_cache_db = sqlite3.connect(args.lemma_cache, timeout=60)
+        lemma_cache_db.execute('CREATE TABLE IF NOT EXISTS lemmas (model TEXT, tokens TEXT, lemmas TEXT, used REAL, PRIMARY KEY (model, tokens))')
+        lemma_cache_pid = os.getpid()
+    return lemma_cache_db
+
+def remember_lemmas(key, lemmas):
+    """
+    Stores lemmas in the in-memory cache. If the cache is full, the entries
+    that were stored first are forgotten.
+    """
+    if lemma_cache and len(lemma_cache) >= args.lemma_cache_size:
+        oldest = next(iter(lemma_cache))
+        del lemma_cache[oldest]
+        lemma_cache_touched.discard(oldest)
+    lemma_cache[key] = lemmas
+    lemma_cache_touched.add(key)
+
+def lemmatize(token_lists):
+    """
+    Takes a list of token lists (sentences). Makes sure that lemmas of all of
+    them are in the in-memory cache. Sentences that are not known from the disk
+    cache are lemmatized by spaCy in batches, with the components that do not
+    affect lemmas (parser, named entities) disabled.
+    """
+    if args.lemmatizer == 'none':
+        return
+    keys = [tuple(x) for x in token_lists if not tuple(x) in lemma_cache]
+    keys = list(dict.fromkeys(keys)) # unique, keep order
+    if not keys:
+        return
+    db = get_lemma_cache_db()
+    if db:
+        model = lemma_model_id()
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = [json.dumps(k) for k in keys[i:i+500]]
+            query = 'SELECT tokens, lemmas FROM lemmas WHERE model = ? AND tokens IN (%s)' % ','.join('?' * len(chunk))
+            for tokens, lemmas in db.execute(query, [model] + chunk):
+                found[tuple(json.loads(tokens))] = json.loads(lemmas)
+        for k in found:
+            remember_lemmas(k, found[k])
+        keys = [k for k in keys if not k in found]
+        if not keys:
+            return
+    texts = [' '.join(k) for k in keys]
+    for k, doc in zip(keys, get_nlp().pipe(texts, disable=['parser', 'ner'], batch_size=256)):
+        remember_lemmas(k, [token.lemma_ for token in doc])
+
+def get_lemmas(tokens):
+    """
+    Returns the list of lemmas for a list of tokens (one sentence). Without
+    a lemmatizer (--lemmatizer none), the list is empty.
+    """
+    if args.lemmatizer == 'none':
+        return []
+    key = tuple(tokens)
+    if not key in lemma_cache:
+        lemmatize([tokens])
+    lemma_cache_touched.add(key)
+    return lemma_cache[key]
+
+def save_lemma_cache():
+    """
+    Writes the lemmas that were computed or used in this run to the disk cache.
+    If the disk cache grows over --lemma-cache-size sentences, the entries that
+    have not been used for the longest time are evicted.
+    """
+    db = get_lemma_cache_db()
+    if not db or not lemma_cache_touched:
+        return
+    model = lemma_model_id()
+    now = time.time()
+    with db:
+        db.executemany('INSERT OR REPLACE INTO lemmas (model, tokens, lemmas, used) VALUES (?, ?, ?, ?)',
+                       [(model, json.dumps(k), json.dumps(lemma_cache[k]), now) for k in lemma_cache_touched if k in lemma_cache])
+        n = db.execute('SELECT COUNT(*) FROM lemmas').fetchone()[0]
+        if n > args.lemma_cache_size:
+            db.execute('DELETE FROM lemmas WHERE rowid IN (SELECT rowid FROM lemmas ORDER BY used LIMIT ?)', (n - args.lemma_cache_size,))
+    lemma_cache_touched.clear()
+
+def prefetch_lemmas(fname):
+    """
+    Reads the token lines of an input file in advance and lemmatizes all
+    sentences in batches, so that the per-sentence tests later find the lemmas
+    in the cache. The tokens are extracted the same way as in
+    validate_sentence_metadata() but without any error reporting; if they are
+    extracted differently for a malformed sentence, that sentence will be
+    lemmatized separately when it is tested. Invalid UTF-8 is replaced here
+    and reported by sentences() at the line where it occurs.
+    """
+    token_lists = []
+    with io.open(fname, 'r', encoding='utf-8', errors='replace') as inp:
+        for line in inp:
+            line = remove_leading_whitespace(remove_trailing_whitespace(line))
+            if args.inline_comments:
+                line = remove_inline_comment(line)
+            match = sentid_tokens_re.match(line)
+            if match:
+                if args.check_wide_space:
+                    token_lists.append(match.group(2).split(' '))
+                else:
+                    token_lists.append(re.split(r"\s+", match.group(2)))
+                continue
+            match = ilg_re.match(line)
+            if match:
+                if match.group(1) == 'Words':
+                    token_lists.append(re.split(r"\s+", match.group(2)))
+                continue
+            match = ilg_old_re.match(line)
+            if match and (match.group(1) == 'Words' or match.group(1) == 'tx'):
+                token_lists.append(re.split(r"\s+", match.group(2)))
+    lemmatize(token_lists)
+
+# A concept is accepted by validate_abstract_concept_NEs() if it is a substring
+# of a known label (abstract concept, NE type, discourse concept, non-event
+# roleset or attribute value). Instead of scanning the whole inventory for
+# every concept, all substrings of the labels are collected once in a set, so
+# that the test is a single lookup.
+known_concept_substrings = None
+
+def get_known_concept_substrings():
+    """
+    Returns the set of all substrings of the known concept labels, building it
+    on first use.
+    """
+    global known_concept_substrings
+    if known_concept_substrings is None:
+        labels = set(abstract_concepts.keys()) | get_label_tables()['ne_types'] | set(discourse_concepts) | set(non_event_rolesets)
+        labels |= set(value for entry in known_relations.values() for value in entry.get('value', []))
+        substrings = set()
+        for label in labels:
+            for i in range(len(label) + 1):
+                for j in range(i, len(label) + 1):
+                    substrings.add(label[i:j])
+        known_concept_substrings = frozenset(substrings)
+    return known_concept_substrings
+
 
 def validate_abstract_concept_NEs(sentence, node_dict, args):
     """
@@ -1507,27 +2048,118 @@ def validate_abstract_concept_NEs(sentence, node_dict, args):
     """
     testlevel = 3
     testclass = 'Sentence'
-    current_nodes = list(sentence[1]['nodes'])
-    concepts = [node_dict[n].get("concept") for n in current_nodes if "concept" in node_dict[n]]
-    filtered_concepts = [
-        concept for concept in concepts
-        if not re.search(r'-\d+$', concept) or re.search(r'-91$|-92$', concept)
+    nodes = [node for node in sentence_index(sentence, node_dict).nodes if node.concept is not None]
+    filtered_nodes = [
+        node for node in nodes
+        if not re.search(r'-\d+$', node.concept) or re.search(r'-91$|-92$', node.concept)
     ] # remove verb predicates
     tokens = sentence[0]['tokens']
-    token_lemmas = [token.lemma_ for token in nlp(" ".join(tokens))]
-    attribute_value_items = [
-        value for entry in known_relations.values()
-        for value in entry.get('value', [])
-    ]
-
-    possible_cocepts = list(abstract_concepts.keys()) + ne_types + discourse_concepts + non_event_rolesets + attribute_value_items
-    for item in filtered_concepts:
-        is_present = any(item in s for s in tokens + token_lemmas + possible_cocepts)
+    token_lemmas = get_lemmas(tokens)
+    known_substrings = get_known_concept_substrings()
+    # Tokens and lemmas never contain the separator, so a concept occurs in the
+    # joined string iff it is a substring of one of the words.
+    words = '\x00'.join(tokens + token_lemmas)
+    for node in filtered_nodes:
+        item = node.concept
+        is_present = item in known_substrings or item in words
         if not is_present:
             testid = 'unknown-abstract-concept-ne'
             testmessage = "Unknown abstract concept or NE: '%s'." % item
-            warn(testmessage, testclass, testlevel, testid, lineno=sentence[1]['line0'])
+            warn(testmessage, testclass, testlevel, testid, lineno=sentence[1]['line0'], node=node.variable)
+
+#------------------------------------------------------------------------------
+# Index of a sentence for the level 3 tests. The tests look at the nodes of
+# the sentence in the order of their lines, at their relations by label, and
+# at the relations as seen from the node (with inverted relations turned
+# around). All that is collected in one pass when the first level 3 test of
+# the sentence needs it. By then the level 2 tests have built the nodes and
+# relations of the sentence, and the level 3 tests do not change them.
+#------------------------------------------------------------------------------
+
+# Outgoing relations that make a node an event, and their inverted (incoming)
+# counterparts; see detect_events().
+event_relations = set([':ARG%d' % i for i in range(7)] + [':aspect', ':modstr'])
+inverted_event_relations = set([':ARG%d-of' % i for i in range(7)])
+
+@lru_cache(maxsize=None)
+def uninvert_relation(relation):
+    """
+    Returns the relation without the suffix '-of' that marks an inverted
+    relation (':ARG0-of' becomes ':ARG0'). There are few distinct relation
+    labels, so the results are memoized.
+    """
+    if relation.endswith('-of'):
+        return relation[:-3]
+    return relation
 
+@lru_cache(maxsize=None)
+def op_number(relation):
+    """
+    Returns N if the relation is ':opN', otherwise None.
+    """
+    match = op_re.match(relation)
+    if match:
+        return int(match.group(1))
+    return None
+
+def is_non_event_concept(concept):
+    """
+    Tells whether the concept is a discourse connective or a roleset such as
+    publication-91, which are not events even if they look like ones.
+    """
+    return concept in non_event_concepts
+
+class SentenceIndex:
+    """
+    The nodes and relations of one sentence as the level 3 tests need them:
+    nodes ....... the nodes of the sentence sorted by line (and variable)
+    relations ... node variable: all its relations sorted by line
+    outgoing .... node variable: its outgoing relations sorted by line
+    labels ...... node variable: {label: its outgoing relations with the label}
+    roles ....... node variable: {label: relations} where outgoing ':ARG0' and
+                  incoming ':ARG0-of' both count as ':ARG0' of the node
+    wiki ........ pairs (node, relation) of the ':wiki' relations, in order
+    Use sentence_index() to get it. The document-level relations of the nodes
+    are in sentence[3]['node_relations'] (see validate_document_level()).
+    """
+    __slots__ = ('nodes', 'relations', 'outgoing', 'labels', 'roles', 'wiki')
+
+    def __init__(self, sentence, node_dict):
+        self.nodes = tuple(sorted([node_dict[nid] for nid in sentence[1]['nodes']], key=lambda x: (x.line0, x.variable)))
+        self.relations = {}
+        self.outgoing = {}
+        self.labels = {}
+        self.roles = {}
+        self.wiki = []
+        for node in self.nodes:
+            relations = tuple(sorted(node.relations, key=lambda x: x.line0)) if node.relations is not None else ()
+            outgoing = tuple(r for r in relations if r.dir == 'out')
+            labels = {}
+            roles = {}
+            for r in relations:
+                uninvert = uninvert_relation(r.relation)
+                if r.dir == 'out':
+                    labels.setdefault(r.relation, []).append(r)
+                    if uninvert == r.relation:
+                        roles.setdefault(uninvert, []).append(r)
+                elif uninvert != r.relation:
+                    roles.setdefault(uninvert, []).append(r)
+                if r.relation == ':wiki':
+                    self.wiki.append((node, r))
+            self.relations[node.variable] = relations
+            self.outgoing[node.variable] = outgoing
+            self.labels[node.variable] = labels
+            self.roles[node.variable] = roles
+
+def sentence_index(sentence, node_dict):
+    """
+    Returns the SentenceIndex of the sentence, building it when it is needed
+    for the first time.
+    """
+    index = sentence[1].get('index')
+    if index is None:
+        index = sentence[1]['index'] = SentenceIndex(sentence, node_dict)
+    return index
 
 def validate_relations(sentence, node_dict, args):
     """
@@ -1538,76 +2170,57 @@ def validate_relations(sentence, node_dict, args):
     # print(json.dumps(node_dict, indent=4))
     testlevel = 3
     testclass = 'Sentence'
-    # Sort the nodes by their first line so that the validation report is stable and can be diffed.
-    nodes = sorted([node_dict[nid] for nid in sentence[1]['nodes']], key=lambda x: x['line0'])
-    for node in nodes:
-        nid = node['variable']
-        if 'relations' in node:
-            relations = sorted([r for r in node['relations'] if r['dir'] == 'out'], key=lambda x: x['line0'])
-            for r in relations:
+    # The nodes are sorted by their first line so that the validation report is stable and can be diffed.
+    index = sentence_index(sentence, node_dict)
+    for node in index.nodes:
+        nid = node.variable
+        if node.relations is not None:
+            for r in index.outgoing[nid]:
                 ###!!! For now assume that every relation can be inverted using the '-of' suffix.
                 ###!!! Later this should be banned at least for pure attributes.
-                relation = re.sub(r"-of$", '', r['relation'])
+                relation = uninvert_relation(r.relation)
                 # Make sure that ':opN' is known for any N.
-                if not relation in known_relations and op_re.match(relation):
+                if not relation in known_relations and op_number(relation):
                     known_relations[relation] = known_relations[':op1']
                 if not relation in known_relations:
                     testid = 'unknown-relation'
-                    testmessage = "Unknown relation '%s'." % r['relation']
-                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                    testmessage = "Unknown relation '%s'." % r.relation
+                    warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=nid)
                 else:
                     type = known_relations[relation]['type']
                     values = known_relations[relation]['values'] if 'values' in known_relations[relation] else []
                     # Non-attributes should have child nodes rather than scalar values, but there are exceptions.
                     # :ARG2 of have-polarity-91 has values '+' and '-'.
-                    if r['relation'] == ':ARG2' and node['concept'] == 'have-polarity-91':
+                    if r.relation == ':ARG2' and node.concept == 'have-polarity-91':
                         type = 'attribute'
                         values = ['+', '-']
                     if type != 'attribute':
-                        if r['type'] != 'node':
+                        if r.type != 'node':
                             testid = 'unexpected-value'
-                            testmessage = "Expected child node because '%s' is relation, not attribute; found %s with value '%s'." % (r['relation'], r['type'], r['value'])
-                            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                            testmessage = "Expected child node because '%s' is relation, not attribute; found %s with value '%s'." % (r.relation, r.type, r.value)
+                            warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=nid)
                     else: # type == attribute
-                        if values and not r['value'] in values:
+                        if values and not r.value in values:
                             testid = 'unexpected-value'
-                            testmessage = "Unexpected value '%s' of attribute '%s'." % (r['value'], r['relation'])
-                            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                            testmessage = "Unexpected value '%s' of attribute '%s'." % (r.value, r.relation)
+                            warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=nid)
             # Check repeated same-name relations. Include incoming inverted relations.
-            relations = sorted(node['relations'], key=lambda x: x['line0'])
-            relcount = {}
-            relfirst = {}
-            rellast = {}
-            for r in relations:
-                uninvert = re.sub(r"-of$", '', r['relation'])
-                if r['dir'] == 'out' and uninvert == r['relation'] or r['dir'] == 'in' and uninvert != r['relation']:
-                    if uninvert in relfirst:
-                        relcount[uninvert] += 1
-                        rellast[uninvert] = r['line0']
-                    else:
-                        relfirst[uninvert] = r['line0']
-                        relcount[uninvert] = 1
-                        rellast[uninvert] = r['line0']
-            # Now relations will hold just the names, not the full records.
-            relations = sorted(list(relcount), key=lambda x: rellast[x])
-            for r in relations:
-                if relcount[r] > 1 and r in known_relations and not known_relations[r]['repeat']:
+            roles = index.roles[nid]
+            for r in sorted(roles, key=lambda x: roles[x][-1].line0):
+                if len(roles[r]) > 1 and r in known_relations and not known_relations[r]['repeat']:
                     testid = 'repeated-relation'
-                    testmessage = "Node '%s' is not supposed to have more than one relation '%s' but it has %d: first on line %d." % (nid, r, relcount[r], relfirst[r])
-                    warn(testmessage, testclass, testlevel, testid, lineno=rellast[r])
+                    testmessage = "Node '%s' is not supposed to have more than one relation '%s' but it has %d: first on line %d." % (nid, r, len(roles[r]), roles[r][0].line0)
+                    warn(testmessage, testclass, testlevel, testid, lineno=roles[r][-1].line0, node=nid)
             # For :op1, :op2 etc., check that higher numbers occur only if lower numbers do.
-            relations = [r for r in node['relations'] if r['dir'] == 'out' and op_re.match(r['relation'])]
+            relations = [r for r in index.outgoing[nid] if op_number(r.relation)]
             if relations:
-                for r in relations:
-                    match = op_re.match(r['relation'])
-                    r['opnumber'] = int(match.group(1))
-                relations = sorted(relations, key=lambda x: x['opnumber'])
+                relations = sorted(relations, key=lambda x: op_number(x.relation))
                 for i in range(len(relations)):
-                    opnumber = relations[i]['opnumber']
+                    opnumber = op_number(relations[i].relation)
                     if opnumber > i + 1:
                         testid = 'skipped-op-relation'
                         testmessage = "Missing relation ':op%d' while there is relation ':op%d'." % (opnumber-1, opnumber)
-                        warn(testmessage, testclass, testlevel, testid, lineno=relations[i]['line0'])
+                        warn(testmessage, testclass, testlevel, testid, lineno=relations[i].line0, node=nid)
                         break
 
 def validate_name(sentence, node_dict, args):
@@ -1616,50 +2229,49 @@ def validate_name(sentence, node_dict, args):
     """
     testlevel = 3
     testclass = 'Sentence'
-    # Sort the nodes by their first line so that the validation report is stable and can be diffed.
-    nodes = sorted([node_dict[nid] for nid in sentence[1]['nodes']], key=lambda x: x['line0'])
-    for node in nodes:
-        if node['concept'] == 'name':
-            relations = sorted(node['relations'], key=lambda x: x['line0'])
+    # The nodes are sorted by their first line so that the validation report is stable and can be diffed.
+    index = sentence_index(sentence, node_dict)
+    for node in index.nodes:
+        if node.concept == 'name':
             in_name_found = False
             out_op1_found = False
-            for r in relations:
-                if r['dir'] == 'in':
-                    if r['relation'] == ':name':
+            for r in index.relations[node.variable]:
+                if r.dir == 'in':
+                    if r.relation == ':name':
                         in_name_found = True
                     else:
                         testid = 'wrong-incoming-name'
-                        testmessage = "Incoming relation to a 'name' concept should not be '%s'." % r['relation']
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                        testmessage = "Incoming relation to a 'name' concept should not be '%s'." % r.relation
+                        warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=node.variable)
                 else:
-                    if op_re.match(r['relation']):
-                        if r['relation'] == ':op1':
+                    if op_number(r.relation):
+                        if r.relation == ':op1':
                             out_op1_found = True
                         # In general ':opN' can be relation (leading to a child node) or attribute (with string or numeric value).
                         # However, ':opN' of a 'name' concept should always be strings.
-                        if r['type'] != 'string':
+                        if r.type != 'string':
                             testid = 'unexpected-value'
-                            testmessage = "Expected string attribute of '%s', found '%s'." % (r['relation'], r['type'])
-                            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                            testmessage = "Expected string attribute of '%s', found '%s'." % (r.relation, r.type)
+                            warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=node.variable)
                     else:
                         testid = 'wrong-outgoing-name'
-                        testmessage = "Outgoing relation from a 'name' concept should not be '%s'." % r['relation']
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+                        testmessage = "Outgoing relation from a 'name' concept should not be '%s'." % r.relation
+                        warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=node.variable)
             if not in_name_found:
                 testid = 'missing-incoming-name'
-                testmessage = "Missing incoming ':name' relation to the 'name' concept %s." % (node['variable'])
-                warn(testmessage, testclass, testlevel, testid, lineno=node['line0'])
+                testmessage = "Missing incoming ':name' relation to the 'name' concept %s." % (node.variable)
+                warn(testmessage, testclass, testlevel, testid, lineno=node.line0, node=node.variable)
             if not out_op1_found:
                 testid = 'missing-outgoing-name'
-                testmessage = "Missing outgoing ':op1' relation from the 'name' concept %s." % (node['variable'])
-                warn(testmessage, testclass, testlevel, testid, lineno=node['line0'])
+                testmessage = "Missing outgoing ':op1' relation from the 'name' concept %s." % (node.variable)
+                warn(testmessage, testclass, testlevel, testid, lineno=node.line0, node=node.variable)
             # The name node is usually unaligned (either 0-0 or -1--1).
             # The alignment goes to its parent node instead.
             ###!!! However, there are exceptions, so we cannot require this.
-            #if 'alignment' in node and node['alignment']['tokids'] != [0]:
+            #if node.alignment is not None and node.alignment.tokids != [0]:
             #    testid = 'invalid-name-alignment'
-            #    testmessage = "Name nodes should stay unaligned (unlike their parents), but %s is aligned to %s (%s)." % (node['variable'], str(node['alignment']['tokids']), node['alignment']['tokstr'])
-            #    warn(testmessage, testclass, testlevel, testid, lineno=node['alignment']['line0'])
+            #    testmessage = "Name nodes should stay unaligned (unlike their parents), but %s is aligned to %s (%s)." % (node.variable, str(node.alignment.tokids), node.alignment.tokstr)
+            #    warn(testmessage, testclass, testlevel, testid, lineno=node.alignment.line0)
 
 def validate_wiki(sentence, node_dict, args):
     """
@@ -1667,23 +2279,19 @@ def validate_wiki(sentence, node_dict, args):
     """
     testlevel = 3
     testclass = 'Sentence'
-    # Sort the nodes by their first line so that the validation report is stable and can be diffed.
-    nodes = sorted([node_dict[nid] for nid in sentence[1]['nodes']], key=lambda x: x['line0'])
-    for node in nodes:
-        relations = sorted(node['relations'], key=lambda x: x['line0'])
-        for r in relations:
-            if r['relation'] == ':wiki':
-                if args.check_string_wiki and r['type'] != 'string':
-                    testid = 'unexpected-value'
-                    testmessage = "Expected string attribute of '%s', found '%s'." % (r['relation'], r['type'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-                else:
-                    # At ÚFAL we require the :wiki value to be a Wikidata identifier (from URL after stripping https://wikidata.org/wiki/).
-                    # The US UMR team allow article title from English Wikipedia instead, so this test is not universally applicable.
-                    if args.check_non_q_wiki and not re.match(r"^Q[1-9][0-9]*$", r['value']):
-                        testid = 'unexpected-value'
-                        testmessage = "Expected Wikidata id (Q+number), found '%s'." % (r['value'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+    # The relations are in the order of the lines of their nodes so that the validation report is stable and can be diffed.
+    for node, r in sentence_index(sentence, node_dict).wiki:
+        if args.check_string_wiki and r.type != 'string':
+            testid = 'unexpected-value'
+            testmessage = "Expected string attribute of '%s', found '%s'." % (r.relation, r.type)
+            warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=node.variable)
+        else:
+            # At ÚFAL we require the :wiki value to be a Wikidata identifier (from URL after stripping https://wikidata.org/wiki/).
+            # The US UMR team allow article title from English Wikipedia instead, so this test is not universally applicable.
+            if args.check_non_q_wiki and not re.match(r"^Q[1-9][0-9]*$", r.value):
+                testid = 'unexpected-value'
+                testmessage = "Expected Wikidata id (Q+number), found '%s'." % (r.value)
+                warn(testmessage, testclass, testlevel, testid, lineno=r.line0, node=node.variable)
 
 def detect_events(sentence, node_dict, args):
     """
@@ -1703,27 +2311,25 @@ def detect_events(sentence, node_dict, args):
     for nid in sorted(sentence[1]['nodes']):
         node = node_dict[nid]
         if args.print_relations:
-            print("Node %s, concept=%s, line=%d, tokens=%s %s" % (nid, node['concept'], node['line0'], str(node['alignment']['tokids']), node['alignment']['tokstr']))
-        # If it is a discourse connective, stop here.
-        if re.match(discourse_concept_re, node['concept']):
+            print("Node %s, concept=%s, line=%d, tokens=%s %s" % (nid, node.concept, node.line0, str(node.alignment.tokids), node.alignment.tokstr))
+        # If it is a discourse connective or document metadata such as
+        # publication-91, stop here.
+        if is_non_event_concept(node.concept):
             continue
-        # If it is document metadata such as publication-91, stop here.
-        if re.match(non_event_roleset_re, node['concept']):
-            continue
-        if not 'event_reason' in node and re.match(r"^.+-91$", node['concept']):
-            node['event_reason'] = "its concept is %s on line %d" % (node['concept'], node['line0'])
-        relations = node['relations']
+        if node.event_reason is None and len(node.concept) > 3 and node.concept.endswith('-91'):
+            node.event_reason = "its concept is %s on line %d" % (node.concept, node.line0)
+        relations = node.relations
         for r in relations:
             if args.print_relations:
-                print("  Relation %s %s, type=%s, value=%s, line=%d" % (r['dir'], r['relation'], r['type'], r['value'], r['line0']))
-            if not 'event_reason' in node:
-                if r['dir'] == 'out' and re.match(r"^:(ARG[0-6]|aspect|modstr)$", r['relation']):
-                    node['event_reason'] = "it has outgoing relation %s on line %d" % (r['relation'], r['line0'])
-                elif r['dir'] == 'in' and re.match(r"^:ARG[0-6]-of$", r['relation']):
-                    node['event_reason'] = "it has incoming relation %s on line %d" % (r['relation'], r['line0'])
+                print("  Relation %s %s, type=%s, value=%s, line=%d" % (r.dir, r.relation, r.type, r.value, r.line0))
+            if node.event_reason is None:
+                if r.dir == 'out' and r.relation in event_relations:
+                    node.event_reason = "it has outgoing relation %s on line %d" % (r.relation, r.line0)
+                elif r.dir == 'in' and r.relation in inverted_event_relations:
+                    node.event_reason = "it has incoming relation %s on line %d" % (r.relation, r.line0)
         if args.print_relations:
-            if 'event_reason' in node:
-                print("  This node is an event because %s." % node['event_reason'])
+            if node.event_reason is not None:
+                print("  This node is an event because %s." % node.event_reason)
             print('')
     # Check document-level annotation.
     testlevel = 3
@@ -1735,36 +2341,36 @@ def detect_events(sentence, node_dict, args):
             if r['relation'] == ':same-event':
                 if r['node0'] in node_dict:
                     node = node_dict[r['node0']]
-                    if 'entity_reason' in node:
-                        testmessage = "Node '%s' cannot participate in :same-event relation; it is an entity because %s." % (r['node0'], node['entity_reason'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-                    if not 'event_reason' in node:
-                        node['event_reason'] = "it participates in a :same-event relation on line %d" % (r['line0'])
+                    if node.entity_reason is not None:
+                        testmessage = "Node '%s' cannot participate in :same-event relation; it is an entity because %s." % (r['node0'], node.entity_reason)
+                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=node.variable)
+                    if node.event_reason is None:
+                        node.event_reason = "it participates in a :same-event relation on line %d" % (r['line0'])
                 if r['node1'] in node_dict:
                     node = node_dict[r['node1']]
-                    if 'entity_reason' in node:
-                        testmessage = "Node '%s' cannot participate in :same-event relation; it is an entity because %s." % (r['node0'], node['entity_reason'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-                    if not 'event_reason' in node:
-                        node['event_reason'] = "it participates in a :same-event relation on line %d" % (r['line0'])
+                    if node.entity_reason is not None:
+                        testmessage = "Node '%s' cannot participate in :same-event relation; it is an entity because %s." % (r['node0'], node.entity_reason)
+                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=node.variable)
+                    if node.event_reason is None:
+                        node.event_reason = "it participates in a :same-event relation on line %d" % (r['line0'])
             # Same entity coreference means that none of the nodes is event;
             # remember it so that we can later report errors if it is included
             # in event coreference.
             elif r['relation'] == ':same-entity':
                 if r['node0'] in node_dict:
                     node = node_dict[r['node0']]
-                    if 'event_reason' in node:
-                        testmessage = "Node '%s' cannot participate in :same-entity relation; it is an event because %s." % (r['node0'], node['event_reason'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-                    if not 'entity_reason' in node:
-                        node['entity_reason'] = "it participates in a :same-entity relation on line %d" % (r['line0'])
+                    if node.event_reason is not None:
+                        testmessage = "Node '%s' cannot participate in :same-entity relation; it is an event because %s." % (r['node0'], node.event_reason)
+                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=node.variable)
+                    if node.entity_reason is None:
+                        node.entity_reason = "it participates in a :same-entity relation on line %d" % (r['line0'])
                 if r['node1'] in node_dict:
                     node = node_dict[r['node1']]
-                    if 'event_reason' in node:
-                        testmessage = "Node '%s' cannot participate in :same-entity relation; it is an event because %s." % (r['node1'], node['event_reason'])
-                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
-                    if not 'entity_reason' in node:
-                        node['entity_reason'] = "it participates in a :same-entity relation on line %d" % (r['line0'])
+                    if node.event_reason is not None:
+                        testmessage = "Node '%s' cannot participate in :same-entity relation; it is an event because %s." % (r['node1'], node.event_reason)
+                        warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=node.variable)
+                    if node.entity_reason is None:
+                        node.entity_reason = "it participates in a :same-entity relation on line %d" % (r['line0'])
 
 def validate_events(sentence, node_dict, args):
     """
@@ -1773,49 +2379,47 @@ def validate_events(sentence, node_dict, args):
     """
     testlevel = 3
     testclass = 'Sentence'
-    # Sort the nodes by their first line so that the validation report is stable and can be diffed.
-    nodes = sorted([node_dict[nid] for nid in sentence[1]['nodes']], key=lambda x: x['line0'])
-    for node in nodes:
-        nid = node['variable']
+    # The nodes are sorted by their first line so that the validation report is stable and can be diffed.
+    index = sentence_index(sentence, node_dict)
+    for node in index.nodes:
+        nid = node.variable
+        labels = index.labels[nid]
         relations = {}
-        relations[':aspect'] = sorted([r for r in node['relations'] if r['dir'] == 'out' and r['relation'] == ':aspect'], key=lambda x: x['line0'])
-        relations[':modal-strength/predicate'] = sorted([r for r in node['relations'] if r['dir'] == 'out' and r['relation'] in [':modal-strength', ':modal-predicate']], key=lambda x: x['line0'])
-        if 'event_reason' in node:
+        relations[':aspect'] = labels.get(':aspect', [])
+        if ':modal-strength' in labels and ':modal-predicate' in labels:
+            relations[':modal-strength/predicate'] = [r for r in index.outgoing[nid] if r.relation in [':modal-strength', ':modal-predicate']]
+        else:
+            relations[':modal-strength/predicate'] = labels.get(':modal-strength', labels.get(':modal-predicate', []))
+        if node.event_reason is not None:
             # :ARG relations imply that it is an event but they are not required.
             # On the other hand, :aspect and :modal-strength seem to be required according to the guidelines.
             # :modal-strength can be replaced by :modal-predicate. Only one of them is expected (guidelines 4-3-1-2).
             for rtype in [':aspect', ':modal-strength/predicate']: #modal annotations are in document level
                 if len(relations[rtype]) < 1:
                     testid = 'missing-attribute'
-                    testmessage = "Missing attribute %s. Node %s is an event because %s." % (rtype, nid, node['event_reason'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=node['line0'])
+                    testmessage = "Missing attribute %s. Node %s is an event because %s." % (rtype, nid, node.event_reason)
+                    warn(testmessage, testclass, testlevel, testid, lineno=node.line0, node=nid)
                 # :modal-strength must be atom but :modal-predicate is a node.
-                elif relations[rtype][0]['relation'] == ':modal-strength' and relations[rtype][0]['type'] != 'atom':
+                elif relations[rtype][0].relation == ':modal-strength' and relations[rtype][0].type != 'atom':
                     testid = 'invalid-attribute'
-                    testmessage = "Expected atomic value of attribute %s, found type=%s, value=%s." % (':modal-strength', relations[rtype][0]['type'], relations[rtype][0]['value'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=relations[rtype][0]['line0'])
+                    testmessage = "Expected atomic value of attribute %s, found type=%s, value=%s." % (':modal-strength', relations[rtype][0].type, relations[rtype][0].value)
+                    warn(testmessage, testclass, testlevel, testid, lineno=relations[rtype][0].line0, node=nid)
             # Check also document level relations. Every event must have at least
             # :temporal against document-creation-time.
-            found = False
-            for r in sentence[3]['relations']:
-                if r['group'] == ':temporal':
-                    if r['node0'] == nid or r['node1'] == nid:
-                        found = True
-                        break
-            if not found:
-                event = "%s / %s" % (nid, node['concept'])
-                if node['alignment']['tokstr'] != '':
-                    event += " '%s'" % node['alignment']['tokstr']
+            if not ':temporal' in sentence[3]['node_relations'].get(nid, {}):
+                event = "%s / %s" % (nid, node.concept)
+                if node.alignment.tokstr != '':
+                    event += " '%s'" % node.alignment.tokstr
                 testid = 'missing-temporal'
                 testmessage = "Missing temporal relation (at least with document-creation-time) for event %s." % event
-                warn(testmessage, 'Document', testlevel, testid, lineno=sentence[3]['line0'])
+                warn(testmessage, 'Document', testlevel, testid, lineno=sentence[3]['line0'], node=nid)
         # On the other hand, some concepts look like events but they are not events and should not have :aspect and :modal-strength.
-        elif re.match(non_event_roleset_re, node['concept']) or re.match(discourse_concept_re, node['concept']):
+        elif is_non_event_concept(node.concept):
             for rtype in [':aspect', ':modal-strength/predicate']:
                 if len(relations[rtype]) > 0:
                     testid = 'unexpected-attribute'
-                    testmessage = "Attribute %s not expected because %s is not an event." % (relations[rtype][0]['relation'], node['concept'])
-                    warn(testmessage, testclass, testlevel, testid, lineno=relations[rtype][0]['line0'])
+                    testmessage = "Attribute %s not expected because %s is not an event." % (relations[rtype][0].relation, node.concept)
+                    warn(testmessage, testclass, testlevel, testid, lineno=relations[rtype][0].line0, node=nid)
 
 def validate_document_relations(sentence, node_dict, args):
     """
@@ -1850,15 +2454,15 @@ def validate_document_relations(sentence, node_dict, args):
         if not r['node0'] in node_dict and not r['node0'] in ['root', 'author', 'null-conceiver', 'document-creation-time', 'past-reference', 'present-reference', 'future-reference']:
             testid = 'unknown-node-id'
             testmessage = "The node id (variable) '%s' is unknown. No such node has been defined so far." % r['node0']
-            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=r['node0'])
             # Add the variable to node_dict so that we do not get KeyError later.
-            node_dict[r['node0']] = {'concept': 'UNKNOWN', 'relations': [], 'alignment': {'tokids': [], 'tokstr': ''}, 'line0': r['line0']}
+            node_dict[r['node0']] = Node(r['node0'], r['line0'], 'UNKNOWN', [], Alignment([], ''))
         if not r['node1'] in node_dict and not r['node1'] in ['root', 'author', 'null-conceiver', 'document-creation-time', 'past-reference', 'present-reference', 'future-reference']:
             testid = 'unknown-node-id'
             testmessage = "The node id (variable) '%s' is unknown. No such node has been defined so far." % r['node1']
-            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=r['node1'])
             # Add the variable to node_dict so that we do not get KeyError later.
-            node_dict[r['node1']] = {'concept': 'UNKNOWN', 'relations': [], 'alignment': {'tokids': [], 'tokstr': ''}, 'line0': r['line0']}
+            node_dict[r['node1']] = Node(r['node1'], r['line0'], 'UNKNOWN', [], Alignment([], ''))
         # At least one of the participants must be a concept node from the current
         # sentence. For example, it is not allowed to annotate coreference between
         # nodes s2p (from sentence 2) and s3p (from sentence 3) in the document-
@@ -1868,12 +2472,12 @@ def validate_document_relations(sentence, node_dict, args):
         # 's' and the sentence number) or the line where the node is defined
         # (and compare it with the first line of the current sentence).
         current_sentence_line = sentence[0]['line0']
-        node0_line = node_dict[r['node0']]['line0'] if r['node0'] in node_dict else -1
-        node1_line = node_dict[r['node1']]['line0'] if r['node1'] in node_dict else -1
+        node0_line = node_dict[r['node0']].line0 if r['node0'] in node_dict else -1
+        node1_line = node_dict[r['node1']].line0 if r['node1'] in node_dict else -1
         if node0_line < current_sentence_line and node1_line < current_sentence_line and not (r['node0'] == 'root' and r['node1'] == 'author'):
             testid = 'misplaced-document-relation'
             testmessage = "At least one of the nodes must be from the current sentence but neither '%s' nor '%s' is." % (r['node0'], r['node1'])
-            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'])
+            warn(testmessage, testclass, testlevel, testid, lineno=r['line0'], node=r['node0'] if variable_re.match(r['node0']) else r['node1'])
         # By convention, node0 of a document-level relation is from the same
         # sentence as node1 or from an earlier one. We could probably extend this
         # convention so that node0 is the one defined before node1 (line-wise).
@@ -1893,113 +2497,118 @@ def validate_document_relations(sentence, node_dict, args):
 def collect_coreference_clusters(document, node_dict, args):
     """
     Once all sentences of the document have been read, this function should be
-    called. It re-visits the document-level graphs of all sentences, traces
+    called. It re-visits the document-level relations of all sentences, traces
     the coreference relations and constructs clusters of nodes that refer to
     the same entity.
     """
-    # Collect coreference clusters.
+    # Collect coreference clusters. The cluster attributes of the nodes form
+    # a union-find forest (see find_coref_cluster_id()), so that merging two
+    # clusters does not require visiting their members.
+    members = [] # all clustered nodes in the order in which they were first mentioned
+    for r in document['relations']:
+        if r['group'] == ':coref' and r['relation'] in [':same-entity', ':same-event']:
+            n0 = r['node0']
+            n1 = r['node1']
+            for n in (n0, n1):
+                node = node_dict[n]
+                if node.cluster is None:
+                    node.cluster = n
+                    node.cluster_relations = []
+                    node.cluster_line0 = r['line0']
+                    members.append(n)
+                # Remember the relation so that we can later explain why the node is in the cluster.
+                node.cluster_relations.append(r)
+            # The cluster will be represented by the id of its first node (the one first mentioned).
+            # If the two nodes were in different clusters, the other cluster is attached to it.
+            cid = get_coref_cluster_id(n0, n1, node_dict)
+            node_dict[find_coref_cluster_id(n0, node_dict)].cluster = cid
+            node_dict[find_coref_cluster_id(n1, node_dict)].cluster = cid
     document['clusters'] = {}
-    for s in document['sentences']:
-        for r in s[3]['relations']:
-            if r['group'] == ':coref' and r['relation'] in [':same-entity', ':same-event']:
-                n0 = r['node0']
-                n1 = r['node1']
-                reason = "\n  Line %s: %s %s %s" % (r['line0'], debugnode(r['node0'], node_dict), r['relation'], debugnode(r['node1'], node_dict))
-                # The cluster will be represented by the id of its first node (the one first mentioned).
-                cid = get_coref_cluster_id(n0, n1, node_dict)
-                if not cid in document['clusters']:
-                    document['clusters'][cid] = set()
-                # If the node was already member of this cluster, do nothing.
-                # If it was in a cluster but the cluster id was different, move its members to the new cluster.
-                # If it was not in any cluster, add it to this one.
-                if 'cluster' in node_dict[n0]:
-                    if node_dict[n0]['cluster'] != cid:
-                        oldcid = node_dict[n0]['cluster']
-                        for cm in document['clusters'][oldcid]:
-                            document['clusters'][oldcid].remove(cm)
-                            document['clusters'][cid].add(cm)
-                            node_dict[cm]['cluster'] = cid
-                else:
-                    node_dict[n0]['cluster'] = cid
-                    document['clusters'][cid].add(n0)
-                if 'cluster' in node_dict[n1]:
-                    if node_dict[n1]['cluster'] != cid:
-                        oldcid = node_dict[n1]['cluster']
-                        for cm in document['clusters'][oldcid]:
-                            document['clusters'][oldcid].remove(cm)
-                            document['clusters'][cid].add(cm)
-                            node_dict[cm]['cluster'] = cid
-                else:
-                    node_dict[n1]['cluster'] = cid
-                    document['clusters'][cid].add(n1)
-                if not 'cluster_reason' in node_dict[n0]:
-                    node_dict[n0]['cluster_reason'] = reason
-                else:
-                    node_dict[n0]['cluster_reason'] += ' and' + reason
-                if not 'cluster_reason' in node_dict[n1]:
-                    node_dict[n1]['cluster_reason'] = reason
-                else:
-                    node_dict[n1]['cluster_reason'] += ' and' + reason
-                if not 'cluster_line0' in node_dict[n0]:
-                    node_dict[n0]['cluster_line0'] = r['line0']
-                if not 'cluster_line0' in node_dict[n1]:
-                    node_dict[n1]['cluster_line0'] = r['line0']
+    for cm in members:
+        cid = find_coref_cluster_id(cm, node_dict)
+        if not cid in document['clusters']:
+            document['clusters'][cid] = set()
+        document['clusters'][cid].add(cm)
     # Check that nodes in the same cluster do not have conflicting wiki links.
+    # The conflicts are collected first, so that the Wikidata labels for the
+    # messages (and for the report) can be fetched together.
+    mismatches = []
     for c in document['clusters']:
         cwiki = ''
         cwikinode = ''
         members = sorted(list(document['clusters'][c]))
         for cm in members:
             wiki = ''
-            wikidatalist = [x['value'] for x in node_dict[cm]['relations'] if x['relation'] == ':wiki']
+            wikidatalist = [x.value for x in node_dict[cm].relations if x.relation == ':wiki']
             if len(wikidatalist) > 0:
                 wiki = wikidatalist[0]
             if wiki != '':
                 if cwiki != '':
                     if wiki != cwiki:
-                        wikilabel = wiki
-                        label = get_wikidata_label(wiki)
-                        if label:
-                            wikilabel = wiki + ' (' + label + ')'
-                        cwikilabel = cwiki
-                        label = get_wikidata_label(cwiki)
-                        if label:
-                            cwikilabel = cwiki + ' (' + label + ')'
-                        testlevel = 3
-                        testclass = 'Document'
-                        testid = 'coref-wiki-mismatch'
-                        testmessage = "The node '%s' has wikidata link %s but it is coreferential with node '%s' whose wikidata is %s." % (cm, wikilabel, cwikinode, cwikilabel)
-                        warn(testmessage, testclass, testlevel, testid, lineno=node_dict[cm]['line0'])
+                        mismatches.append((cm, wiki, cwikinode, cwiki))
                 else:
                     cwiki = wiki
                     cwikinode = cm
+    wikis = [x for m in mismatches for x in (m[1], m[3])]
+    if args.print_clusters:
+        wikis += [r.value for c in document['clusters'] for cm in document['clusters'][c] for r in node_dict[cm].relations if r.relation == ':wiki']
+    prefetch_wikidata_labels(wikis)
+    for cm, wiki, cwikinode, cwiki in mismatches:
+        wikilabel = wiki
+        label = get_wikidata_label(wiki)
+        if label:
+            wikilabel = wiki + ' (' + label + ')'
+        cwikilabel = cwiki
+        label = get_wikidata_label(cwiki)
+        if label:
+            cwikilabel = cwiki + ' (' + label + ')'
+        testlevel = 3
+        testclass = 'Document'
+        testid = 'coref-wiki-mismatch'
+        testmessage = "The node '%s' has wikidata link %s but it is coreferential with node '%s' whose wikidata is %s." % (cm, wikilabel, cwikinode, cwikilabel)
+        warn(testmessage, testclass, testlevel, testid, lineno=node_dict[cm].line0, node=cm)
     if args.print_clusters:
         for c in document['clusters']:
             print("Coreference cluster '%s': " % c)
             members = sorted(list(document['clusters'][c]))
             for cm in members:
                 wiki = ''
-                wikidatalist = [x['value'] for x in node_dict[cm]['relations'] if x['relation'] == ':wiki']
+                wikidatalist = [x.value for x in node_dict[cm].relations if x.relation == ':wiki']
                 if len(wikidatalist) > 0:
                     wiki = wikidatalist[0]
                     label = get_wikidata_label(wiki)
                     if label:
                         wiki += ' (' + label + ')'
-                print("  %s (%s / %s) wiki '%s' line %d" % (cm, node_dict[cm]['alignment']['tokstr'], node_dict[cm]['concept'], wiki, node_dict[cm]['line0']))
+                print("  %s (%s / %s) wiki '%s' line %d" % (cm, node_dict[cm].alignment.tokstr, node_dict[cm].concept, wiki, node_dict[cm].line0))
+
+def find_coref_cluster_id(nid, node_dict):
+    """
+    Takes the id of a node that is member of a coreference cluster. Returns
+    the id of the cluster. The cluster attribute of each member points to
+    another member of the same cluster, and the member whose id is the cluster
+    id points to itself. On the way, the members are re-pointed directly to
+    the cluster id, so that the next search is faster.
+    """
+    cid = nid
+    while node_dict[cid].cluster != cid:
+        cid = node_dict[cid].cluster
+    while nid != cid:
+        node = node_dict[nid]
+        nid = node.cluster
+        node.cluster = cid
+    return cid
 
 def get_coref_cluster_id(n0, n1, node_dict):
     """
     Takes ids of two nodes from the same coreference cluster. Decides which of
     the two ids should serve as the id of the cluster.
     """
-    # If one of the nodes already is member of a cluster, replace it with its current cluster id.
-    if 'cluster' in node_dict[n0]:
-        n0 = node_dict[n0]['cluster']
-    if 'cluster' in node_dict[n1]:
-        n1 = node_dict[n1]['cluster']
+    # Replace the nodes with the ids of the clusters they are already in.
+    n0 = find_coref_cluster_id(n0, node_dict)
+    n1 = find_coref_cluster_id(n1, node_dict)
     # The node mentioned earlier (line-wise) wins.
-    l0 = node_dict[n0]['line0']
-    l1 = node_dict[n1]['line0']
+    l0 = node_dict[n0].line0
+    l1 = node_dict[n1].line0
     if l0 < l1:
         return n0
     if l1 < l0:
@@ -2011,130 +2620,146 @@ def get_coref_cluster_id(n0, n1, node_dict):
     else:
         return n1
 
+def coref_reason(nid, node_dict):
+    """
+    Explains why a node is in its coreference cluster: lists the coreference
+    relations in which it participates.
+    """
+    return ' and'.join(["\n  Line %s: %s %s %s" % (r['line0'], debugnode(r['node0'], node_dict), r['relation'], debugnode(r['node1'], node_dict)) for r in node_dict[nid].cluster_relations])
+
+def render_reason(reason):
+    """
+    The reason of an inferred temporal relation is stored as a pair (reason of
+    the relation from which it was inferred, reason of the older relation that
+    was combined with it); the pairs can be nested. This function joins the
+    reasons into a string when the reason is reported.
+    """
+    parts = []
+    stack = [reason]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, tuple):
+            stack.append(x[1])
+            stack.append(x[0])
+        else:
+            parts.append(x)
+    return ' and'.join(parts)
+
 def build_temporal_graph(document, node_dict, args):
     """
     Once all sentences of the document have been read and coreference clusters
     have been collected, this function should be called. It re-visits the
-    document-level graphs of all sentences, traces the temporal relations and
+    document-level relations of all sentences, traces the temporal relations and
     infers additional temporal relations where possible.
     """
-    # Add identity relations to the temporal graph for coreferential entities and events.
-    # (We need entities because of temporal expressions. Other entities will be added but not used.)
+    # The temporal graph knows the coreference clusters: coreferential entities
+    # and events are in :identity relation without storing an edge for each
+    # pair of them. (We need entities because of temporal expressions. Other
+    # entities will be in the graph but not used.)
     document['temporal'] = temporal = Temporal(document, node_dict);
-    for c in document['clusters']:
-        members = list(document['clusters'][c])
-        #print("\n", 'temporal.add_relation for cluster %s members: ' % c, members)
-        for cmi in members:
-            for cmj in members:
-                if cmj != cmi:
-                    temporal.add_relation(cmi, ':identity', cmj, node_dict[cmi]['cluster_line0'], node_dict[cmi]['cluster_reason'])
     # Collect and infer temporal relations.
-    for s in document['sentences']:
-        for r in s[3]['relations']:
-            if r['group'] == ':temporal':
-                # Save the current relation in the graph. Report error in case of conflict.
-                reason = "\n  Line %s: %s %s %s" % (r['line0'], debugnode(r['node0'], node_dict), r['relation'], debugnode(r['node1'], node_dict))
-                temporal.add_relation(r['node0'], r['relation'], r['node1'], r['line0'], reason)
-                # Save the opposite relation in the graph. Then look for transitively inferred relations.
-                if r['relation'] == ':before':
-                    temporal.add_relation(r['node1'], ':after', r['node0'], r['line0'], reason)
-                    # Identity and transitive :before between n0, n1, and their neighbors.
-                    # (n0 :before n1) and (n1 :before n) => (n0 :before n)
-                    # No need for recursion, as shortcuts to distant layers already exist in the graph.
-                    for n in temporal.nodes():
-                        if n == r['node0'] or n == r['node1']:
-                            continue
-                        if temporal.is_relation(n, r['node1'], [':after', ':identity']):
-                            # We already know that n1 is before n0. Now n is before n1 or they are coreferential.
-                            # Therefore, n is before n0.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node1'])
-                            temporal.add_relation(r['node0'], ':before', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':after', r['node0'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':before', ':identity']):
-                            # We already know that n0 is after n1. Now n is after n0 or they are coreferential.
-                            # Therefore, n is after n1.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            temporal.add_relation(r['node1'], ':after', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':before', r['node1'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':contains']):
-                            # We already know that n1 is before n0. Now n0 contains n, so n1 is also before n.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            temporal.add_relation(r['node1'], ':after', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':before', r['node1'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node1'], [':contains']):
-                            # We already know that n1 is before n0. Now n1 contains n, so n is also before n0.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node1'])
-                            temporal.add_relation(r['node0'], ':before', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':after', r['node0'], r['line0'], reason1)
-                elif r['relation'] == ':after':
-                    temporal.add_relation(r['node1'], ':before', r['node0'], r['line0'], reason)
-                    # Identity and transitive :after between n0, n1, and their neighbors.
-                    # (n0 :after n1) and (n1 :after n) => (n0 :after n)
-                    # No need for recursion, as shortcuts to distant layers already exist in the graph.
-                    for n in temporal.nodes():
-                        if n == r['node0'] or n == r['node1']:
-                            continue
-                        if temporal.is_relation(n, r['node1'], [':before', ':identity']):
-                            # We already know that n1 is after n0. Now n is after n1 or they are coreferential.
-                            # Therefore, n is after n0.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node1'])
-                            temporal.add_relation(r['node0'], ':after', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':before', r['node0'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':after', ':identity']):
-                            # We already know that n0 is before n1. Now n is before n0 or they are coreferential.
-                            # Therefore, n is before n1.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            temporal.add_relation(r['node1'], ':before', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':after', r['node1'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':contains']):
-                            # We already know that n1 is after n0. Now n0 contains n, so n1 is also after n.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            temporal.add_relation(r['node1'], ':before', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':after', r['node1'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node1'], [':contains']):
-                            # We already know that n1 is after n0. Now n1 contains n, so n is also after n0.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node1'])
-                            temporal.add_relation(r['node0'], ':after', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':before', r['node0'], r['line0'], reason1)
-                elif r['relation'] == ':contained':
-                    # The guidelines do not define any inverse relation to ':contained'
-                    # but we need it to block the slot and not allow other relations here
-                    # (and also to see the relation from both sides).
-                    temporal.add_relation(r['node1'], ':contains', r['node0'], r['line0'], reason)
-                    # Identity and transitive :contained between n0, n1, and their neighbors.
-                    # (n0 :contained n1) and (n1 :contained n) => (n0 :contained n)
-                    for n in temporal.nodes():
-                        if n == r['node0'] or n == r['node1']:
-                            continue
-                        if temporal.is_relation(n, r['node1'], [':contains', ':identity']):
-                            # We already know that n1 is contained in n0. Now n is contained in n1 or they are coreferential.
-                            # Therefore, n is contained in n0.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node1'])
-                            temporal.add_relation(r['node0'], ':contained', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':contains', r['node0'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':contained', ':identity']):
-                            # We already know that n0 contains n1. Now n contains n0 or they are coreferential.
-                            # Therefore, n contains n1.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            temporal.add_relation(r['node1'], ':contains', n, r['line0'], reason1)
-                            temporal.add_relation(n, ':contained', r['node1'], r['line0'], reason1)
-                        if temporal.is_relation(n, r['node0'], [':before', ':after']):
-                            # We already know that n0 contains n1. Now n0 is before/after n.
-                            # Therefore, n1 is also before/after n.
-                            reason1 = reason + ' and' + temporal.reason(n, r['node0'])
-                            relation_n_n1 = temporal.relation(n, r['node0'])
-                            relation_n1_n = ':before' if relation_n_n1 == ':after' else ':after'
-                            temporal.add_relation(n, relation_n_n1, r['node1'], r['line0'], reason1)
-                            temporal.add_relation(r['node1'], relation_n1_n, n, r['line0'], reason1)
-                elif r['relation'] == ':overlap':
-                    temporal.add_relation(r['node1'], ':overlap', r['node0'], r['line0'], reason)
-                # Markéta maintains that the guidelines require :depends-on in certain situations.
-                #elif r['relation'] == ':depends-on':
-                #    testlevel = 3
-                #    testclass = 'Document'
-                #    testid = 'temporal-depends-on'
-                #    testmessage = "The temporal relation ':depends-on' could probably be replaced by more specific ':before', ':after', ':contained' or ':overlap'."
-                #    warn(testmessage, testclass, testlevel, testid, r['line0'])
+    for r in document['relations']:
+        if r['group'] == ':temporal':
+            # Save the current relation in the graph. Report error in case of conflict.
+            reason = "\n  Line %s: %s %s %s" % (r['line0'], debugnode(r['node0'], node_dict), r['relation'], debugnode(r['node1'], node_dict))
+            temporal.add_relation(r['node0'], r['relation'], r['node1'], r['line0'], reason)
+            # Save the opposite relation in the graph. Then look for transitively inferred relations.
+            if r['relation'] == ':before':
+                temporal.add_relation(r['node1'], ':after', r['node0'], r['line0'], reason)
+                # Identity and transitive :before between n0, n1, and their neighbors.
+                # (n0 :before n1) and (n1 :before n) => (n0 :before n)
+                # No need for recursion, as shortcuts to distant layers already exist in the graph.
+                # Only nodes that have one of the relations tested below to n0 or n1 can be affected.
+                for n in temporal.related_nodes(r['node0'], [':before', ':identity', ':contains'], r['node1'], [':after', ':identity', ':contains']):
+                    if temporal.is_relation(n, r['node1'], [':after', ':identity']):
+                        # We already know that n1 is before n0. Now n is before n1 or they are coreferential.
+                        # Therefore, n is before n0.
+                        reason1 = (reason, temporal.reason(n, r['node1']))
+                        temporal.add_relation(r['node0'], ':before', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':after', r['node0'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':before', ':identity']):
+                        # We already know that n0 is after n1. Now n is after n0 or they are coreferential.
+                        # Therefore, n is after n1.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        temporal.add_relation(r['node1'], ':after', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':before', r['node1'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':contains']):
+                        # We already know that n1 is before n0. Now n0 contains n, so n1 is also before n.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        temporal.add_relation(r['node1'], ':after', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':before', r['node1'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node1'], [':contains']):
+                        # We already know that n1 is before n0. Now n1 contains n, so n is also before n0.
+                        reason1 = (reason, temporal.reason(n, r['node1']))
+                        temporal.add_relation(r['node0'], ':before', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':after', r['node0'], r['line0'], reason1)
+            elif r['relation'] == ':after':
+                temporal.add_relation(r['node1'], ':before', r['node0'], r['line0'], reason)
+                # Identity and transitive :after between n0, n1, and their neighbors.
+                # (n0 :after n1) and (n1 :after n) => (n0 :after n)
+                # No need for recursion, as shortcuts to distant layers already exist in the graph.
+                # Only nodes that have one of the relations tested below to n0 or n1 can be affected.
+                for n in temporal.related_nodes(r['node0'], [':after', ':identity', ':contains'], r['node1'], [':before', ':identity', ':contains']):
+                    if temporal.is_relation(n, r['node1'], [':before', ':identity']):
+                        # We already know that n1 is after n0. Now n is after n1 or they are coreferential.
+                        # Therefore, n is after n0.
+                        reason1 = (reason, temporal.reason(n, r['node1']))
+                        temporal.add_relation(r['node0'], ':after', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':before', r['node0'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':after', ':identity']):
+                        # We already know that n0 is before n1. Now n is before n0 or they are coreferential.
+                        # Therefore, n is before n1.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        temporal.add_relation(r['node1'], ':before', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':after', r['node1'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':contains']):
+                        # We already know that n1 is after n0. Now n0 contains n, so n1 is also after n.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        temporal.add_relation(r['node1'], ':before', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':after', r['node1'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node1'], [':contains']):
+                        # We already know that n1 is after n0. Now n1 contains n, so n is also after n0.
+                        reason1 = (reason, temporal.reason(n, r['node1']))
+                        temporal.add_relation(r['node0'], ':after', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':before', r['node0'], r['line0'], reason1)
+            elif r['relation'] == ':contained':
+                # The guidelines do not define any inverse relation to ':contained'
+                # but we need it to block the slot and not allow other relations here
+                # (and also to see the relation from both sides).
+                temporal.add_relation(r['node1'], ':contains', r['node0'], r['line0'], reason)
+                # Identity and transitive :contained between n0, n1, and their neighbors.
+                # (n0 :contained n1) and (n1 :contained n) => (n0 :contained n)
+                # Only nodes that have one of the relations tested below to n0 or n1 can be affected.
+                for n in temporal.related_nodes(r['node0'], [':contained', ':identity', ':before', ':after'], r['node1'], [':contains', ':identity']):
+                    if temporal.is_relation(n, r['node1'], [':contains', ':identity']):
+                        # We already know that n1 is contained in n0. Now n is contained in n1 or they are coreferential.
+                        # Therefore, n is contained in n0.
+                        reason1 = (reason, temporal.reason(n, r['node1']))
+                        temporal.add_relation(r['node0'], ':contained', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':contains', r['node0'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':contained', ':identity']):
+                        # We already know that n0 contains n1. Now n contains n0 or they are coreferential.
+                        # Therefore, n contains n1.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        temporal.add_relation(r['node1'], ':contains', n, r['line0'], reason1)
+                        temporal.add_relation(n, ':contained', r['node1'], r['line0'], reason1)
+                    if temporal.is_relation(n, r['node0'], [':before', ':after']):
+                        # We already know that n0 contains n1. Now n0 is before/after n.
+                        # Therefore, n1 is also before/after n.
+                        reason1 = (reason, temporal.reason(n, r['node0']))
+                        relation_n_n1 = temporal.relation(n, r['node0'])
+                        relation_n1_n = ':before' if relation_n_n1 == ':after' else ':after'
+                        temporal.add_relation(n, relation_n_n1, r['node1'], r['line0'], reason1)
+                        temporal.add_relation(r['node1'], relation_n1_n, n, r['line0'], reason1)
+            elif r['relation'] == ':overlap':
+                temporal.add_relation(r['node1'], ':overlap', r['node0'], r['line0'], reason)
+            # Markéta maintains that the guidelines require :depends-on in certain situations.
+            #elif r['relation'] == ':depends-on':
+            #    testlevel = 3
+            #    testclass = 'Document'
+            #    testid = 'temporal-depends-on'
+            #    testmessage = "The temporal relation ':depends-on' could probably be replaced by more specific ':before', ':after', ':contained' or ':overlap'."
+            #    warn(testmessage, testclass, testlevel, testid, r['line0'])
     # We are not interested in nodes that have only identity relations to other nodes.
     # They are probably neither time expressions nor events; they just got here from the coreference graph.
     temporal.remove_identity_only_nodes()
@@ -2144,61 +2769,133 @@ def build_temporal_graph(document, node_dict, args):
 
 #==============================================================================
 class Temporal:
+    """
+    The temporal graph of a document. The graph maps each node to its children
+    and each child to the pair (relation, reason). Besides that, the reverse
+    index maps each node to its parents grouped by relation, so that we do not
+    have to search the whole graph for the nodes that have a relation to a
+    given node.
+
+    Members of a coreference cluster are in :identity relation to each other.
+    These relations are not stored in the graph, which would need k*(k-1)
+    edges for a cluster of k nodes; instead, each member is mapped to the id
+    of its cluster (the representative) and the methods below answer as if
+    the edges were there. The reason of such a relation is the coreference
+    relations of the member (see coref_reason()), so the messages still name
+    the original nodes and lines.
+    """
     def __init__(self, document, node_dict):
         self.document = document
         self.node_dict = node_dict
         self.graph = {}
+        self.incoming = {}
+        self.clusters = document['clusters']
+        self.representative = {}
+        for cid, members in self.clusters.items():
+            if len(members) > 1:
+                for cm in members:
+                    self.representative[cm] = cid
+        self.coref_reasons = {}
+        # Set by remove_identity_only_nodes(). The removed members of clusters
+        # have no :identity relations to the other members then.
+        self.pruned = False
 
     def __str__(self):
-        result = ''
+        result = []
         for i in self.nodes():
-            result += "%s -->\n" % debugnode(i, self.node_dict)
+            result.append("%s -->\n" % debugnode(i, self.node_dict))
             childrelations = []
             for j in self.children(i):
                 childrelations.append("    %s --> %s\n" % (self.relation(i, j), debugnode(j, self.node_dict)))
             childrelations.sort()
-            result += ''.join(childrelations)
-        return result
+            result.extend(childrelations)
+        return ''.join(result)
 
     def nodes(self):
-        return sorted(list(self.graph))
+        if self.pruned:
+            return sorted(list(self.graph))
+        return sorted(set(self.graph) | set(self.representative))
 
     def children(self, node):
-        if node in self.graph:
-            return sorted(list(self.graph[node]))
-        else:
+        return sorted(list(self.graph.get(node, {})) + self.identical(node))
+
+    def is_identical(self, n0, n1):
+        """
+        Tells whether n0 has an :identity relation to n1 because they are
+        different members of the same coreference cluster.
+        """
+        cid = self.representative.get(n0)
+        return cid is not None and n0 != n1 and self.representative.get(n1) == cid and (not self.pruned or n0 in self.graph)
+
+    def identical(self, node):
+        """
+        Returns the list of the nodes to which the given node has an :identity
+        relation because they are in the same coreference cluster.
+        """
+        cid = self.representative.get(node)
+        if cid is None or (self.pruned and not node in self.graph):
+            return []
+        return [x for x in self.clusters[cid] if x != node]
+
+    def identical_parents(self, node):
+        """
+        Returns the list of the nodes that have an :identity relation to the
+        given node because they are in the same coreference cluster.
+        """
+        cid = self.representative.get(node)
+        if cid is None:
             return []
+        return [x for x in self.clusters[cid] if x != node and (not self.pruned or x in self.graph)]
+
+    def coref_reason(self, node):
+        if not node in self.coref_reasons:
+            self.coref_reasons[node] = coref_reason(node, self.node_dict)
+        return self.coref_reasons[node]
 
     def add_relation(self, n0, r, n1, line0, reason):
         """
         Adds a temporal relation to the graph. Reports an error if there already
         is a conflicting relation between the same nodes.
         """
-        if n0 in self.graph and n1 in self.graph[n0]:
+        if self.is_identical(n0, n1):
+            # Coreferential nodes cannot have any other temporal relation.
+            if r != ':identity':
+                testlevel = 3
+                testclass = 'Document'
+                testid = 'temporal-mismatch'
+                testmessage = "Older temporal relation '%s %s %s' collides with newly inferred '%s'. Reason for older: %s" % (n0, ':identity', n1, r, self.coref_reason(n0))
+                warn(testmessage, testclass, testlevel, testid, line0, node=n0 if variable_re.match(n0) else n1)
+        elif n0 in self.graph and n1 in self.graph[n0]:
             # If the relation matches, do nothing. Keep the previous line0 of the temporal relation.
-            if self.graph[n0][n1]['relation'] != r:
+            if self.graph[n0][n1][0] != r:
                 testlevel = 3
                 testclass = 'Document'
                 testid = 'temporal-mismatch'
-                testmessage = "Older temporal relation '%s %s %s' collides with newly inferred '%s'. Reason for older: %s" % (n0, self.graph[n0][n1]['relation'], n1, r, self.graph[n0][n1]['reason'])
-                warn(testmessage, testclass, testlevel, testid, line0)
+                testmessage = "Older temporal relation '%s %s %s' collides with newly inferred '%s'. Reason for older: %s" % (n0, self.graph[n0][n1][0], n1, r, render_reason(self.graph[n0][n1][1]))
+                warn(testmessage, testclass, testlevel, testid, line0, node=n0 if variable_re.match(n0) else n1)
         else:
             if not n0 in self.graph:
                 self.graph[n0] = {}
-            if not n1 in self.graph[n0]:
-                self.graph[n0][n1] = {}
-            self.graph[n0][n1]['relation'] = r
-            self.graph[n0][n1]['reason'] = reason
+            self.graph[n0][n1] = (r, reason)
+            if not n1 in self.incoming:
+                self.incoming[n1] = {}
+            if not r in self.incoming[n1]:
+                self.incoming[n1][r] = set()
+            self.incoming[n1][r].add(n0)
 
     def relation(self, n0, n1):
         if n0 in self.graph and n1 in self.graph[n0]:
-            return self.graph[n0][n1]['relation']
+            return self.graph[n0][n1][0]
+        elif self.is_identical(n0, n1):
+            return ':identity'
         else:
             return None
 
     def reason(self, n0, n1):
         if n0 in self.graph and n1 in self.graph[n0]:
-            return self.graph[n0][n1]['reason']
+            return self.graph[n0][n1][1]
+        elif self.is_identical(n0, n1):
+            return self.coref_reason(n0)
         else:
             return None
 
@@ -2207,45 +2904,88 @@ class Temporal:
         Finds out whether there is relation between nodes n0 and n1 of a type in
         the given list.
         """
-        return n0 in self.graph and n1 in self.graph[n0] and self.graph[n0][n1]['relation'] in relation_list
+        return self.relation(n0, n1) in relation_list
+
+    def parents(self, node, relation_list=None):
+        """
+        Returns the set of nodes that have a relation to the given node. If
+        relation_list is given, only relations of these types are considered.
+        """
+        result = set()
+        if node in self.incoming:
+            for r in self.incoming[node]:
+                if relation_list is None or r in relation_list:
+                    result |= self.incoming[node][r]
+        if relation_list is None or ':identity' in relation_list:
+            result.update(self.identical_parents(node))
+        return result
+
+    def related_nodes(self, n0, relation_list0, n1, relation_list1):
+        """
+        Returns the nodes other than n0 and n1 that have a relation of the given
+        types to n0 or n1, ordered by their ids. When a relation between n0 and
+        n1 is added, new relations can be inferred only for these nodes.
+        """
+        result = self.parents(n0, relation_list0) | self.parents(n1, relation_list1)
+        result.discard(n0)
+        result.discard(n1)
+        return sorted(result)
 
     def remove_identity_only_nodes(self):
         """
         The document's temporal graph may contain nodes that are neither temporal
         expressions nor events. They are inherited from the coreference graph and
         they have only :identity relations, nothing else. This function will remove
-        them.
+        them. The members of clusters that have no other relations than those to
+        the other members are not in self.graph; they are removed by setting
+        self.pruned.
         """
         nodes = list(self.graph)
-        ionly = [x for x in nodes if not any([True for y in self.graph[x] if self.graph[x][y]['relation'] != ':identity'])]
+        ionly = [x for x in nodes if not any([True for y in self.graph[x] if self.graph[x][y][0] != ':identity'])]
         for node in ionly:
+            for y in self.graph[node]:
+                self.incoming[y][':identity'].discard(node)
             del self.graph[node]
+        self.pruned = True
 
     def print_timeline(self):
         """
         Partially orders the temporal nodes following their before-after relations.
-        Prints them together with debugging information.
+        Prints them together with debugging information. The nodes are printed
+        by components (see component()). Within a component, the next node to
+        print is the minimal one (see timeline_key()) among the nodes that have
+        a relation from an already printed node or, if there are none, among
+        all remaining nodes of the component. It is printed together with its
+        identity cluster. The candidates are kept in heaps and the printed
+        nodes in a dictionary of positions, so that the time line is printed
+        in time proportional to the size of the graph (up to a logarithm).
         """
         print("Document temporal graph:\n")
         print(self)
         print("Document time line:")
-        nodes = sorted(list(self.graph))
         self.already_printed = []
-        for node in nodes:
-            if not node in self.already_printed:
-                component = self.component(node)
-                if component:
-                    #print("\nNode %s => component" % node, component)
-                    while True:
-                        # Find next node to print.
-                        # It must be one of those that have not been printed yet.
-                        # We should also be able to find one that has a relation to one of the already printed nodes.
-                        candidates = [x for x in component if not x in self.already_printed and self.find_relation_to_already_printed(x)]
+        self.printed_position = {}
+        # Nodes to which a printed node has a relation other than :overlap.
+        self.reached = set()
+        for node in sorted(self.graph):
+            if not node in self.printed_position:
+                self.current_component = component = self.component(node)
+                remaining = [self.timeline_key(x) for x in component if not x in self.printed_position]
+                self.ready = [self.timeline_key(x) for x in component if x in self.reached and not x in self.printed_position]
+                heapq.heapify(remaining)
+                heapq.heapify(self.ready)
+                while True:
+                    # Printed nodes are removed from the heaps only when they get to the top.
+                    candidates = self.ready
+                    while candidates and candidates[0][2] in self.printed_position:
+                        heapq.heappop(candidates)
+                    if not candidates:
+                        candidates = remaining
+                        while candidates and candidates[0][2] in self.printed_position:
+                            heapq.heappop(candidates)
                         if not candidates:
-                            candidates = [x for x in component if not x in self.already_printed]
-                            if not candidates:
-                                break
-                        self.print_identity_cluster(self.minimal_node(candidates))
+                            break
+                    self.print_identity_cluster(candidates[0][2])
 
     def component(self, node):
         """
@@ -2254,47 +2994,44 @@ class Temporal:
         (before, after, identity, contained, contains). Note that this does not
         necessarily mean that all have a direct relation to the initial node, as
         the :contains relation carries over before/after from larger to smaller
-        but not from smaller to larger.
+        but not from smaller to larger. Returns the set of the nodes.
         """
-        queue = [node]
-        component = {}
+        queue = deque([node])
+        component = set([node])
         while queue:
-            x = queue.pop(0)
-            if not x in component:
-                component[x] = True
-                for y in self.children(x):
-                    if not y in component and self.graph[x][y]['relation'] in [':before', ':after', ':identity', ':contained', ':contains']:
-                        queue.append(y)
-        return sorted_temporal(self, list(component))
-
-    def minimal_node(self, nodes):
+            x = queue.popleft()
+            for y, (r, reason) in self.graph.get(x, {}).items():
+                if not y in component and r in [':before', ':after', ':identity', ':contained', ':contains']:
+                    component.add(y)
+                    queue.append(y)
+            for y in self.identical(x):
+                if not y in component:
+                    component.add(y)
+                    queue.append(y)
+        return component
+
+    def timeline_key(self, node):
         """
-        Takes a list of nodes (a subset of the nodes in the graph).
-        Finds the node that is after as little nodes as possible (in the whole
-        graph, not just in this list; if the list contains all nodes of the
-        graph, we can find at least one node that is not after any other node)
-        and is before as many nodes as possible. For the purpose of ordering,
-        :contained counts as :after and :contains counts as :before.
+        Returns the key by which the nodes are ordered on the time line: the
+        node that is after as little nodes as possible (in the whole graph) and
+        before as many nodes as possible comes first. For the purpose of
+        ordering, :contained counts as :after and :contains counts as :before.
         As the nodes are only partially ordered, there may be multiple minimal
-        nodes; in such a case it returns the one whose id is alphabetically
-        minimal.
+        nodes; in such a case the one whose id is alphabetically minimal comes
+        first.
         """
-        info = []
-        for node in nodes:
-            naft = len([x for x in self.graph if self.is_relation(x, node, [':after', ':contained'])])
-            nbef = len([x for x in self.graph if self.is_relation(x, node, [':before', ':contains'])])
-            info.append((naft, -nbef, node))
-        info.sort()
-        # The input list should be non-empty. Otherwise an exception will be thrown now.
-        return info[0][2]
+        incoming = self.incoming.get(node, {})
+        naft = len(incoming.get(':after', ())) + len(incoming.get(':contained', ()))
+        nbef = len(incoming.get(':before', ())) + len(incoming.get(':contains', ()))
+        return (naft, -nbef, node)
 
     def print_identity_cluster(self, node):
-        nodes = sorted([node] + [x for x in self.graph if self.is_relation(node, x, [':identity'])])
+        nodes = sorted([node] + [x for x in self.graph.get(node, {}) if x in self.graph and self.graph[node][x][0] == ':identity'] + [x for x in self.identical(node) if x in self.graph])
         for node in nodes:
             self.print_node(node)
 
     def print_node(self, node):
-        if not node in self.already_printed:
+        if not node in self.printed_position:
             relation_parent = self.already_printed[-1] if self.already_printed else None
             relation = ':norel'
             rpr = self.find_relation_to_already_printed(node)
@@ -2308,45 +3045,34 @@ class Temporal:
                     relation_parent = rpr[0]
                     relation = rpr[1]
             print("%s %s %s" % (debugnode(relation_parent, self.node_dict), relation, debugnode(node, self.node_dict)))
+            self.printed_position[node] = len(self.already_printed)
             self.already_printed.append(node)
+            # The children of the node can now follow it on the time line.
+            children = [y for y, (r, reason) in self.graph.get(node, {}).items() if r != ':overlap'] + self.identical(node)
+            for y in children:
+                if not y in self.reached:
+                    self.reached.add(y)
+                    if y in self.current_component and not y in self.printed_position:
+                        heapq.heappush(self.ready, self.timeline_key(y))
 
     def find_relation_to_already_printed(self, node, allow_overlap=False):
-        previous_nodes = self.already_printed.copy()
-        while previous_nodes:
-            pnode = previous_nodes.pop()
-            if pnode and pnode in self.graph and node in self.graph[pnode] and (self.graph[pnode][node]['relation'] != ':overlap' or allow_overlap):
+        """
+        Returns the most recently printed node that has a relation to the given
+        node (other than :overlap unless allow_overlap), together with the
+        relation; or None if there is no such node.
+        """
+        relation_parent = None
+        for r, parents in self.incoming.get(node, {}).items():
+            if r != ':overlap' or allow_overlap:
+                for pnode in parents:
+                    if pnode in self.printed_position and (relation_parent is None or self.printed_position[pnode] > self.printed_position[relation_parent]):
+                        relation_parent = pnode
+        for pnode in self.identical_parents(node):
+            if pnode in self.printed_position and (relation_parent is None or self.printed_position[pnode] > self.printed_position[relation_parent]):
                 relation_parent = pnode
-                relation = self.graph[pnode][node]['relation']
-                return (relation_parent, relation)
-        return None
-
-def sorted_temporal(temporal, nodes):
-    """
-    Takes the list of nodes from the document's temporal graph and tries to
-    order them according to the temporal relations where they exist.
-    (The output is only partially predictable because relations between some
-    nodes may be missing.)
-    """
-    nodes_with_graph = [(x, temporal) for x in nodes]
-    compare_key = cmp_to_key(compare_temporal)
-    return [x[0] for x in sorted(nodes_with_graph, key=compare_key)]
-
-def compare_temporal(node1, node2):
-    temporal = node1[1]
-    if temporal.is_relation(node1[0], node2[0], [':before', ':contains']):
-        # node2 is before node 1
-        # node2 contains node1
-        # node1 > node2
-        return 1
-    elif temporal.is_relation(node1[0], node2[0], [':after', ':contained']):
-        # node2 is after node 1
-        # node2 is contained in node 1
-        # node1 < node2
-        return -1
-    else:
-        # It could be identity.
-        # But it could be also incomparable situations: overlap or no relation at all.
-        return 0
+        if relation_parent is None:
+            return None
+        return (relation_parent, self.relation(relation_parent, node))
 
 
 
@@ -2354,62 +3080,1291 @@ def compare_temporal(node1, node2):
 # Main part.
 #==============================================================================
 
+# The tests of the sentences and of the whole document, in the order in which
+# they run. For each test: the validation level from which it runs, the tests
+# whose results it needs (e.g., validate_events() checks the nodes that
+# detect_events() marked as events), and the tests whose results it uses if
+# they run (e.g., validate_document_relations() adds the unknown nodes of the
+# relations, which the document-level tests otherwise fail on). A test runs
+# only if the tests it needs run, too. --only and --skip select tests from
+# this table; --only adds the tests that are needed or used. The document-level
+# tests report level 3 errors but they run already at level 2, which collects
+# their input.
+checks = {
+    'validate_sentence_metadata': {'level': 2, 'requires': [], 'uses': []},
+    'validate_sentence_graph': {'level': 2, 'requires': [], 'uses': []},
+    'validate_alignment': {'level': 2, 'requires': ['validate_sentence_metadata', 'validate_sentence_graph'], 'uses': []},
+    'validate_document_level': {'level': 2, 'requires': ['validate_sentence_graph'], 'uses': []},
+    'validate_abstract_concept_NEs': {'level': 3, 'requires': ['validate_sentence_metadata', 'validate_sentence_graph'], 'uses': []},
+    'validate_relations': {'level': 3, 'requires': ['validate_sentence_graph'], 'uses': []},
+    'validate_name': {'level': 3, 'requires': ['validate_sentence_graph'], 'uses': []},
+    'validate_wiki': {'level': 3, 'requires': ['validate_sentence_graph'], 'uses': []},
+    'detect_events': {'level': 3, 'requires': ['validate_alignment', 'validate_document_level'], 'uses': []},
+    'validate_events': {'level': 3, 'requires': ['validate_alignment', 'validate_document_level', 'detect_events'], 'uses': []},
+    'validate_document_relations': {'level': 3, 'requires': ['validate_document_level'], 'uses': []},
+    'collect_coreference_clusters': {'level': 2, 'requires': ['validate_alignment', 'validate_document_level'], 'uses': ['validate_document_relations']},
+    'build_temporal_graph': {'level': 2, 'requires': ['collect_coreference_clusters'], 'uses': []}
+}
+
+def select_checks(args):
+    """
+    Returns the names of the tests to run, in the order of the table checks:
+    the tests of the --level, restricted to the --only tests and the tests they
+    need or use, without the --skip tests and the tests that need them. Raises
+    ValueError if a test is unknown or if an --only test cannot run.
+    """
+    only = [name for value in args.only for name in value.split(',') if name]
+    skip = [name for value in args.skip for name in value.split(',') if name]
+    for name in only + skip:
+        if not name in checks:
+            raise ValueError("Unknown test '%s'. The tests are: %s." % (name, ', '.join(checks)))
+    # The tests needed by a test precede it in the table.
+    selected = set()
+    for name, check in checks.items():
+        if check['level'] <= args.level and not name in skip and all(r in selected for r in check['requires']):
+            selected.add(name)
+    if only:
+        wanted = set()
+        stack = list(only)
+        while stack:
+            name = stack.pop()
+            if not name in wanted:
+                wanted.add(name)
+                stack.extend(checks[name]['requires'] + checks[name]['uses'])
+        for name in only:
+            if not name in selected:
+                raise ValueError("The test '%s' cannot run at --level %d or without the tests it needs: %s." % (name, args.level, ', '.join(checks[name]['requires'])))
+        selected &= wanted
+    return [name for name in checks if name in selected]
+
+def lemmas_needed(args):
+    """
+    Tells whether the selected tests need the lemmas of the tokens, so that
+    the lemmatizer must be loaded.
+    """
+    return 'validate_abstract_concept_NEs' in args.checks and args.lemmatizer != 'none'
+
 def validate(inp, out, args, known_sent_ids):
     global sentence_line, sentence_id
     # Dictionary of all concept nodes in the document.
     node_dict = {}
-    # Collected data of the whole document.
-    document = {'sentences': []}
-    for sentence in sentences(inp, args):
-        # If fundamental errors were found already in sentences(), the function
-        # will skip the current sentence and go to the next one. So if we are
-        # here, we have a sentence with the expected set of annotation blocks
-        # and with lines that at least superficially look acceptable.
-        # But let's do a sanity check anyway:
-        if len(sentence)<4:
-            testlevel = 0
-            testclass = 'Internal'
-            testid = 'invalid-sentence'
-            testmessage = "Skipping further tests of sentence with less than 4 annotation blocks."
-            warn(testmessage, testclass, testlevel, testid)
-            continue
-        if args.level > 1:
-            validate_sentence_metadata(sentence, known_sent_ids, args) # level 2?
-            validate_sentence_graph(sentence, node_dict, args)
-            validate_alignment(sentence, node_dict, args)
-            validate_document_level(sentence, node_dict, args)
-        if args.level > 2:
-            validate_abstract_concept_NEs(sentence, node_dict, args)
-            validate_relations(sentence, node_dict, args)
-            validate_name(sentence, node_dict, args)
-            validate_wiki(sentence, node_dict, args)
-            detect_events(sentence, node_dict, args)
-            if args.check_aspect_modstr:
-                validate_events(sentence, node_dict, args)
-            validate_document_relations(sentence, node_dict, args)
-        # Remember the sentence for further document-level tests.
-        document['sentences'].append(sentence)
-        # Before we read the next sentence, clear the current sentence variables
-        # so that sentences() knows they should be reset to new values.
-        sentence_line = None
-        sentence_id = None
+    # Collected data of the whole document. We do not keep the sentences, only
+    # the document-level relations that are needed by the document-level tests
+    # (see summarize_sentence()).
+    document = {'relations': []}
+    if args.sentence_jobs > 1 and any(name in args.checks for name in contents_checks) and not multiprocessing.current_process().daemon:
+        validate_sentences_parallel(inp, node_dict, document, args, known_sent_ids)
+    else:
+        for sentence in sentences(inp, args):
+            if validate_sentence(sentence, node_dict, document, args, known_sent_ids):
+                # Before we read the next sentence, clear the current sentence variables
+                # so that sentences() knows they should be reset to new values.
+                sentence_line = None
+                sentence_id = None
     # After we have read the input, we can ask about the line breaks observed.
     validate_newlines(inp) # level 1
     # Document-level tests.
-    collect_coreference_clusters(document, node_dict, args)
-    build_temporal_graph(document, node_dict, args)
+    if 'collect_coreference_clusters' in args.checks:
+        collect_coreference_clusters(document, node_dict, args)
+    if 'build_temporal_graph' in args.checks:
+        build_temporal_graph(document, node_dict, args)
 
-if __name__=="__main__":
+def validate_sentence(sentence, node_dict, document, args, known_sent_ids):
+    """
+    Runs the level 2 and 3 tests of one sentence read by sentences(), then
+    keeps what the document-level tests need from it. Returns False if the
+    sentence had to be skipped.
+    """
+    if profile is not None:
+        sentence_start = time.perf_counter()
+    # If fundamental errors were found already in sentences(), the function
+    # will skip the current sentence and go to the next one. So if we are
+    # here, we have a sentence with the expected set of annotation blocks
+    # and with lines that at least superficially look acceptable.
+    # But let's do a sanity check anyway:
+    if len(sentence)<4:
+        testlevel = 0
+        testclass = 'Internal'
+        testid = 'invalid-sentence'
+        testmessage = "Skipping further tests of sentence with less than 4 annotation blocks."
+        warn(testmessage, testclass, testlevel, testid)
+        return False
+    selected = args.checks
+    if 'validate_sentence_metadata' in selected:
+        validate_sentence_metadata(sentence, known_sent_ids, args) # level 2?
+    if 'validate_sentence_graph' in selected:
+        validate_sentence_graph(sentence, node_dict, args)
+    if 'validate_alignment' in selected:
+        validate_alignment(sentence, node_dict, args)
+    if 'validate_document_level' in selected:
+        validate_document_level(sentence, node_dict, args)
+    validate_sentence_contents(sentence, node_dict, args)
+    if 'detect_events' in selected:
+        detect_events(sentence, node_dict, args)
+    if 'validate_events' in selected and args.check_aspect_modstr:
+        validate_events(sentence, node_dict, args)
+    if 'validate_document_relations' in selected:
+        validate_document_relations(sentence, node_dict, args)
+    # Remember what we need from the sentence for further document-level tests.
+    summarize_sentence(sentence, document, node_dict)
+    if profile is not None:
+        profile_sentence(time.perf_counter() - sentence_start)
+    return True
+
+def summarize_sentence(sentence, document, node_dict):
+    """
+    Once all sentence-level tests of a sentence are done, keeps only what the
+    document-level tests (collect_coreference_clusters(), build_temporal_graph())
+    need from it: the coreference and temporal relations of its document-level
+    graph, and for each of its nodes the concept, alignment, line and :wiki
+    relations. The lines, comments and tokens of the sentence are not referenced
+    anymore and can be released, so that memory does not grow with the length
+    of the document.
+    """
+    if 'relations' in sentence[3]:
+        document['relations'].extend([r for r in sentence[3]['relations'] if r['group'] in [':coref', ':temporal']])
+    if 'nodes' in sentence[1]:
+        for nid in sentence[1]['nodes']:
+            node = node_dict[nid]
+            node.relations = [r for r in node.relations if r.relation == ':wiki']
+
+#------------------------------------------------------------------------------
+# Incremental validation (--cache-dir). The messages found in a file are stored
+# in an SQLite database together with a fingerprint of the file contents, of
+# this script and of the options that affect the tests. If the fingerprint
+# matches in the next run, the messages are replayed without reading the file
+# again. If the file has changed, it is validated again, but the results of
+# the level 3 tests that look only at one sentence are replayed for the
+# sentences that have not changed (see validate_sentence_contents()). The
+# document-level tests always run again on a changed file because they depend
+# on all its sentences. The messages are cached before they are counted, so
+# that --quiet and --max-err work the same way as without the cache.
+#------------------------------------------------------------------------------
+
+cache_db = None
+cache_pid = None # the process that opened cache_db; worker processes must open their own connection
+cache_fingerprint = None
+old_sentence_results = {} # key: sentence fingerprint; value: messages of the content tests in the previous run of the current file (JSON; see store_sentence_results())
+new_sentence_results = {} # the same for the current run
+line_reference_re = re.compile(r"\bline [0-9]+") # a line number in the text of a message
+
+# Options that do not change the messages found in a file. The options that
+# decide which messages are printed (--quiet, --max-err) are applied when the
+# cached messages are replayed.
+cache_neutral_options = ['input', 'quiet', 'max_err', 'jobs', 'sentence_jobs', 'output', 'output_format', 'cache_dir', 'lemma_cache', 'lemma_cache_size', 'wikidata_timeout', 'wikidata_cache', 'wikidata_cache_ttl', 'profile', 'profile_json', 'server', 'server_socket', 'watch', 'watch_interval', 'watch_debounce', 'report_dir']
+
+def get_cache_db():
+    """
+    Returns the connection to the result cache in --cache-dir. There is one
+    entry per input file (identified by its real path) and validator (see
+    get_cache_fingerprint()); the entries of a file are replaced whenever it is
+    validated again, so the cache does not grow beyond the files and option
+    sets that are being used.
+    """
+    global cache_db, cache_pid
+    if cache_db is None or cache_pid != os.getpid():
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cache_db = sqlite3.connect(os.path.join(args.cache_dir, 'validate-cache.sqlite'), timeout=60)
+        cache_db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT, validator TEXT, fingerprint TEXT, result TEXT, PRIMARY KEY (path, validator))')
+        cache_db.execute('CREATE TABLE IF NOT EXISTS sentences (path TEXT, validator TEXT, fingerprint TEXT, records TEXT, PRIMARY KEY (path, validator, fingerprint))')
+        cache_pid = os.getpid()
+    return cache_db
+
+def get_cache_fingerprint():
+    """
+    Identifies the validator and the options whose results are cached: the
+    source of this script, the relevant options, the hashes of the label
+    inventories if the test that uses them is selected and, if lemmas are
+    needed, the versions of the lemmatizer packages (found without loading
+    them). Returns a hash of all that.
+    """
+    global cache_fingerprint
+    if cache_fingerprint is None:
+        with io.open(os.path.realpath(__file__), 'rb') as f:
+            source = hashlib.sha256(f.read()).hexdigest()
+        options = {k: v for k, v in sorted(vars(args).items()) if not k in cache_neutral_options}
+        packages = {}
+        if lemmas_needed(args):
+            for package in ['spacy', 'en_core_web_sm', 'spacy-lookups-data']:
+                try:
+                    packages[package] = importlib.metadata.version(package)
+                except importlib.metadata.PackageNotFoundError:
+                    packages[package] = None
+        labels = {}
+        if 'validate_abstract_concept_NEs' in args.checks:
+            labels = {name: x['sha256'] for name, x in get_label_tables()['sources'].items()}
+        cache_fingerprint = hashlib.sha256(json.dumps([source, options, packages, labels], sort_keys=True).encode('utf-8')).hexdigest()
+    return cache_fingerprint
+
+def sentence_fingerprint(sentence):
+    """
+    Identifies a sentence for validate_sentence_contents(): the lines of its
+    annotation blocks, their position relative to the sentence level graph (so
+    that the sentence is recognized if lines were inserted or deleted before
+    it) and the set of its nodes (which may be smaller than what the lines
+    suggest if a variable was already used in a previous sentence). The first
+    block is taken without its position because it also counts the empty
+    lines that precede the sentence.
+    """
+    line0 = sentence[1]['line0']
+    blocks = [[b['line0'] - line0 if i > 0 else None, b['comments'], b['lines']] for i, b in enumerate(sentence)]
+    nodes = sorted(sentence[1].get('nodes', []))
+    return hashlib.sha256(json.dumps([blocks, nodes]).encode('utf-8')).hexdigest()
+
+def store_sentence_results(sentence, fingerprint, records):
+    """
+    Keeps the messages of the content tests of a sentence for the next run.
+    Their line numbers are stored relative to the sentence level graph. A message that mentions a line number in its text cannot be
+    moved, so the messages of such a sentence are replayed only if the
+    sentence stays where it is.
+    """
+    line0 = sentence[1]['line0']
+    fixed = any(line_reference_re.search(record['message']) for record, explanation in records)
+    moved = [(dict(record, line=record['line'] - line0), explanation) for record, explanation in records]
+    new_sentence_results[fingerprint] = json.dumps({'line0': line0 if fixed else None, 'records': moved})
+
+def replay_sentence_results(sentence, fingerprint):
+    """
+    Passes the messages that store_sentence_results() kept for a sentence in
+    the previous run to the recorder, moved to the current position of the
+    sentence. Returns False if there are no usable messages.
+    """
+    if not fingerprint in old_sentence_results:
+        return False
+    line0 = sentence[1]['line0']
+    stored = json.loads(old_sentence_results[fingerprint])
+    if stored['line0'] is not None and stored['line0'] != line0:
+        return False
+    for record, explanation in stored['records']:
+        record['file'] = curr_fname
+        record['line'] += line0
+        recorder.append((record, explanation))
+    new_sentence_results[fingerprint] = old_sentence_results[fingerprint]
+    return True
+
+# The tests run (and cached) by validate_sentence_contents().
+contents_checks = ['validate_abstract_concept_NEs', 'validate_relations', 'validate_name', 'validate_wiki']
+
+def validate_sentence_contents(sentence, node_dict, args):
+    """
+    Runs the level 3 tests whose results depend only on the current sentence
+    and not on the previous ones. With --cache-dir, their messages are
+    remembered for each sentence, and if the same sentence is found in the
+    next run, the messages are replayed instead of running the tests.
+    """
+    selected = [name for name in contents_checks if name in args.checks]
+    if not selected:
+        return
+    fingerprint = None
+    if args.cache_dir and recorder is not None:
+        fingerprint = sentence_fingerprint(sentence)
+        if replay_sentence_results(sentence, fingerprint):
+            return
+        start = len(recorder)
+    if deferred_contents is not None:
+        # The tests run in a worker process (see --sentence-jobs).
+        defer_contents(sentence, node_dict)
+        return
+    if 'validate_abstract_concept_NEs' in selected:
+        validate_abstract_concept_NEs(sentence, node_dict, args)
+    if 'validate_relations' in selected:
+        validate_relations(sentence, node_dict, args)
+    if 'validate_name' in selected:
+        validate_name(sentence, node_dict, args)
+    if 'validate_wiki' in selected:
+        validate_wiki(sentence, node_dict, args)
+    if fingerprint is not None:
+        store_sentence_results(sentence, fingerprint, recorder[start:])
+
+def validate_cached_file(fname):
+    """
+    Validates one input file with --cache-dir, or takes its results from the
+    cache if neither the file nor the validator has changed. Returns the
+    messages (not yet counted), the captured reports for the standard output,
+    the sentence ids (with the number of messages that precede each of them)
+    and the traceback if the validation ended with an exception. Results of a
+    failed validation are not cached, nor are the results of a file for which
+    some Wikidata labels could not be fetched (the labels are a part of some
+    messages and reports, and the next run may get them).
+    """
+    global old_sentence_results, new_sentence_results
+    path = os.path.realpath(fname)
+    validator = get_cache_fingerprint()
+    with io.open(fname, 'rb') as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()
+    db = get_cache_db()
+    row = db.execute('SELECT fingerprint, result FROM files WHERE path = ? AND validator = ?', (path, validator)).fetchone()
+    if row and row[0] == fingerprint:
+        return json.loads(row[1])
+    old_sentence_results = dict(db.execute('SELECT fingerprint, records FROM sentences WHERE path = ? AND validator = ?', (path, validator)))
+    new_sentence_results = {}
+    failed_lookups = wikidata_failed_lookups
+    result = validate_recorded(fname)
+    if result['traceback'] is None:
+        with db:
+            if wikidata_failed_lookups == failed_lookups:
+                db.execute('INSERT OR REPLACE INTO files (path, validator, fingerprint, result) VALUES (?, ?, ?, ?)', (path, validator, fingerprint, json.dumps(result)))
+            else:
+                db.execute('DELETE FROM files WHERE path = ? AND validator = ?', (path, validator))
+            db.execute('DELETE FROM sentences WHERE path = ? AND validator = ?', (path, validator))
+            db.executemany('INSERT INTO sentences (path, validator, fingerprint, records) VALUES (?, ?, ?, ?)', [(path, validator, k, v) for k, v in new_sentence_results.items()])
+    old_sentence_results = {}
+    new_sentence_results = {}
+    return result
+
+def validate_recorded(fname):
+    """
+    Validates one input file without reporting the messages. Returns the
+    messages (not yet counted), the captured reports for the standard output,
+    the sentence ids (with the number of messages that precede each of them)
+    and the traceback if the validation ended with an exception. The result
+    can be reported later by replay_file_result().
+    """
+    global curr_fname, curr_line, sentence_line, sentence_id, recorder
+    curr_fname = fname
+    curr_line = 0
+    sentence_line = 0
+    sentence_id = None
+    recorder = []
+    known_ids = SentenceIds(recorder)
+    # The statistics of the file are returned with the result and added when it is replayed.
+    earlier_stats = alignment_stats.pop(fname, None)
+    stdout = io.StringIO()
+    tb = None
+    with redirect_stdout(stdout):
+        try:
+            # If the file has been validated before, most sentences will not
+            # need their lemmas, so they are not lemmatized in advance.
+            if lemmas_needed(args) and not old_sentence_results:
+                prefetch_lemmas(fname)
+            with io.open(fname, 'r', encoding='utf-8') as inp:
+                validate(inp, sys.stdout, args, known_ids)
+            save_lemma_cache()
+        except:
+            warn('Exception caught!', 'Internal', 0, 'internal-error')
+            tb = traceback.format_exc()
+    result = {'records': recorder, 'stdout': stdout.getvalue(), 'sent_ids': known_ids.occurrences, 'traceback': tb,
+              'alignment_stats': alignment_stats.pop(fname, None)}
+    if earlier_stats is not None:
+        alignment_stats[fname] = earlier_stats
+    recorder = None
+    return result
+
+def replay_file_result(fname, result, known_sent_ids):
+    """
+    Reports the messages returned by validate_cached_file() as if the file was
+    being validated now. Sentence ids that were already used in one of the
+    previous files are reported at the place where they occur.
+    """
+    global curr_fname, sentence_line, sentence_id
+    curr_fname = fname
+    sys.stdout.write(result['stdout'])
+    records = result['records']
+    printed = 0
+    for sid, sline, slabel, position in result['sent_ids']:
+        for record, explanation in records[printed:position]:
+            record['file'] = fname
+            report(record, explanation)
+        printed = position
+        sentence_line = sline
+        sentence_id = slabel
+        if sid in known_sent_ids:
+            testid = 'non-unique-sent-id'
+            testmessage = "Non-unique sentence id '%s'." % sid
+            warn(testmessage, 'Metadata', 2, testid, lineno=-1)
+        known_sent_ids.add(sid)
+    for record, explanation in records[printed:]:
+        record['file'] = fname
+        report(record, explanation)
+    if result['traceback']:
+        sink.note(result['traceback'])
+    if result.get('alignment_stats'):
+        add_alignment_stats(result['alignment_stats'], fname)
+    sentence_line = None
+    sentence_id = None
+
+#------------------------------------------------------------------------------
+# Alignment statistics (--alignment-stats). validate_alignment() counts the
+# tokens and nodes of each sentence as a by-product of its coverage checks, and
+# the counts are summed per file. The counts of worker processes (--jobs) and
+# of cached files (--cache-dir) come with their results.
+#------------------------------------------------------------------------------
+
+alignment_stats = {} # key: file name; value: counts (see validate_alignment())
+
+def add_alignment_stats(counts, fname=None):
+    """
+    Adds the counts of a sentence or of a whole file to the statistics of the
+    file (by default the current file).
+    """
+    entry = alignment_stats.setdefault(curr_fname if fname is None else fname, {})
+    for k, v in counts.items():
+        entry[k] = entry.get(k, 0) + v
+
+def merge_alignment_stats(other):
+    """
+    Adds the statistics of a worker process (see --jobs) to ours.
+    """
+    for fname, counts in other.items():
+        add_alignment_stats(counts, fname)
+
+def print_alignment_stats():
+    """
+    Prints the alignment statistics per file and their totals (one of the
+    reports on the standard output).
+    """
+    def percent(part, whole):
+        return 100.0 * part / whole if whole else 0.0
+    total = {}
+    print('Alignment coverage:')
+    print('  %-32s %9s %9s %8s %9s %11s %9s %9s %8s %8s' % ('File', 'Sentences', 'Tokens', 'Aligned', 'Multiple', 'Unaligned', 'Punct.', 'Nodes', '0-0', 'Missing'))
+    rows = list(alignment_stats.items())
+    for fname, counts in rows:
+        for k, v in counts.items():
+            total[k] = total.get(k, 0) + v
+    if len(rows) > 1:
+        rows.append(('Total', total))
+    for fname, counts in rows:
+        print('  %-32s %9d %9d %7.1f%% %9d %11d %9d %9d %8d %8d' % (fname, counts['sentences'], counts['tokens'], percent(counts['aligned'], counts['tokens']),
+                                                                 counts['overlapping'], counts['unaligned'], counts['punctuation'], counts['nodes'], counts['unaligned_nodes'], counts['missing']))
+
+#------------------------------------------------------------------------------
+# Profiling of the tests (--profile, --profile-json). The test functions are
+# replaced by timing wrappers only when profiling was requested, so that the
+# validator does not spend any time on measuring otherwise.
+#------------------------------------------------------------------------------
+
+# The functions that are measured, and the validation level to which they belong.
+# The document-level tests run at every level but they report level 3 errors.
+profiled_checks = {
+    'sentences': 1,
+    'validate_newlines': 1,
+    'validate_sentence_metadata': 2,
+    'validate_sentence_graph': 2,
+    'validate_alignment': 2,
+    'validate_document_level': 2,
+    'prefetch_lemmas': 3,
+    'validate_abstract_concept_NEs': 3,
+    'validate_relations': 3,
+    'validate_name': 3,
+    'validate_wiki': 3,
+    'detect_events': 3,
+    'validate_events': 3,
+    'validate_document_relations': 3,
+    'collect_coreference_clusters': 3,
+    'build_temporal_graph': 3
+}
+profile_slowest = 10 # how many of the slowest sentences are reported
+profile = None # the measurements; see new_profile()
+
+def new_profile():
+    """
+    Returns an empty set of measurements: the number of calls and the time
+    spent for each check and file, the number of sentences and the time spent
+    on their tests for each file, and the slowest sentences as tuples (time,
+    file, sentence id, line).
+    """
+    return {'checks': {}, 'files': {}, 'slowest': []}
+
+def profiled(name, func):
+    """
+    Returns a function that calls func and adds the time spent in it to the
+    profile of the current file. The generator sentences() is measured while
+    it is reading each sentence, not while the caller processes the sentence.
+    """
+    def add(elapsed):
+        entry = profile['checks'].setdefault(name, {}).setdefault(curr_fname, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+    if name == 'sentences':
+        def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    add(time.perf_counter() - start)
+                    return
+                add(time.perf_counter() - start)
+                yield item
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(time.perf_counter() - start)
+    return wrapper
+
+def install_profiler():
+    """
+    Starts profiling: replaces the functions in profiled_checks by their
+    timing wrappers. Called once in each process.
+    """
+    global profile
+    if profile is None:
+        profile = new_profile()
+        for name in profiled_checks:
+            globals()[name] = profiled(name, globals()[name])
+
+def profile_sentence(elapsed):
+    """
+    Records the time spent on the tests of the current sentence.
+    """
+    entry = profile['files'].setdefault(curr_fname, [0, 0.0])
+    entry[0] += 1
+    entry[1] += elapsed
+    if len(profile['slowest']) < profile_slowest or elapsed > profile['slowest'][-1][0]:
+        profile['slowest'].append((elapsed, curr_fname, sentence_id, sentence_line))
+        profile['slowest'].sort(key=lambda x: -x[0])
+        del profile['slowest'][profile_slowest:]
+
+def merge_profile(other):
+    """
+    Adds the measurements of a worker process (see --jobs) to the profile.
+    """
+    for name, files in other['checks'].items():
+        for fname, (calls, elapsed) in files.items():
+            entry = profile['checks'].setdefault(name, {}).setdefault(fname, [0, 0.0])
+            entry[0] += calls
+            entry[1] += elapsed
+    for fname, (count, elapsed) in other['files'].items():
+        entry = profile['files'].setdefault(fname, [0, 0.0])
+        entry[0] += count
+        entry[1] += elapsed
+    profile['slowest'] = sorted(profile['slowest'] + [tuple(x) for x in other['slowest']], key=lambda x: -x[0])[:profile_slowest]
+
+def profile_summary():
+    """
+    Aggregates the profile per check, per level and per file. Returns
+    a dictionary that can be written as JSON.
+    """
+    checks = []
+    levels = {}
+    files = {}
+    for name in profiled_checks:
+        if not name in profile['checks']:
+            continue
+        level = profiled_checks[name]
+        calls = sum(x[0] for x in profile['checks'][name].values())
+        elapsed = sum(x[1] for x in profile['checks'][name].values())
+        checks.append({'check': name, 'level': level, 'calls': calls, 'seconds': elapsed})
+        levels[level] = levels.get(level, 0.0) + elapsed
+        for fname, (calls, elapsed) in profile['checks'][name].items():
+            files.setdefault(fname, {'seconds': 0.0, 'sentences': 0, 'checks': {}})
+            files[fname]['seconds'] += elapsed
+            files[fname]['checks'][name] = {'calls': calls, 'seconds': elapsed}
+    for fname, (count, elapsed) in profile['files'].items():
+        files.setdefault(fname, {'seconds': 0.0, 'sentences': 0, 'checks': {}})
+        files[fname]['sentences'] = count
+    slowest = [{'file': f, 'sentence': s, 'line': l, 'seconds': e} for e, f, s, l in profile['slowest']]
+    return {'checks': sorted(checks, key=lambda x: -x['seconds']), 'levels': levels, 'files': files, 'slowest_sentences': slowest}
+
+def print_profile(summary):
+    """
+    Prints the profile as a table (one of the reports on the standard output).
+    """
+    print('Profile of the tests (wall time in seconds):')
+    print('  %-32s %5s %9s %10s %10s' % ('Check', 'Level', 'Calls', 'Total', 'Per call'))
+    for c in summary['checks']:
+        print('  %-32s %5d %9d %10.3f %10.6f' % (c['check'], c['level'], c['calls'], c['seconds'], c['seconds'] / c['calls'] if c['calls'] else 0))
+    for level in sorted(summary['levels']):
+        print('  Level %d: %.3f' % (level, summary['levels'][level]))
+    for fname, f in summary['files'].items():
+        print('  File %s: %.3f, %d sentences' % (fname, f['seconds'], f['sentences']))
+    if summary['slowest_sentences']:
+        print('Slowest sentences (time of their sentence level tests):')
+        for s in summary['slowest_sentences']:
+            print('  %.6f %s line %d Sent %s' % (s['seconds'], s['file'], s['line'], s['sentence']))
+
+class SentenceIds(set):
+    """
+    Set of the sentence ids seen so far. Besides the ids themselves, it remembers
+    (in input order) the first line and the label of the sentence in which each
+    id occurred, and the number of messages captured (in the list items) before
+    the id was checked. Uniqueness can thus be checked later across files that
+    were validated in different worker processes (see --jobs) or taken from the
+    cache (see --cache-dir), and the error can be reported at the same place as
+    in a serial run.
+    """
+    def __init__(self, items):
+        super().__init__()
+        self.items = items
+        self.occurrences = []
+
+    def add(self, sid):
+        if not sid in self:
+            self.occurrences.append((sid, sentence_line, sentence_id, len(self.items)))
+        super().add(sid)
+
+def init_worker(worker_args):
+    """
+    Initializes a worker process of the --jobs pool. With the 'fork' start method
+    the worker inherits the parsed options anyway but with 'spawn' it does not.
+    """
+    global args
+    args = worker_args
+    if args.profile or args.profile_json:
+        install_profiler()
+
+def validate_file(fname):
+    """
+    Validates one input file in a worker process. Everything that would be
+    printed and all diagnostics are captured and returned to the parent process
+    together with the error counts and the sentence ids, so that the parent can
+    print the reports in input order and check sentence id uniqueness across
+    files.
+    """
+    global curr_fname, curr_line, sentence_line, sentence_id, error_counter, sink
+    curr_fname = fname
+    curr_line = 0
+    sentence_line = 0
+    sentence_id = None
+    error_counter = {}
+    sink = CaptureSink()
+    if profile is not None:
+        profile.update(new_profile())
+    alignment_stats.clear()
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    known_ids = SentenceIds(sink.items)
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            if args.cache_dir:
+                replay_file_result(fname, validate_cached_file(fname), known_ids)
+            else:
+                if lemmas_needed(args):
+                    prefetch_lemmas(fname)
+                with io.open(fname, 'r', encoding='utf-8') as inp:
+                    validate(inp, sys.stdout, args, known_ids)
+                save_lemma_cache()
+        except:
+            warn('Exception caught!', 'Internal', 0, 'internal-error')
+            sink.note(traceback.format_exc())
+    # Anything that a library printed to the error output goes after the diagnostics.
+    if stderr.getvalue():
+        sink.note(stderr.getvalue())
+    return {'stdout': stdout.getvalue(), 'diagnostics': sink.items, 'error_counter': error_counter, 'sent_ids': known_ids.occurrences, 'profile': profile,
+            'alignment_stats': alignment_stats}
+
+def validate_files_parallel(args, known_sent_ids):
+    """
+    Validates the input files in a pool of args.jobs worker processes. The
+    reports of the individual files are printed in the order of the input files.
+    Sentence ids that were already used in one of the previous files are
+    reported here because the workers do not see each other's ids.
+    """
+    global curr_fname, sentence_line, sentence_id
+    # Load the lemmatizer before the workers are forked, so that they share it
+    # instead of each of them loading its own copy. With --lemma-cache, the
+    # lemmas may all be known already; the workers then load the lemmatizer
+    # only if some sentence is not in the cache.
+    if lemmas_needed(args) and not args.lemma_cache and multiprocessing.get_start_method() == 'fork':
+        get_nlp()
+    # The forked workers must not inherit buffered output of the parent.
+    sys.stdout.flush()
+    sink.stream.flush()
+    with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args,)) as pool:
+        for fname, result in zip(args.input, pool.imap(validate_file, args.input)):
+            sys.stdout.write(result['stdout'])
+            for k, v in result['error_counter'].items():
+                error_counter[k] = error_counter.get(k, 0) + v
+            if result['profile'] is not None:
+                merge_profile(result['profile'])
+            merge_alignment_stats(result['alignment_stats'])
+            curr_fname = fname
+            diagnostics = result['diagnostics']
+            printed = 0
+            for sid, sline, slabel, offset in result['sent_ids']:
+                if sid in known_sent_ids:
+                    replay(diagnostics[printed:offset], sink)
+                    printed = offset
+                    sentence_line = sline
+                    sentence_id = slabel
+                    testid = 'non-unique-sent-id'
+                    testmessage = "Non-unique sentence id '%s'." % sid
+                    warn(testmessage, 'Metadata', 2, testid, lineno=-1)
+                known_sent_ids.add(sid)
+            replay(diagnostics[printed:], sink)
+            sentence_line = None
+            sentence_id = None
+
+#------------------------------------------------------------------------------
+# Parallel validation of the sentences of one file (--sentence-jobs). Most
+# tests of a sentence depend on the sentences before it: on the sentence ids
+# and nodes seen so far, and on the coreference that marks earlier nodes as
+# events or entities. They run in the parent process in input order, as in a
+# serial run, and so do the document-level tests. Only the level 3 tests of
+# validate_sentence_contents(), which look at nothing but the current sentence
+# (their results are kept per sentence by --cache-dir, too), are sent to a pool
+# of worker processes, together with a copy of the sentence and its nodes taken
+# at the moment when a serial run would test them. Meanwhile the parent records
+# its own messages. When all sentences are done, it reports them with the
+# messages of the workers inserted where the tests would have run, so that the
+# report is the same as in a serial run.
+#------------------------------------------------------------------------------
+
+# The sentences are sent to the workers in batches of this size. Files with
+# fewer sentences are validated serially.
+contents_batch_size = 50
+
+# The sentences whose validate_sentence_contents() is left to the workers:
+# position in the recorded messages, curr_line, sentence_line, sentence_id and
+# the pickled sentence with its nodes. None if the tests run here.
+deferred_contents = None
+
+def defer_contents(sentence, node_dict):
+    """
+    Takes the place of validate_sentence_contents() in the parent process of
+    --sentence-jobs. Remembers where the messages of the tests belong and
+    a copy of the sentence and its nodes as they are now; the later tests may
+    still change them.
+    """
+    nodes = {nid: node_dict[nid] for nid in sentence[1]['nodes']}
+    deferred_contents.append((len(recorder), curr_line, sentence_line, sentence_id,
+                              pickle.dumps((sentence, nodes), protocol=pickle.HIGHEST_PROTOCOL)))
+
+def validate_contents_batch(task):
+    """
+    Runs validate_sentence_contents() on a batch of sentences from
+    defer_contents() in a worker process. Returns for each sentence the
+    captured messages, the captured reports for the standard output and error
+    output, and the traceback if an exception occurred (the rest of the batch
+    is then skipped); further the messages for --cache-dir and the profile.
+    """
+    global curr_fname, curr_line, sentence_line, sentence_id, recorder, new_sentence_results, deferred_contents
+    fname, batch = task
+    curr_fname = fname
+    deferred_contents = None
+    new_sentence_results = {}
+    if profile is not None:
+        profile.update(new_profile())
+    results = []
+    for curr_line, sentence_line, sentence_id, snapshot in batch:
+        sentence, node_dict = pickle.loads(snapshot)
+        recorder = []
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        tb = None
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                validate_sentence_contents(sentence, node_dict, args)
+            except:
+                tb = traceback.format_exc()
+        results.append((recorder, stdout.getvalue(), stderr.getvalue(), tb))
+        if tb:
+            break
+    return {'sentences': results, 'sentence_results': new_sentence_results, 'profile': profile}
+
+def report_recorded(records, occurrences, start, end, known_sent_ids):
+    """
+    Reports the messages recorded by validate_sentences_parallel() and passes
+    the sentence ids that it found (the occurrences of its SentenceIds) to
+    known_sent_ids, each after the messages that preceded it. Start and end
+    are pairs of the number of messages and sentence ids; returns end.
+    """
+    global sentence_line, sentence_id
+    printed, nsids = start
+    for sid, sentence_line, sentence_id, position in occurrences[nsids:end[1]]:
+        for record, explanation in records[printed:position]:
+            emit(record, explanation)
+        printed = position
+        known_sent_ids.add(sid)
+    for record, explanation in records[printed:end[0]]:
+        emit(record, explanation)
+    return end
+
+def validate_sentences_parallel(inp, node_dict, document, args, known_sent_ids):
+    """
+    Validates the sentences of one input file as validate() does, filling
+    node_dict and document for the document-level tests, but the tests of
+    validate_sentence_contents() run in a pool of args.sentence_jobs worker
+    processes. The messages are reported after the last sentence.
+    """
+    global recorder, deferred_contents, curr_line, sentence_line, sentence_id
+    outer_recorder = recorder
+    recorder = []
+    # The sentence ids are checked here but passed to known_sent_ids only when
+    # the messages before them are reported (see SentenceIds).
+    sent_ids = SentenceIds(recorder)
+    sent_ids.update(known_sent_ids)
+    deferred_contents = []
+    sid_counts = [] # for each deferred sentence the number of sentence ids seen by then
+    pool = None
+    jobs = [] # the first deferred sentence of each batch and its job in the pool
+    submitted = 0
+    error = None
+    try:
+        for sentence in sentences(inp, args):
+            if validate_sentence(sentence, node_dict, document, args, sent_ids):
+                sentence_line = None
+                sentence_id = None
+            sid_counts += [len(sent_ids.occurrences)] * (len(deferred_contents) - len(sid_counts))
+            if len(deferred_contents) - submitted >= contents_batch_size:
+                if pool is None:
+                    # The forked workers must not inherit buffered output of the parent.
+                    sys.stdout.flush()
+                    sink.stream.flush()
+                    # The objects inherited by the forked workers are left out of their
+                    # garbage collection; otherwise it would touch (and copy) all of them.
+                    gc.freeze()
+                    pool = multiprocessing.Pool(args.sentence_jobs, initializer=init_worker, initargs=(args,))
+                jobs.append((submitted, pool.apply_async(validate_contents_batch, ((curr_fname, [item[1:] for item in deferred_contents[submitted:]]),))))
+                submitted = len(deferred_contents)
+    except Exception as e:
+        # The sentences read so far are reported before the exception is raised again.
+        error = e
+    sid_counts += [len(sent_ids.occurrences)] * (len(deferred_contents) - len(sid_counts))
+    records = recorder
+    recorder = outer_recorder
+    deferred = deferred_contents
+    deferred_contents = None
+    end_state = (curr_line, sentence_line, sentence_id)
+    results = [None] * len(deferred)
+    if pool is not None:
+        try:
+            if submitted < len(deferred):
+                jobs.append((submitted, pool.apply_async(validate_contents_batch, ((curr_fname, [item[1:] for item in deferred[submitted:]]),))))
+            for first, job in jobs:
+                result = job.get()
+                results[first:first+len(result['sentences'])] = result['sentences']
+                new_sentence_results.update(result['sentence_results'])
+                if result['profile'] is not None:
+                    merge_profile(result['profile'])
+        finally:
+            pool.terminate()
+            gc.unfreeze()
+    # Report the messages recorded here, the sentence ids and the messages of
+    # the workers in the order of a serial run.
+    done = (0, 0)
+    for i, (position, line, sline, slabel, snapshot) in enumerate(deferred):
+        done = report_recorded(records, sent_ids.occurrences, done, (position, sid_counts[i]), known_sent_ids)
+        if results[i] is not None and results[i][3] is None:
+            sentence_records, stdout, stderr, tb = results[i]
+            for record, explanation in sentence_records:
+                emit(record, explanation)
+            sys.stdout.write(stdout)
+            if stderr:
+                sink.note(stderr)
+        else:
+            # The sentence was not sent to a worker (the file is small), or
+            # the worker failed. Validate it here, so that an exception is
+            # raised where a serial run would raise it.
+            curr_line, sentence_line, sentence_id = line, sline, slabel
+            sentence, nodes = pickle.loads(snapshot)
+            validate_sentence_contents(sentence, nodes, args)
+    report_recorded(records, sent_ids.occurrences, done, (len(records), len(sent_ids.occurrences)), known_sent_ids)
+    curr_line, sentence_line, sentence_id = end_state
+    if error is not None:
+        raise error
+
+#------------------------------------------------------------------------------
+# Resident validation server (--server, --server-socket). The server loads the
+# lemmatizer and other resources once and then validates requests in a pool of
+# worker processes forked from it, so that editors and annotation tools do not
+# pay for the startup with every validation. Requests and responses are JSON
+# objects, one per line, read from the standard input and written to the
+# standard output, or exchanged over a Unix socket (any number of connections).
+#
+# Request:  {"id": 1, "files": ["a.umr", "b.umr"], "options": ["--level", "2"]}
+#       or  {"id": 2, "text": "...", "name": "a.umr", "options": []}
+# Response: {"id": 1, "diagnostics": [...], "notes": [...], "stdout": "...",
+#            "summary": {"counts": {...}, "errors": 0, "passed": true}}
+#       or  {"id": 3, "error": "..."} if the request itself is wrong.
+#
+# The diagnostics are the records that --output-format jsonl would print. The
+# responses are written as soon as the requests are finished, which need not
+# be the order in which they came.
+#------------------------------------------------------------------------------
+
+# Options that belong to the server process and cannot be changed by requests:
+# the resources shared by all requests, and the options of the output.
+server_options = ['lemmatizer', 'lemma_cache', 'lemma_cache_size', 'cache_dir', 'wikidata_url', 'wikidata_timeout', 'wikidata_cache', 'wikidata_cache_ttl', 'wikidata_dump', 'wikidata_offline', 'output', 'output_format', 'profile', 'profile_json', 'alignment_stats', 'server', 'server_socket', 'watch', 'watch_interval', 'watch_debounce', 'report_dir']
+
+def serve_request(request):
+    """
+    Validates the files or the text of one request in a worker process of the
+    server and returns the response.
+    """
+    global args, error_counter, sink, cache_fingerprint, curr_fname, curr_line, sentence_line, sentence_id
+    response = {'id': request.get('id')}
+    files = request.get('files', [])
+    text = request.get('text')
+    name = request.get('name', '-')
+    options = request.get('options', [])
+    if not isinstance(files, list) or not all(isinstance(f, str) for f in files) or not isinstance(options, list) or not isinstance(name, str) or not (text is None or isinstance(text, str)):
+        response['error'] = "Expecting 'files' and 'options' as lists of strings, 'text' and 'name' as strings."
+        return response
+    texts = {}
+    if text is not None:
+        files = files + [name]
+        texts[name] = text
+    if not files:
+        response['error'] = "Nothing to validate: the request has neither 'files' nor 'text'."
+        return response
+    server_args = args
+    stderr = io.StringIO()
+    try:
+        with redirect_stderr(stderr):
+            request_args = build_option_parser().parse_args([str(o) for o in options] + ['--'] + files)
+    except SystemExit:
+        # The last line of the usage message says what is wrong.
+        response['error'] = stderr.getvalue().strip().split('\n')[-1]
+        return response
+    for option in server_options:
+        setattr(request_args, option, getattr(server_args, option))
+    # The request itself runs in a worker process.
+    request_args.jobs = 1
+    request_args.sentence_jobs = 1
+    args = request_args
+    error_counter = {}
+    sink = CaptureSink()
+    # The worker may have served another request (of another client) before;
+    # its location must not appear in the messages of this one.
+    curr_fname = None
+    curr_line = 0
+    sentence_line = 0
+    sentence_id = None
+    # The cached results depend on the options of the request.
+    cache_fingerprint = None
+    stdout = io.StringIO()
+    try:
+        if args.level < 1:
+            sink.note('Option --level must not be less than 1; changing from %d to 1' % args.level)
+            args.level = 1
+        try:
+            args.checks = select_checks(args)
+        except ValueError as e:
+            response['error'] = str(e)
+            return response
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            validate_inputs(args, texts)
+    finally:
+        args = server_args
+    if stderr.getvalue():
+        sink.note(stderr.getvalue())
+    nerror = sum(v for k, v in error_counter.items() if k != 'Warning')
+    response['diagnostics'] = [item for kind, item in sink.items if kind == 'record']
+    response['notes'] = [item for kind, item in sink.items if kind == 'note']
+    response['stdout'] = stdout.getvalue()
+    response['summary'] = {'counts': error_counter, 'errors': nerror, 'passed': nerror == 0}
+    return response
+
+def serve_stream(stream_in, stream_out, pool):
+    """
+    Reads requests from stream_in until it ends, validates them in the pool
+    and writes the responses to stream_out as soon as they are ready.
+    """
+    lock = threading.Lock()
+    pending = []
+    def respond(response):
+        # Called in the result thread of the pool, which must survive a
+        # client that has gone away.
+        try:
+            with lock:
+                stream_out.write(json.dumps(response, ensure_ascii=False) + '\n')
+                stream_out.flush()
+        except (OSError, ValueError):
+            pass
+    for line in stream_in:
+        if line.strip() == '':
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            respond({'id': None, 'error': 'Invalid JSON: %s' % e})
+            continue
+        if not isinstance(request, dict):
+            respond({'id': None, 'error': 'The request must be a JSON object.'})
+            continue
+        error = lambda e, id=request.get('id'): respond({'id': id, 'error': 'Exception caught! %s' % repr(e)})
+        pending.append(pool.apply_async(serve_request, (request,), callback=respond, error_callback=error))
+    for result in pending:
+        result.wait()
+
+class ServerHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one connection to the --server-socket. Each connection is handled
+    in its own thread, and its requests go to the shared pool.
+    """
+    def handle(self):
+        serve_stream(io.TextIOWrapper(self.rfile, encoding='utf-8'), io.TextIOWrapper(self.wfile, encoding='utf-8'), self.server.pool)
+
+def run_server(args):
+    """
+    Loads the shared resources, starts the pool of args.jobs workers (one per
+    CPU if --jobs is not given) and serves requests from the standard input or
+    from the Unix socket args.server_socket, until the input ends or the server
+    is interrupted.
+    """
+    # Load the resources before the workers are forked, so that they share
+    # them instead of each of them loading its own copy.
+    if lemmas_needed(args) and multiprocessing.get_start_method() == 'fork':
+        get_nlp()
+    if 'validate_abstract_concept_NEs' in args.checks:
+        get_known_concept_substrings()
+    get_wikidata_dump()
+    sys.stdout.flush()
+    sink.stream.flush()
+    gc.freeze()
+    njobs = args.jobs if args.jobs > 1 else os.cpu_count() or 1
+    with multiprocessing.Pool(njobs, initializer=init_worker, initargs=(args,)) as pool:
+        if not args.server_socket:
+            serve_stream(sys.stdin, sys.stdout, pool)
+            return
+        # A socket left behind by a previous server would prevent binding.
+        if os.path.exists(args.server_socket) and stat.S_ISSOCK(os.stat(args.server_socket).st_mode):
+            os.unlink(args.server_socket)
+        server = socketserver.ThreadingUnixStreamServer(args.server_socket, ServerHandler)
+        server.daemon_threads = True
+        server.pool = pool
+        # Stop on kill as on Ctrl+C, removing the socket.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(args.server_socket)
+
+#------------------------------------------------------------------------------
+# Watch mode (--watch). All files in a directory are validated once, then the
+# directory is polled and only the files that have changed are validated
+# again. The report of each file is kept in --report-dir under the name of the
+# file, like the error files written by the run_*.sh scripts. The sentence ids
+# of all files are kept in an index, so that an id added to (or removed from)
+# one file updates the non-unique-sent-id errors of the other files without
+# validating them again. As with several files on the command line, the error
+# is reported in the file that comes later in alphabetical order.
+#------------------------------------------------------------------------------
+
+def record_file(fname):
+    """
+    Validates one file for the watch mode (through the --cache-dir if there
+    is one) and returns the result as validate_recorded() does. It also runs
+    in the worker processes.
+    """
+    if args.cache_dir:
+        try:
+            return validate_cached_file(fname)
+        except OSError:
+            # The file has disappeared; validate_recorded() will say so.
+            pass
+    return validate_recorded(fname)
+
+def scan_directory(directory):
+    """
+    Returns the files in the directory (but not in its subdirectories) as a
+    dictionary from the path to the modification time and size. Hidden files
+    are skipped, as they are by the shell scripts.
+    """
+    files = {}
+    for entry in os.scandir(directory):
+        if entry.name.startswith('.'):
+            continue
+        try:
+            if entry.is_file():
+                st = entry.stat()
+                files[entry.path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            # Removed since the directory was listed.
+            pass
+    return files
+
+def file_sent_ids(result):
+    """
+    Returns the set of sentence ids in the result of validate_recorded().
+    """
+    if result is None:
+        return set()
+    return set(occurrence[0] for occurrence in result['sent_ids'])
+
+def write_report(fname, result, earlier_ids, report_dir):
+    """
+    Writes the report of one file to report_dir: the messages in the
+    --output-format and the final verdict, as validate.py would write them for
+    this file alone, plus the non-unique ids of sentences that occur in earlier
+    files (earlier_ids). Reports printed to the standard output (--print-*)
+    stay on the standard output. Returns the summary.
+    """
+    global error_counter, sink
+    main_sink = sink
+    error_counter = {}
+    path = os.path.join(report_dir, os.path.basename(fname))
+    stdout = io.StringIO()
+    try:
+        # The report is replaced at once, so that it is never seen half-written.
+        with io.open(path + '.tmp', 'w', encoding='utf-8') as stream:
+            sink = sink_classes[args.output_format](stream)
+            with redirect_stdout(stdout):
+                replay_file_result(fname, result, set(earlier_ids))
+            nerror = sum(v for k, v in error_counter.items() if k != 'Warning')
+            summary = {'counts': error_counter, 'errors': nerror, 'passed': nerror == 0}
+            sink.summarize(summary)
+            sink.close()
+        os.replace(path + '.tmp', path)
+    finally:
+        sink = main_sink
+    sys.stdout.write(stdout.getvalue())
+    return summary
+
+def watch(args):
+    """
+    Validates the files in the directory args.watch and keeps their reports in
+    args.report_dir up to date until interrupted. A changed file is validated
+    when it has not changed for args.watch_debounce seconds, so that a file
+    that is still being written is not validated several times.
+    """
+    results = {} # path: result of validate_recorded()
+    validated = {} # path: (mtime, size) of the file when it was validated
+    changed = {} # path: ((mtime, size), time since when the file has had it)
+    sent_id_files = {} # sentence id: set of paths of the files that contain it
+    os.makedirs(args.report_dir, exist_ok=True)
+    first = True
+    while True:
+        files = scan_directory(args.watch)
+        now = time.monotonic()
+        for path, state in files.items():
+            if validated.get(path) != state and (not path in changed or changed[path][0] != state):
+                changed[path] = (state, now)
+        for path in [p for p in changed if not p in files]:
+            del changed[path]
+        ready = sorted(p for p, (state, since) in changed.items() if first or now - since >= args.watch_debounce)
+        removed = sorted(p for p in validated if not p in files)
+        # Sentence ids whose set of files has changed.
+        touched = set()
+        for path in removed:
+            del validated[path]
+            for sid in file_sent_ids(results.pop(path)):
+                sent_id_files[sid].discard(path)
+                if not sent_id_files[sid]:
+                    del sent_id_files[sid]
+                touched.add(sid)
+            report_path = os.path.join(args.report_dir, os.path.basename(path))
+            if os.path.exists(report_path):
+                os.remove(report_path)
+            sink.note('%s: removed' % path)
+        if args.jobs > 1 and len(ready) > 1:
+            with multiprocessing.Pool(min(args.jobs, len(ready)), initializer=init_worker, initargs=(args,)) as pool:
+                new_results = pool.map(record_file, ready)
+        else:
+            new_results = [record_file(path) for path in ready]
+        for path, result in zip(ready, new_results):
+            # If the file changed again during the validation, the next scan
+            # will see that its state differs from the validated one.
+            validated[path] = changed.pop(path)[0]
+            old_ids = file_sent_ids(results.get(path))
+            new_ids = file_sent_ids(result)
+            for sid in old_ids - new_ids:
+                sent_id_files[sid].discard(path)
+                if not sent_id_files[sid]:
+                    del sent_id_files[sid]
+            for sid in new_ids - old_ids:
+                sent_id_files.setdefault(sid, set()).add(path)
+            touched |= old_ids ^ new_ids
+            results[path] = result
+        affected = set(ready)
+        for sid in touched:
+            affected |= sent_id_files.get(sid, set())
+        for path in sorted(affected):
+            earlier_ids = [sid for sid in file_sent_ids(results[path]) if min(sent_id_files[sid]) < path]
+            summary = write_report(path, results[path], earlier_ids, args.report_dir)
+            if summary['passed']:
+                sink.note('%s: PASSED' % path)
+            else:
+                sink.note('%s: FAILED with %d errors' % (path, summary['errors']))
+        if first:
+            sink.note('Validated %d files; watching %s for changes.' % (len(ready), args.watch))
+            first = False
+        if affected or removed:
+            sys.stdout.flush()
+            sink.stream.flush()
+        time.sleep(args.watch_interval)
+
+def validate_inputs(args, texts=None):
+    """
+    Validates the input files in args.input ('-' is the standard input). The
+    inputs whose names are keys in texts are not read from the disk; their
+    contents is the value (e.g. an unsaved buffer sent by an editor to the
+    --server). An exception stops the validation and is reported as an
+    internal error.
+    """
+    global curr_fname
+    if texts is None:
+        texts = {}
+    out = sys.stdout # Does this ever need to be anything else?
+    try:
+        known_sent_ids = set()
+        open_files = []
+        if args.jobs > 1 and len(args.input) > 1 and not '-' in args.input and not texts:
+            validate_files_parallel(args, known_sent_ids)
+        else:
+            # An error in opening a file is reported at that file.
+            for curr_fname in args.input:
+                if curr_fname in texts:
+                    # Universal newlines, as if the text was read from a file.
+                    open_files.append(io.StringIO(texts[curr_fname], newline=None))
+                elif curr_fname == '-':
+                    # Set PYTHONIOENCODING=utf-8 before starting Python. See https://docs.python.org/3/using/cmdline.html#envvar-PYTHONIOENCODING
+                    # Otherwise ANSI will be read in Windows and locale-dependent encoding will be used elsewhere.
+                    open_files.append(sys.stdin)
+                else:
+                    open_files.append(io.open(curr_fname, 'r', encoding='utf-8'))
+            for curr_fname, inp in zip(args.input, open_files):
+                on_disk = curr_fname != '-' and not curr_fname in texts
+                if args.cache_dir and on_disk:
+                    inp.close()
+                    result = validate_cached_file(curr_fname)
+                    replay_file_result(curr_fname, result, known_sent_ids)
+                    # Without the cache, an exception stops the validation of the remaining files, too.
+                    if result['traceback']:
+                        break
+                    continue
+                if lemmas_needed(args) and on_disk:
+                    prefetch_lemmas(curr_fname)
+                validate(inp, out, args, known_sent_ids)
+            save_lemma_cache()
+    except:
+        warn('Exception caught!', 'Internal', 0, 'internal-error')
+        # If the output is used in an HTML page, it must be properly escaped
+        # because the traceback can contain e.g. "<module>". However, escaping
+        # is beyond the goal of validation, which can be also run in a console.
+        sink.note(traceback.format_exc())
+
+def build_option_parser():
+    """
+    Returns the parser of the command-line options. The --server uses it also
+    for the options sent with each request.
+    """
     opt_parser = argparse.ArgumentParser(description="UMR validation script. Python 3 is needed to run it! Optionally, if the 'requests' library is installed (try 'pip install requests'), some functions can show Wikidata labels together with Q-codes.")
 
     io_group = opt_parser.add_argument_group('Input / output options')
     io_group.add_argument('--quiet', dest="quiet", action="store_true", default=False, help='Do not print any error messages. Exit with 0 on pass, non-zero on fail.')
     io_group.add_argument('--max-err', action="store", type=int, default=1000, help='How many errors to output before exiting? 0 for all. Default: %(default)d.')
+    io_group.add_argument('--jobs', action="store", type=int, default=1, help='Validate multiple input files in N parallel worker processes. Reports are printed per file in input order; --max-err then applies to each file separately. Standard input is always validated serially. Default: %(default)d.')
+    io_group.add_argument('--sentence-jobs', action="store", type=int, default=1, help='Run the level 3 tests that look only at one sentence (the tests of names, relations, wiki and abstract concepts) in N parallel worker processes, while the other tests of the sentences run in input order in the main process. Meant for single large files; the messages are the same as in a serial run but they are printed only after the whole file has been read. Default: %(default)d.')
     io_group.add_argument('input', nargs='*', help='Input file name(s), or "-" or nothing for standard input.')
+    io_group.add_argument('--server', action="store_true", default=False, help='Run as a resident validation server: read requests from the standard input and write the responses to the standard output, as JSON objects one per line. A request has the keys "files" (list of file names) and/or "text" (contents to validate, with the file name "name"), "options" (list of command-line options for this request) and "id" (returned in the response). The lemmatizer, caches and Wikidata options are those of the server. Up to N requests (see --jobs; one per CPU by default) are validated at the same time.')
+    io_group.add_argument('--server-socket', action="store", default=None, help='Like --server but the requests come over this Unix socket, where any number of clients can connect.')
+    io_group.add_argument('--watch', action="store", default=None, metavar='DIR', help='Validate all files in the directory DIR, then keep watching it and validate again only the files that change (polling every --watch-interval seconds). The report of each file is written to --report-dir and kept up to date; sentence ids are checked for uniqueness across all files in DIR. Stop with Ctrl+C.')
+    io_group.add_argument('--report-dir', action="store", default=None, help='Directory where --watch keeps the report of each input file, under the name of the file. Required with --watch.')
+    io_group.add_argument('--watch-interval', action="store", type=float, default=1, help='How often (in seconds) --watch looks for changed files. Default: %(default)s.')
+    io_group.add_argument('--watch-debounce', action="store", type=float, default=0.5, help='How long (in seconds) a changed file must stay unchanged before --watch validates it, so that a file that is being saved is not validated several times. Default: %(default)s.')
+    io_group.add_argument('--output-format', action="store", choices=['text', 'jsonl', 'sarif'], default='text', help="Format of the error messages: 'text' is one human-readable line per message, 'jsonl' is one JSON object per message (with the keys file, line, sentence, level, class, testid, node, message), 'sarif' is a SARIF 2.1.0 log. Default: %(default)s.")
+    io_group.add_argument('--output', action="store", default=None, help='File to which the error messages and the summary are written. Default: standard error output.')
+
+    io_group.add_argument('--cache-dir', action="store", default=None, help='Directory in which the results of the validation are kept between runs. Files that have not changed since the previous run with the same options are not validated again, and in changed files, the level 3 tests of a sentence are not repeated if the sentence has not changed. Standard input is never cached.')
+    io_group.add_argument('--lemma-cache', action="store", default=None, help='SQLite file in which lemmas of the sentences are kept between runs, so that sentences seen before are not lemmatized again.')
+    io_group.add_argument('--lemma-cache-size', action="store", type=int, default=100000, help='How many sentences to keep in the lemma cache (both in memory and on disk). Default: %(default)d.')
 
     list_group = opt_parser.add_argument_group('Label sets', 'Options relevant to checking label sets.')
     list_group.add_argument('--lang', action="store", default=None, help="Which langauge are we checking? If you specify this (as a two-letter code), the validator will use language-specific guidelines.")
+    list_group.add_argument('--lemmatizer', action="store", choices=['spacy', 'lookup', 'none'], default='spacy', help="Lemmatizer used when checking abstract concepts and named entities at level 3: 'spacy' is the full en_core_web_sm pipeline, 'lookup' is spaCy's lookup-table lemmatizer (faster to load, needs spacy-lookups-data), 'none' compares concepts with the word forms only. Default: %(default)s.")
     list_group.add_argument('--level', action="store", type=int, default=5, dest="level", help="Level 1: Test only the technical format backbone. Level 2: UMR format. Level 3: UMR contents. Level 4: Language-specific labels. Level 5: Language-specific contents.")
+    list_group.add_argument('--only', action="append", default=[], metavar='TESTS', help='Run only these tests of the --level (comma-separated names; the option can be repeated), together with the tests whose results they need. The tests are: %s.' % ', '.join(checks))
+    list_group.add_argument('--skip', action="append", default=[], metavar='TESTS', help='Do not run these tests (comma-separated names; the option can be repeated), nor the tests that need their results. E.g., --skip validate_abstract_concept_NEs saves loading the lemmatizer.')
 
     strict_group = opt_parser.add_argument_group('Strictness', 'Options for relaxing selected tests.')
     strict_group.add_argument('--allow-inline-comments', dest='inline_comments', action='store_true', default=False, help='Allow comments anywhere, not just at the beginning of a block. Everything from # to end of line will be ignored. This option also implies --allow-trailing-whitespace.')
@@ -2438,64 +4393,87 @@ if __name__=="__main__":
         help='Do not report extra/spurious empty lines.'
     )
 
+    wikidata_group = opt_parser.add_argument_group('Wikidata', "Options for looking up the labels of :wiki values, which are shown in some messages and reports. The labels are requested from the Wikidata API only if the 'requests' library is installed.")
+    wikidata_group.add_argument('--wikidata-url', action="store", default='https://www.wikidata.org/w/api.php', help='URL of the Wikidata API (or of a local server with the same API). Default: %(default)s.')
+    wikidata_group.add_argument('--wikidata-timeout', action="store", type=float, default=10, help='How many seconds to wait for the Wikidata API. If a request fails, no further requests are made in the same run. Default: %(default)s.')
+    wikidata_group.add_argument('--wikidata-cache', action="store", default=None, help='SQLite file in which Wikidata labels are kept between runs.')
+    wikidata_group.add_argument('--wikidata-cache-ttl', action="store", type=float, default=30, help='After how many days a label in the Wikidata cache is requested again. Default: %(default)s.')
+    wikidata_group.add_argument('--wikidata-dump', action="store", default=None, help='Local file with Wikidata labels: a JSON object mapping ids to labels (file name ending in .json), or an SQLite file with the table labels (id, label), such as a copy of --wikidata-cache.')
+    wikidata_group.add_argument('--wikidata-offline', action="store_true", default=False, help='Do not contact the Wikidata API; use only --wikidata-cache and --wikidata-dump.')
+
     report_group = opt_parser.add_argument_group('Reports', 'Options for printing additional reports about the data.')
     report_group.add_argument('--print-relations', dest='print_relations', action='store_true', default=False, help='Print detailed info about all nodes and relations.')
     report_group.add_argument('--print-clusters', dest='print_clusters', action='store_true', default=False, help='Print detailed info about coreference clusters (entities).')
     report_group.add_argument('--print-temporal', dest='print_temporal', action='store_true', default=False, help='Print detailed info about temporal relations.')
+    report_group.add_argument('--alignment-stats', dest='alignment_stats', action='store_true', default=False, help='Print a table with the alignment coverage of each file and their totals: tokens aligned to a node, tokens aligned to more than one node, unaligned non-punctuation tokens, unaligned (0-0) nodes and nodes without alignment.')
+    report_group.add_argument('--profile', action='store_true', default=False, help='Measure the time spent in the individual tests and print a table with the totals per test, level and file, and the slowest sentences.')
+    report_group.add_argument('--profile-json', action='store', default=None, help='Measure the time spent in the individual tests (like --profile) and write the results to this file as JSON.')
+    return opt_parser
 
+if __name__=="__main__":
+    opt_parser = build_option_parser()
     args = opt_parser.parse_args() # Parsed command-line arguments
     error_counter={} # Incremented by warn()  {key: error type value: its count}
+    sink = open_sink(args)
+    if args.profile or args.profile_json:
+        install_profiler()
 
     # Level of validation
     if args.level < 1:
-        print('Option --level must not be less than 1; changing from %d to 1' % args.level, file=sys.stderr)
+        sink.note('Option --level must not be less than 1; changing from %d to 1' % args.level)
         args.level = 1
 
-    out = sys.stdout # Does this ever need to be anything else?
-
     try:
-        known_sent_ids = set()
-        open_files = []
-        if args.input == []:
-            args.input.append('-')
-        for fname in args.input:
-            if fname == '-':
-                # Set PYTHONIOENCODING=utf-8 before starting Python. See https://docs.python.org/3/using/cmdline.html#envvar-PYTHONIOENCODING
-                # Otherwise ANSI will be read in Windows and locale-dependent encoding will be used elsewhere.
-                open_files.append(sys.stdin)
-            else:
-                open_files.append(io.open(fname, 'r', encoding='utf-8'))
-        for curr_fname, inp in zip(args.input, open_files):
-            validate(inp, out, args, known_sent_ids)
-    except:
-        warn('Exception caught!', 'Internal', 0, 'internal-error')
-        # If the output is used in an HTML page, it must be properly escaped
-        # because the traceback can contain e.g. "<module>". However, escaping
-        # is beyond the goal of validation, which can be also run in a console.
-        traceback.print_exc()
+        args.checks = select_checks(args)
+    except ValueError as e:
+        opt_parser.error(str(e))
+    if lemmas_needed(args) and args.lemmatizer == 'lookup':
+        # Without the tables, spaCy would fail only when the first lemma is needed.
+        try:
+            importlib.metadata.version('spacy-lookups-data')
+        except importlib.metadata.PackageNotFoundError:
+            opt_parser.error("--lemmatizer lookup needs the package spacy-lookups-data (pip install spacy-lookups-data), or use --lemmatizer spacy or none")
+
+    if args.server or args.server_socket:
+        run_server(args)
+        sys.exit(0)
+    if args.watch:
+        if not args.report_dir:
+            opt_parser.error('--watch requires --report-dir')
+        if os.path.realpath(args.report_dir) == os.path.realpath(args.watch):
+            opt_parser.error('--report-dir must not be the watched directory')
+        # Stop on kill as on Ctrl+C.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+        sink.close()
+        sys.exit(0)
+    if args.input == []:
+        args.input.append('-')
+    validate_inputs(args)
+    if profile is not None:
+        summary = profile_summary()
+        if args.profile:
+            print_profile(summary)
+        if args.profile_json:
+            with io.open(args.profile_json, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+    if args.alignment_stats:
+        print_alignment_stats()
     # Summarize the warnings and errors.
-    passed = True
-    nerror = 0
-    if error_counter:
-        for k, v in sorted(error_counter.items()):
-            if k == 'Warning':
-                errors = 'Warnings'
-            else:
-                errors = k+' errors'
-                nerror += v
-                passed = False
-            if not args.quiet:
-                print('%s: %d' % (errors, v), file=sys.stderr)
+    nerror = sum(v for k, v in error_counter.items() if k != 'Warning')
+    passed = nerror == 0
     # Print the final verdict and exit.
+    sink.summarize({'counts': error_counter, 'errors': nerror, 'passed': passed})
     if passed:
-        if not args.quiet:
-            print('*** PASSED ***', file=sys.stderr)
+        sink.close()
         sys.exit(0)
     else:
-        if not args.quiet:
-            print('*** FAILED *** with %d errors' % nerror, file=sys.stderr)
         for f_name in sorted(warn_on_missing_files):
             filepath = os.path.join(THISDIR, 'data', f_name+'.'+args.lang)
             if not os.path.exists(filepath):
-                print('The language-specific file %s does not exist.' % filepath, file=sys.stderr)
+                sink.note('The language-specific file %s does not exist.' % filepath)
+        sink.close()
         sys.exit(1)
@@ -0,0 +1,340 @@
+"""
+Tests of scripts/validate.py. The validator is run as a command, as the users
+run it, and its reports are compared with what is expected.
+
+Usage:
+    python -m pytest tests
+"""
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+sys.path.insert(0, scripts_dir)
+import validate
+
+
+def run_script(name, *arguments):
+    """
+    Runs a script from the scripts directory and returns its exit code and
+    what it printed to the standard output and the standard error output.
+    """
+    result = subprocess.run([sys.executable, os.path.join(scripts_dir, name)] + list(arguments),
+                            capture_output=True, text=True)
+    return result.returncode, result.stdout, result.stderr
+
+
+class OutputFormatTest(unittest.TestCase):
+    """
+    Machine-readable output of the messages (--output-format).
+    """
+    def test_node_of_each_message(self):
+        # Every message that names a node must carry it in the node field.
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '60', '--coref-rate', '0.5',
+                                              '--error-rate', '0.8', '--seed', '3', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            code, stdout, stderr = run_script('validate.py', '--lemmatizer', 'none', '--wikidata-offline', '--max-err', '0',
+                                              '--output-format', 'jsonl', fname)
+            records = [json.loads(line) for line in stderr.splitlines() if line.startswith('{')]
+            records = [r for r in records if 'testid' in r]
+            self.assertIn('missing-alignment', [r['testid'] for r in records])
+            for r in records:
+                named = re.findall(r"\b(s[0-9]+[a-z]+[0-9]*)\b", r['message'])
+                if named:
+                    self.assertIn(r['node'], named, r)
+
+
+class WikidataStub(http.server.ThreadingHTTPServer):
+    """
+    A local stand-in for the Wikidata API (--wikidata-url). It answers
+    wbgetentities requests according to its mode: 'labels' gives every id the
+    label 'Label of <id>', 'error' is an API error with HTTP status 200 (as
+    after maxlag) and 'down' is HTTP status 503.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            ids = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['ids'][0].split('|')
+            status = 200
+            if self.server.mode == 'labels':
+                data = {'entities': {id: {'id': id, 'labels': {'en': {'language': 'en', 'value': 'Label of ' + id}}} for id in ids}}
+            elif self.server.mode == 'error':
+                data = {'error': {'code': 'maxlag', 'info': 'Waiting for a database server.'}}
+            else:
+                status = 503
+                data = {}
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self, mode):
+        super().__init__(('127.0.0.1', 0), self.Handler)
+        self.mode = mode
+        self.url = 'http://127.0.0.1:%d/w/api.php' % self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class LemmaCacheTest(unittest.TestCase):
+    """
+    Sentences whose lemmas are in the disk cache (--lemma-cache) must be
+    validated without loading spaCy. A stub of spaCy is put in front of the
+    real one: it lemmatizes by lowercasing in the first run and refuses to
+    load in the second.
+    """
+    document = """# meta-info :: sent_id = test.1
+# :: snt1
+Index: 1 2
+Words: dog barks
+
+# sentence level graph:
+(s1b1 / bark-01
+    :ARG0 (s1d2 / dog)
+    :aspect habitual
+    :modal-strength full-affirmative)
+
+# alignment:
+s1b1: 2-2
+s1d2: 1-1
+
+# document level annotation:
+(s1s0 / sentence
+    :temporal ((document-creation-time :overlap s1b1))
+    :modal ((root :modal author)
+            (author :full-affirmative s1b1)))
+
+
+# meta-info :: sent_id = test.2
+# :: snt2
+Index: 1 2
+Words: Rain fell
+
+# sentence level graph:
+(s2f1 / fall-01
+    :ARG1 (s2r2 / rain-01)
+    :aspect performance
+    :modal-strength full-affirmative)
+
+# alignment:
+s2f1: 0-0
+s2r2: 1-2
+
+# document level annotation:
+(s2s0 / sentence
+    :temporal ((document-creation-time :before s2f1))
+    :modal ((root :modal author)
+            (author :full-affirmative s2f1)))
+
+
+"""
+
+    working_spacy = """
+class Token:
+    def __init__(self, text):
+        self.lemma_ = text.lower()
+
+class Language:
+    meta = {'lang': 'en', 'name': 'stub', 'version': '0'}
+
+    def pipe(self, texts, **kwargs):
+        for text in texts:
+            yield [Token(t) for t in text.split(' ')]
+
+def load(name):
+    return Language()
+"""
+    refusing_spacy = """
+def load(name):
+    raise RuntimeError('spaCy must not be loaded when all lemmas are cached')
+
+def blank(name):
+    raise RuntimeError('spaCy must not be loaded when all lemmas are cached')
+"""
+
+    def test_second_run_does_not_load_spacy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'test.umr')
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write(self.document)
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join([tmp, os.environ.get('PYTHONPATH', '')]))
+            reports = []
+            for stub in (self.working_spacy, self.refusing_spacy):
+                with open(os.path.join(tmp, 'spacy.py'), 'w', encoding='utf-8') as f:
+                    f.write(stub)
+                result = subprocess.run([sys.executable, os.path.join(scripts_dir, 'validate.py'), '--lemmatizer', 'spacy',
+                                         '--lemma-cache', os.path.join(tmp, 'lemmas.db'), fname],
+                                        capture_output=True, text=True, env=env)
+                self.assertNotIn('internal-error', result.stderr)
+                reports.append((result.returncode, result.stdout, result.stderr))
+            self.assertEqual(reports[0], reports[1])
+
+
+class ResultCacheTest(unittest.TestCase):
+    """
+    The results of the previous run (--cache-dir) are replayed only where they
+    are the same as a new validation would give.
+    """
+    def test_sentences_after_an_inserted_line(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '30', '--error-rate', '0.5',
+                                              '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            cache = ['--cache-dir', os.path.join(tmp, 'cache'), '--wikidata-offline', '--max-err', '0']
+            run_script('validate.py', '--lemmatizer', 'none', *cache, fname)
+            with open(fname, encoding='utf-8') as f:
+                text = f.read()
+            with open(fname, 'w', encoding='utf-8') as f:
+                f.write('\n' + text)
+            profile = os.path.join(tmp, 'profile.json')
+            cached = run_script('validate.py', '--lemmatizer', 'none', *cache, '--profile-json', profile, fname)
+            fresh = run_script('validate.py', '--lemmatizer', 'none', '--wikidata-offline', '--max-err', '0', fname)
+            self.assertEqual(cached, fresh)
+            with open(profile, encoding='utf-8') as f:
+                checks = [c['check'] for c in json.load(f)['checks']]
+            # Every sentence was taken from the cache.
+            self.assertIn('validate_sentence_graph', checks)
+            self.assertNotIn('validate_relations', checks)
+
+    def test_labels_after_unreachable_wikidata(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '40', '--coref-rate', '0.5',
+                                              '--errors', 'wiki-mismatch', '--error-rate', '0.5', '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            reports = []
+            with WikidataStub('down') as wikidata:
+                for mode in ('down', 'labels'):
+                    wikidata.mode = mode
+                    reports.append(run_script('validate.py', '--lemmatizer', 'none', '--cache-dir', os.path.join(tmp, 'cache'),
+                                              '--wikidata-url', wikidata.url, '--print-clusters', fname))
+            self.assertIn('coref-wiki-mismatch', reports[0][2])
+            self.assertNotIn('Label of', reports[0][1] + reports[0][2])
+            self.assertIn('Label of', reports[1][1])
+            self.assertIn('Label of', reports[1][2])
+
+
+class WikidataCacheTest(unittest.TestCase):
+    """
+    Labels in the disk cache of Wikidata labels (--wikidata-cache).
+    """
+    def test_api_error_is_not_cached(self):
+        # An error of the API comes with HTTP status 200. The ids of the
+        # batch must not be stored as having no label.
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '40', '--coref-rate', '0.5',
+                                              '--errors', 'wiki-mismatch', '--error-rate', '0.5', '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            reports = []
+            with WikidataStub('error') as wikidata:
+                for mode in ('error', 'labels'):
+                    wikidata.mode = mode
+                    reports.append(run_script('validate.py', '--lemmatizer', 'none', '--wikidata-cache', os.path.join(tmp, 'labels.db'),
+                                              '--wikidata-url', wikidata.url, fname))
+            self.assertIn('coref-wiki-mismatch', reports[0][2])
+            self.assertNotIn('Label of', reports[0][2])
+            self.assertIn('Label of', reports[1][2])
+
+
+class SentenceJobsTest(unittest.TestCase):
+    """
+    --sentence-jobs must not change the report of a file, even if the
+    coreference and temporal relations link sentences that are validated in
+    different batches.
+    """
+    def test_same_report_as_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '400', '--coref-rate', '0.5',
+                                              '--error-rate', '0.2', '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            # Make sure that the relations cross the batches.
+            batch = lambda s: (int(s) - 1) // validate.contents_batch_size
+            crossing = {':coref': 0, ':temporal': 0}
+            group = None
+            with open(fname, encoding='utf-8') as f:
+                for line in f:
+                    match = re.match(r'\s*(:coref|:temporal|:modal)', line)
+                    if match:
+                        group = match.group(1)
+                    match = re.search(r'\(s([0-9]+)[a-z]+[0-9]* :\S+ s([0-9]+)[a-z]+[0-9]*\)', line)
+                    if match and group in crossing and batch(match.group(1)) != batch(match.group(2)):
+                        crossing[group] += 1
+            self.assertTrue(all(crossing.values()), crossing)
+            options = ['--lemmatizer', 'none', '--max-err', '0', '--print-clusters', '--print-temporal', fname]
+            serial = run_script('validate.py', '--jobs', '1', *options)
+            parallel = run_script('validate.py', '--jobs', '4', '--sentence-jobs', '4', *options)
+            self.assertIn('Coreference cluster', serial[1])
+            self.assertIn('FAILED', serial[2])
+            self.assertEqual(serial, parallel)
+
+
+class ServerTest(unittest.TestCase):
+    """
+    The resident validation server (--server): requests in, responses out.
+    """
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            missing = os.path.join(tmp, 'missing.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '20', '--error-rate', '0.5',
+                                              '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            with open(fname, encoding='utf-8') as f:
+                text = f.read()
+            requests = [{'id': 1, 'files': [fname]},
+                        {'id': 2, 'files': [missing]},
+                        {'id': 3, 'text': text, 'name': 'buffer.umr', 'options': ['--level', '1']},
+                        {'id': 4, 'files': [fname], 'options': ['--no-such-option']}]
+            result = subprocess.run([sys.executable, os.path.join(scripts_dir, 'validate.py'), '--server', '--jobs', '1', '--lemmatizer', 'none'],
+                                    input=''.join(json.dumps(r) + '\n' for r in requests), capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            responses = {r['id']: r for r in map(json.loads, result.stdout.splitlines())}
+            self.assertEqual(sorted(responses), [1, 2, 3, 4])
+            self.assertFalse(responses[1]['summary']['passed'])
+            self.assertTrue(all(d['file'] == fname for d in responses[1]['diagnostics']))
+            self.assertEqual([(d['file'], d['line'], d['sentence'], d['testid']) for d in responses[2]['diagnostics']],
+                             [(missing, 0, None, 'internal-error')])
+            self.assertTrue(responses[3]['summary']['passed'], responses[3])
+            self.assertIn('no-such-option', responses[4]['error'])
+
+    def test_location_of_previous_request(self):
+        # A worker serves one request after another. An error before the
+        # first line of a file must not be reported at the place where the
+        # previous request ended.
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'synthetic.umr')
+            missing = os.path.join(tmp, 'missing.umr')
+            code, stdout, stderr = run_script('generate_synthetic_umr.py', '--sentences', '20', '--error-rate', '0.5',
+                                              '--seed', '7', '--output', fname)
+            self.assertEqual(code, 0, stderr)
+            validate.args = validate.build_option_parser().parse_args(['--server', '--lemmatizer', 'none'])
+            first = validate.serve_request({'files': [fname]})
+            self.assertTrue(first['diagnostics'])
+            second = validate.serve_request({'files': [missing]})
+            self.assertEqual([(d['file'], d['line'], d['sentence']) for d in second['diagnostics']], [(missing, 0, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()